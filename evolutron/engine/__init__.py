@@ -1,3 +1,4 @@
 # coding=utf-8
 
+from .export import export_model
 from .krs import Model, load_model
@@ -0,0 +1,172 @@
+# coding=utf-8
+"""
+    Exports trained models to the flat weight files run by evolutron.runtime.
+"""
+from collections import OrderedDict
+
+import keras.backend as K
+import keras.layers as native
+import numpy as np
+from keras.engine import InputLayer
+from keras.layers.convolutional import _Conv
+
+from ..extra_layers import Deconvolution1D, Dedense, IndexConvolution1D, SegmentMasking
+from ..runtime import ACTIVATIONS, write_weight_file
+from ..tools.seq_tools import aa_index_table, idx_hot_table
+
+MERGE_TYPES = [(native.Concatenate, 'concatenate'), (native.Add, 'add'), (native.Multiply, 'multiply'),
+               (native.Average, 'average'), (native.Maximum, 'maximum')]
+IDENTITY_TYPES = (native.Dropout, native.SpatialDropout1D, native.GaussianNoise, native.GaussianDropout)
+
+
+def _activation(layer):
+    activation = getattr(layer, 'activation', None)
+    return None if activation is None else activation.__name__
+
+
+def _describe(layer):
+    """ Translates a layer into a runtime layer type, its configuration and the tensors of its weights.
+    """
+    if isinstance(layer, InputLayer):
+        return 'input', {}, {}
+
+    if isinstance(layer, IndexConvolution1D):
+        # The runtime sums the kernel rows of each residue index, as the layer does
+        kernel, = K.batch_get_value([layer.kernel])
+        taps = np.einsum('ia,kaf->kif', idx_hot_table(layer.nb_aa), kernel)
+        config = {'padding': layer.padding, 'dilation_rate': layer.dilation_rate[0],
+                  'activation': _activation(layer)}
+        return 'index_conv1d', config, {'taps': taps, 'bias': layer.bias if layer.use_bias else None}
+
+    # Unbound tied layers hold a placeholder kernel of zeros, e.g. after loading from the architecture alone
+    if isinstance(layer, Deconvolution1D) and not hasattr(layer, '_bound_conv_layer'):
+        raise ValueError('Deconvolution1D {} is not bound to a convolution and cannot be exported.'.format(layer.name))
+    if isinstance(layer, Dedense) and not hasattr(layer, '_bound_dense_layer'):
+        raise ValueError('Dedense {} is not bound to a dense layer and cannot be exported.'.format(layer.name))
+
+    if isinstance(layer, _Conv) and layer.rank == 1:
+        # Deconvolution1D kernels are the transposed kernels of their bound Conv1D
+        config = {'strides': layer.strides[0], 'padding': layer.padding, 'dilation_rate': layer.dilation_rate[0],
+                  'activation': _activation(layer),
+                  'apply_mask': isinstance(layer, Deconvolution1D) and layer.apply_mask}
+        return 'conv1d', config, {'kernel': layer.kernel, 'bias': layer.bias if layer.use_bias else None}
+
+    if isinstance(layer, native.Dense):
+        # Dedense kernels are the transposed kernels of their bound Dense
+        weights = {'kernel': layer.kernel, 'bias': layer.bias if layer.use_bias else None}
+        return 'dense', {'activation': _activation(layer)}, weights
+
+    if isinstance(layer, native.LocallyConnected1D):
+        config = {'strides': layer.strides[0], 'activation': _activation(layer)}
+        return 'locally_connected1d', config, {'kernel': layer.kernel, 'bias': layer.bias if layer.use_bias else None}
+
+    if isinstance(layer, native.MaxPooling1D):
+        return 'max_pool1d', {'pool_size': layer.pool_size[0], 'strides': layer.strides[0],
+                              'padding': layer.padding}, {}
+
+    if isinstance(layer, native.GlobalMaxPooling1D):
+        return 'global_max_pool1d', {}, {}
+    if isinstance(layer, native.GlobalAveragePooling1D):
+        return 'global_average_pool1d', {}, {}
+    if isinstance(layer, native.Flatten):
+        return 'flatten', {}, {}
+    if isinstance(layer, native.Reshape):
+        return 'reshape', {'target_shape': list(layer.target_shape)}, {}
+    if isinstance(layer, native.UpSampling1D):
+        return 'upsampling1d', {'size': layer.size}, {}
+    if isinstance(layer, native.Masking):
+        return 'masking', {'mask_value': layer.mask_value}, {}
+    if isinstance(layer, SegmentMasking):
+        return 'segment_masking', {}, {}
+    if isinstance(layer, native.Activation):
+        return 'activation', {'activation': _activation(layer)}, {}
+    if isinstance(layer, IDENTITY_TYPES):
+        return 'identity', {}, {}
+
+    if isinstance(layer, native.BatchNormalization):
+        if layer.axis not in (-1, len(layer.input_shape) - 1):
+            raise ValueError('Only BatchNormalization over the last axis can be exported.')
+        weights = {'gamma': layer.gamma if layer.scale else None, 'beta': layer.beta if layer.center else None,
+                   'moving_mean': layer.moving_mean, 'moving_variance': layer.moving_variance}
+        return 'batch_normalization', {'epsilon': layer.epsilon}, weights
+
+    for merge_type, kind in MERGE_TYPES:
+        if isinstance(layer, merge_type):
+            return kind, {'axis': layer.axis} if kind == 'concatenate' else {}, {}
+
+    raise ValueError('Layer {0} of type {1} cannot be exported.'.format(layer.name, type(layer).__name__))
+
+
+def _inbound(layer_config):
+    nodes = layer_config['inbound_nodes']
+    if len(nodes) > 1:
+        raise ValueError('Shared layer {} cannot be exported.'.format(layer_config['name']))
+    if not nodes:
+        return []
+    if any(node[2] != 0 for node in nodes[0]):
+        raise ValueError('Layer {} uses a non-first output of a layer.'.format(layer_config['name']))
+    return [node[0] for node in nodes[0]]
+
+
+def export_model(model, filepath, dtype=np.float32):
+    """ Exports a model to a flat weight file for evolutron.runtime, which runs it with NumPy only.
+
+    Supports Conv1D (and Convolution1D, IndexConvolution1D, Deconvolution1D with tied weights), Dense and Dedense,
+    LocallyConnected1D, MaxPooling1D, global pooling, Flatten, Reshape, UpSampling1D, Masking, SegmentMasking,
+    Activation, BatchNormalization, merges and dropout layers, with the built-in activations.
+
+    Args:
+        model (keras.models.Model): the trained model.
+        filepath (str): path of the exported file.
+        dtype: floating point type the weights are stored and computed in.
+
+    Returns: The number of layers exported.
+    """
+    config = model.get_config()
+    layers, arrays, tensors = [], OrderedDict(), []
+    for layer, layer_config in zip(model.layers, config['layers']):
+        assert layer.name == layer_config['name']
+        kind, layer_params, weights = _describe(layer)
+
+        activation = layer_params.get('activation')
+        if activation not in ACTIVATIONS:
+            raise ValueError('Activation {0} of layer {1} cannot be exported.'.format(activation, layer.name))
+
+        names = {}
+        for weight, value in weights.items():
+            if value is None:
+                continue
+            names[weight] = '{0}/{1}'.format(layer.name, weight)
+            if isinstance(value, np.ndarray):
+                arrays[names[weight]] = value.astype(dtype)
+            else:
+                arrays[names[weight]] = None
+                tensors.append((names[weight], value))
+        layers.append({'name': layer.name, 'type': kind, 'config': layer_params, 'inbound': _inbound(layer_config),
+                       'weights': names})
+
+    # All weights, tied kernels included, are evaluated in one call
+    for (name, _), value in zip(tensors, K.batch_get_value([tensor for _, tensor in tensors])):
+        arrays[name] = np.asarray(value, dtype=dtype)
+
+    if any(layer[2] != 0 for layer in config['output_layers']):
+        raise ValueError('Models with non-first layer outputs cannot be exported.')
+
+    if hasattr(model, '_input_encoding'):
+        compact, nb_aa = model._input_encoding()
+    else:
+        input_shape = K.int_shape(model.inputs[0])
+        compact, nb_aa = len(input_shape) == 2, input_shape[-1] if len(input_shape) == 3 else 20
+    arrays['index_table'] = aa_index_table(nb_aa)
+    arrays['hot_table'] = idx_hot_table(nb_aa, dtype)
+
+    header = {'format': 'runtime',
+              'name': model.name,
+              'inputs': [layer[0] for layer in config['input_layers']],
+              'outputs': [layer[0] for layer in config['output_layers']],
+              'input_shapes': [list(K.int_shape(x)) for x in model.inputs],
+              'compact': bool(compact),
+              'nb_aa': int(nb_aa),
+              'layers': layers}
+    write_weight_file(filepath, header, arrays)
+    return len(layers)
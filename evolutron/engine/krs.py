@@ -5,23 +5,28 @@ import json
 import os
 import time
 import warnings
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 import h5py
 import keras
 import keras.backend as K
 import keras.optimizers as opt
 import numpy as np
-from keras.callbacks import ModelCheckpoint
 from keras.engine import topology
 from keras.layers import deserialize_keras_object
-from keras.utils import print_summary
+from keras.utils import Sequence, print_summary
 
+from ..extra_callbacks import BestWeights
+from ..runtime import is_weight_file, read_weight_file, write_weight_file
 from ..tools import Handle, train_valid_split
+from ..tools.data_tools import (bucket_batches, encode_batch, hot_batch_generator, is_index_encoded, prefetch,
+                                stream_batches)
+from ..tools.io_tools import PredictionSink
 
 
 def load_model(filepath, custom_objects=None, compile=True):
-    """Loads an Evolutron model saved via Model.save().
+    """Loads an Evolutron model saved via Model.save(), either as HDF5
+    or in the memory-mapped format of save_mapped.
     # Arguments
         filepath: String, path to the saved model.
         custom_objects: Optional dictionary mapping names
@@ -40,9 +45,6 @@ def load_model(filepath, custom_objects=None, compile=True):
         ImportError: if h5py is not available.
         ValueError: In case of an invalid savefile.
     """
-    if h5py is None:
-        raise ImportError('`load_model` requires h5py.')
-
     if not custom_objects:
         custom_objects = {}
 
@@ -82,63 +84,163 @@ def load_model(filepath, custom_objects=None, compile=True):
             return custom_objects[obj]
         return obj
 
-    f = h5py.File(filepath, mode='r')
-
-    # instantiate model
-    model_config = f.attrs.get('model_config')
-    if model_config is None:
-        raise ValueError('No model found in config file.')
-    model_config = json.loads(model_config.decode('utf-8'))
-
     globs = globals()  # All layers.
     globs['Model'] = Model
-    model = deserialize_keras_object(model_config,
-                                     module_objects=globs,
-                                     custom_objects=custom_objects,
-                                     printable_module_name='layer')
-    # set weights
-    topology.load_weights_from_hdf5_group(f['model_weights'], model.layers)
-
-    # Early return if compilation is not required.
-    if not compile:
-        f.close()
-        return model
 
-    # instantiate optimizer
-    training_config = f.attrs.get('training_config')
-    if training_config is None:
-        warnings.warn('No training configuration found in save file: '
-                      'the model was *not* compiled. Compile it manually.')
-        f.close()
+    if is_weight_file(filepath):
+        # Memory-mapped format: weights are views into the file until they are copied into the model
+        header, arrays = read_weight_file(filepath)
+        if header.get('format') != 'keras':
+            raise ValueError('No model found in {}.'.format(filepath))
+        model = deserialize_keras_object(header['model_config'],
+                                         module_objects=globs,
+                                         custom_objects=custom_objects,
+                                         printable_module_name='layer')
+        _set_mapped_weights(model, header['layers'], arrays)
+        training_config = header.get('training_config')
+        optimizer_weight_values = [arrays[name] for name in header.get('optimizer_weights', [])]
+        f = None
+    else:
+        if h5py is None:
+            raise ImportError('`load_model` requires h5py.')
+        f = h5py.File(filepath, mode='r')
+
+        # instantiate model
+        model_config = f.attrs.get('model_config')
+        if model_config is None:
+            raise ValueError('No model found in config file.')
+        model_config = json.loads(model_config.decode('utf-8'))
+
+        model = deserialize_keras_object(model_config,
+                                         module_objects=globs,
+                                         custom_objects=custom_objects,
+                                         printable_module_name='layer')
+        # set weights
+        topology.load_weights_from_hdf5_group(f['model_weights'], model.layers)
+
+        training_config = f.attrs.get('training_config')
+        if training_config is not None:
+            training_config = json.loads(training_config.decode('utf-8'))
+        optimizer_weight_values = []
+        if 'optimizer_weights' in f:
+            optimizer_weights_group = f['optimizer_weights']
+            optimizer_weight_names = [n.decode('utf8') for n in optimizer_weights_group.attrs['weight_names']]
+            optimizer_weight_values = [optimizer_weights_group[n] for n in optimizer_weight_names]
+
+    try:
+        # Early return if compilation is not required.
+        if not compile:
+            return model
+
+        # instantiate optimizer
+        if training_config is None:
+            warnings.warn('No training configuration found in save file: '
+                          'the model was *not* compiled. Compile it manually.')
+            return model
+        optimizer_config = training_config['optimizer_config']
+        optimizer = opt.deserialize(optimizer_config,
+                                    custom_objects=custom_objects)
+
+        # Recover loss functions and metrics.
+        loss = convert_custom_objects(training_config['loss'])
+        metrics = convert_custom_objects(training_config['metrics'])
+        sample_weight_mode = training_config['sample_weight_mode']
+        loss_weights = training_config['loss_weights']
+
+        # Compile model.
+        model.compile(optimizer=optimizer,
+                      loss=loss,
+                      metrics=metrics,
+                      loss_weights=loss_weights,
+                      sample_weight_mode=sample_weight_mode)
+
+        # Set optimizer weights.
+        if optimizer_weight_values:
+            # Build train function (to get weight updates).
+            model._make_train_function()
+            model.optimizer.set_weights(optimizer_weight_values)
         return model
-    training_config = json.loads(training_config.decode('utf-8'))
-    optimizer_config = training_config['optimizer_config']
-    optimizer = opt.deserialize(optimizer_config,
-                                custom_objects=custom_objects)
-
-    # Recover loss functions and metrics.
-    loss = convert_custom_objects(training_config['loss'])
-    metrics = convert_custom_objects(training_config['metrics'])
-    sample_weight_mode = training_config['sample_weight_mode']
-    loss_weights = training_config['loss_weights']
-
-    # Compile model.
-    model.compile(optimizer=optimizer,
-                  loss=loss,
-                  metrics=metrics,
-                  loss_weights=loss_weights,
-                  sample_weight_mode=sample_weight_mode)
-
-    # Set optimizer weights.
-    if 'optimizer_weights' in f:
-        # Build train function (to get weight updates).
-        model._make_train_function()
-        optimizer_weights_group = f['optimizer_weights']
-        optimizer_weight_names = [n.decode('utf8') for n in optimizer_weights_group.attrs['weight_names']]
-        optimizer_weight_values = [optimizer_weights_group[n] for n in optimizer_weight_names]
-        model.optimizer.set_weights(optimizer_weight_values)
-    f.close()
-    return model
+    finally:
+        if f is not None:
+            f.close()
+
+
+def _json_default(obj):
+    """ Serializes the objects found in model and training configurations.
+    """
+    if hasattr(obj, 'get_config'):
+        return {'class_name': obj.__class__.__name__, 'config': obj.get_config()}
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if hasattr(obj, '__name__'):
+        return obj.__name__
+    raise TypeError('Not JSON Serializable: {}'.format(obj))
+
+
+def _set_mapped_weights(model, layer_weights, arrays):
+    """ Sets the weights of a model from the arrays of a memory-mapped file, all in one backend call.
+    """
+    layers = {layer.name: layer for layer in model.layers}
+    weight_value_tuples = []
+    for entry in layer_weights:
+        layer = layers[entry['name']]
+        if len(layer.weights) != len(entry['weights']):
+            raise ValueError('Layer {0} expects {1} weights, but the saved model has {2}.'.format(
+                    layer.name, len(layer.weights), len(entry['weights'])))
+        weight_value_tuples += zip(layer.weights, [arrays[name] for name in entry['weights']])
+    K.batch_set_value(weight_value_tuples)
+
+
+def save_mapped(model, filepath, include_optimizer=False):
+    """ Saves a model as a JSON architecture header followed by one aligned weight blob, which load_model
+    memory-maps instead of parsing.
+
+    # Arguments
+        model: Keras model instance to be saved.
+        filepath: String, path where to save the model.
+        include_optimizer: Boolean, whether to also save the optimizer state, which is only needed to resume
+            training. The training configuration is saved either way.
+    """
+    # All weights are read from the backend in one call, in layer order
+    values = K.batch_get_value([weight for layer in model.layers for weight in layer.weights])
+    arrays, layers = OrderedDict(), []
+    for layer in model.layers:
+        names = ['{0}/{1}'.format(layer.name, i) for i in range(len(layer.weights))]
+        arrays.update(zip(names, values[:len(names)]))
+        values = values[len(names):]
+        layers.append({'name': layer.name, 'weights': names})
+
+    header = {'format': 'keras',
+              'keras_version': keras.__version__,
+              'backend': K.backend(),
+              'model_config': {'class_name': model.__class__.__name__, 'config': model.get_config()},
+              'layers': layers}
+    if hasattr(model, 'optimizer'):
+        header['training_config'] = {'optimizer_config': {'class_name': model.optimizer.__class__.__name__,
+                                                          'config': model.optimizer.get_config()},
+                                     'loss': model.loss,
+                                     'metrics': model.metrics,
+                                     'sample_weight_mode': model.sample_weight_mode,
+                                     'loss_weights': model.loss_weights}
+        if include_optimizer:
+            names = ['optimizer/{}'.format(i) for i in range(len(model.optimizer.weights))]
+            arrays.update(zip(names, K.batch_get_value(model.optimizer.weights)))
+            header['optimizer_weights'] = names
+
+    write_weight_file(filepath, json.loads(json.dumps(header, default=_json_default)), arrays)
+
+
+def load_weights(model, filepath):
+    """ Loads the weights of a model saved in either format into a model of the same architecture.
+    """
+    if is_weight_file(filepath):
+        header, arrays = read_weight_file(filepath)
+        _set_mapped_weights(model, header['layers'], arrays)
+    else:
+        with h5py.File(filepath, mode='r') as f:
+            topology.load_weights_from_hdf5_group(f['model_weights'], model.layers)
 
 
 class Model(keras.models.Model):
@@ -212,17 +314,17 @@ class Model(keras.models.Model):
                       **data_arguments):
 
         if return_best_model:
-            rn = np.random.random()
-            checkpoint = ModelCheckpoint('/tmp/best_{0}.h5'.format(rn),
-                                         monitor=monitor,
-                                         verbose=verbose,
-                                         mode='min',
-                                         save_best_only=True,
-                                         save_weights_only=True)
+            best_weights = BestWeights(monitor=monitor, mode='min', verbose=verbose)
             if isinstance(callbacks, list):
-                callbacks.append(checkpoint)
+                callbacks.append(best_weights)
             else:
-                callbacks = [checkpoint]
+                callbacks = [best_weights]
+
+        # Sequences, e.g. on-disk shards, know their own number of batches
+        if isinstance(data_arguments.get('generator'), Sequence):
+            data_arguments.setdefault('steps_per_epoch', len(data_arguments['generator']))
+        if isinstance(data_arguments.get('validation_data'), Sequence):
+            data_arguments.setdefault('validation_steps', len(data_arguments['validation_data']))
 
         start_time = time.time()
         super(Model, self).fit_generator(verbose=verbose,
@@ -239,12 +341,6 @@ class Model(keras.models.Model):
                                                                           end_time - start_time))
         self.training_duration = end_time - start_time
 
-        if return_best_model:
-            try:
-                self.load_all_param_values('/tmp/best_{0}.h5'.format(rn))
-            except:
-                print('Unable to load best parameters, saving current model.')
-
         self.history_list.append(self.history)
 
     def fit(self, x=None, y=None, batch_size=32, epochs=1, initial_epoch=0, verbose=1, callbacks=None,
@@ -272,44 +368,209 @@ class Model(keras.models.Model):
                 validation_data = None
 
         if return_best_model:
-            rn = np.random.random()
-            checkpoint = ModelCheckpoint('/tmp/best_{0}.h5'.format(rn),
-                                         monitor=monitor,
-                                         verbose=verbose,
-                                         mode='min',
-                                         save_best_only=True,
-                                         save_weights_only=True)
+            best_weights = BestWeights(monitor=monitor, mode='min', verbose=verbose)
             if isinstance(callbacks, list):
-                callbacks.append(checkpoint)
+                callbacks.append(best_weights)
             else:
-                callbacks = [checkpoint]
+                callbacks = [best_weights]
 
         start_time = time.time()
-        super(Model, self).fit(x=x_train, y=y_train,
-                               batch_size=batch_size,
-                               epochs=epochs,
-                               initial_epoch=initial_epoch,
-                               verbose=verbose,
-                               callbacks=callbacks,
-                               validation_data=validation_data,
-                               shuffle=shuffle,
-                               **fit_kwargs)
+        if is_index_encoded(x_train) and len(K.int_shape(self.inputs[0])) == 3:
+            # Compact uint8 inputs are expanded to one-hot vectors one batch at a time
+            nb_aa = K.int_shape(self.inputs[0])[-1]
+            nb_categories = K.int_shape(self.outputs[0])[-1] if is_index_encoded(y_train) else None
+
+            unsupported = set(fit_kwargs) - {'class_weight', 'sample_weight'}
+            if unsupported:
+                raise ValueError('Arguments {} are not supported with index encoded inputs.'.format(
+                    ', '.join(sorted(unsupported))))
+
+            if validation_data and is_index_encoded(validation_data[0]):
+                validation_steps = int(np.ceil(len(validation_data[0]) / batch_size))
+                validation_weight = validation_data[2] if len(validation_data) == 3 else None
+                validation_data = hot_batch_generator(validation_data[0], validation_data[1], batch_size=batch_size,
+                                                      nb_aa=nb_aa, nb_categories=nb_categories, shuffle=False,
+                                                      sample_weight=validation_weight)
+            else:
+                validation_steps = None
+
+            super(Model, self).fit_generator(hot_batch_generator(x_train, y_train, batch_size=batch_size, nb_aa=nb_aa,
+                                                                 nb_categories=nb_categories, shuffle=shuffle,
+                                                                 sample_weight=fit_kwargs.get('sample_weight')),
+                                             steps_per_epoch=int(np.ceil(len(x_train) / batch_size)),
+                                             epochs=epochs,
+                                             initial_epoch=initial_epoch,
+                                             verbose=verbose,
+                                             callbacks=callbacks,
+                                             validation_data=validation_data,
+                                             validation_steps=validation_steps,
+                                             class_weight=fit_kwargs.get('class_weight'),
+                                             workers=1,
+                                             use_multiprocessing=False)
+        else:
+            super(Model, self).fit(x=x_train, y=y_train,
+                                   batch_size=batch_size,
+                                   epochs=epochs,
+                                   initial_epoch=initial_epoch,
+                                   verbose=verbose,
+                                   callbacks=callbacks,
+                                   validation_data=validation_data,
+                                   shuffle=shuffle,
+                                   **fit_kwargs)
         end_time = time.time()
         print('Model trained for {0} epochs. Total time: {1:.3f}s'.format(len(self.history.epoch),
                                                                           end_time - start_time))
         self.training_duration = end_time - start_time
-        if return_best_model:
-            try:
-                self.load_all_param_values('/tmp/best_{0}.h5'.format(rn))
-            except Exception as e:
-                print('Unable to load best parameters, saving current model.')
-                print(e)
-
         self.history_list.append(self.history)
 
         return x_valid, y_valid
 
-    # TODO: implement predict/evaluate generator
+    def _input_encoding(self):
+        """ Whether the model takes uint8 residue indices, and the size of its amino acid alphabet.
+        """
+        input_shape = K.int_shape(self.inputs[0])
+        if len(input_shape) == 2:
+            return True, next((layer.nb_aa for layer in self.layers if hasattr(layer, 'nb_aa')), 20)
+        return False, input_shape[-1]
+
+    def predict_bucketed(self, x, batch_size=32, max_aa=None):
+        """ Predicts sequences of any length in length-bucketed batches.
+
+        Args:
+            x (pd.Series or list): amino acid strings, or unpadded index or one-hot arrays.
+            batch_size (int): number of sequences per batch.
+            max_aa (int): length to clip sequences to.
+
+        Returns: The predictions in input order. Per-residue predictions are returned as a list of arrays,
+            each clipped to the length of its sequence.
+        """
+        x = list(x)
+        lengths = np.fromiter(map(len, x), dtype=np.int64, count=len(x))
+        if max_aa:
+            lengths = np.minimum(lengths, max_aa)
+
+        compact, nb_aa = self._input_encoding()
+
+        # Batches are encoded from the same excerpts their predictions are scattered back with
+        outputs = [None] * len(x)
+        for excerpt in bucket_batches(lengths, batch_size, shuffle=False):
+            x_batch = encode_batch([x[i] for i in excerpt], nb_aa, compact, max_aa)
+            out = self.predict_on_batch(x_batch)
+            for i, o in zip(excerpt, out):
+                outputs[i] = o[:lengths[i]] if out.ndim == 3 else o
+
+        if len(x) and outputs[0].ndim < 2:
+            return np.asarray(outputs)
+        return outputs
+
+    def _stream(self, x, y=None, batch_size=32, max_aa=None, window=10000, max_queue_size=10):
+        """ Batches any input source in the model's encoding, loading the next batches while the current one runs.
+        """
+        compact, nb_aa = self._input_encoding()
+        output_shape = K.int_shape(self.outputs[0])
+        pad_y_data = y is not None and len(output_shape) == 3
+        batches = stream_batches(x, y, batch_size=batch_size, nb_aa=nb_aa, compact=compact, max_aa=max_aa,
+                                 length=K.int_shape(self.inputs[0])[1], window=window, pad_y_data=pad_y_data,
+                                 nb_categories=output_shape[-1] if pad_y_data else None)
+        return prefetch(batches, max_queue_size)
+
+    def predict_stream(self, x, sink=None, batch_size=32, max_aa=None, window=10000, max_queue_size=10):
+        """ Predicts a dataset of any size in length-bucketed batches, streaming the predictions in input order.
+
+        Args:
+            x: amino acid strings, unpadded arrays, a RaggedStore or a padded (memory-mapped) array, which are
+                bucketed by length one window at a time. Or a keras Sequence or a generator of batches, which are
+                predicted in their own order.
+            sink (str or PredictionSink): .h5 or .npy file to write the predictions to. When None, the predictions
+                are returned like predict_bucketed does.
+            batch_size (int): number of sequences per batch.
+            max_aa (int): length to clip sequences to. Also the padded length of per-residue .npy predictions.
+            window (int): number of sequences bucketed together. Bounds the predictions held back for reordering.
+            max_queue_size (int): number of batches prepared ahead of the model.
+
+        Returns: The predictions, or the number of predictions written to the sink.
+        """
+        indexable = not isinstance(x, Sequence) and hasattr(x, '__getitem__') and hasattr(x, '__len__')
+        if isinstance(sink, str):
+            sink = PredictionSink(sink, nb_samples=len(x) if indexable else None,
+                                  max_len=max_aa or K.int_shape(self.inputs[0])[1])
+            close = True
+        else:
+            close = False
+
+        outputs, pending, next_idx = [], {}, 0
+
+        def emit(out):
+            if sink is None:
+                outputs.extend(out)
+            else:
+                sink.write(out)
+
+        try:
+            for excerpt, x_batch, _ in self._stream(x, batch_size=batch_size, max_aa=max_aa, window=window,
+                                                    max_queue_size=max_queue_size):
+                out = self.predict_on_batch(x_batch)
+                if out.ndim == 3:
+                    # Per-residue predictions are clipped to the length of their sequences
+                    if excerpt is None or isinstance(x, np.ndarray) and x.dtype != object and x.ndim > 1:
+                        lengths = [out.shape[1]] * len(out)
+                    elif hasattr(x, 'lengths'):
+                        lengths = np.minimum(x.lengths[excerpt], out.shape[1])
+                    else:
+                        lengths = [min(len(x[i]), out.shape[1]) for i in excerpt]
+                    out = [o[:length] for o, length in zip(out, lengths)]
+
+                if excerpt is None:
+                    emit(out)
+                    continue
+
+                # Batches are bucketed within a window, so predictions are held back until their turn
+                pending.update(zip(excerpt.tolist(), out))
+                ready = []
+                while next_idx in pending:
+                    ready.append(pending.pop(next_idx))
+                    next_idx += 1
+                if ready:
+                    emit(ready if isinstance(out, list) else np.stack(ready))
+        finally:
+            if close:
+                sink.close()
+
+        if sink is not None:
+            return sink.count
+        if len(outputs) and outputs[0].ndim < 2:
+            return np.asarray(outputs)
+        return outputs
+
+    def evaluate_stream(self, x, y=None, batch_size=32, max_aa=None, window=10000, max_queue_size=10):
+        """ Evaluates a dataset of any size in length-bucketed batches.
+
+        Args:
+            x: amino acid strings, unpadded arrays, a RaggedStore or a padded (memory-mapped) array. Or a keras
+                Sequence or a generator of (x, y) batches.
+            y: targets, indexable like x. Per-residue targets are padded like their sequences, and index labels are
+                expanded to one-hot vectors.
+            batch_size (int): number of sequences per batch.
+            max_aa (int): length to clip sequences to.
+            window (int): number of sequences bucketed together.
+            max_queue_size (int): number of batches prepared ahead of the model.
+
+        Returns: The loss, or the loss and metrics, averaged over all sequences.
+        """
+        totals, nb_samples = None, 0
+        for _, x_batch, y_batch in self._stream(x, y, batch_size=batch_size, max_aa=max_aa, window=window,
+                                                max_queue_size=max_queue_size):
+            if y_batch is None:
+                raise ValueError('evaluate_stream needs targets, either as y or in the batches of x.')
+            outs = self.test_on_batch(x_batch, y_batch)
+            outs = np.asarray(outs if isinstance(outs, list) else [outs], dtype=np.float64) * len(x_batch)
+            totals = outs if totals is None else totals + outs
+            nb_samples += len(x_batch)
+
+        if totals is None:
+            raise ValueError('evaluate_stream got no batches to evaluate.')
+        results = (totals / nb_samples).tolist()
+        return results[0] if len(results) == 1 else results
 
     def display_network_info(self, line_length=100):
         print_summary(self, line_length=line_length)
@@ -370,7 +631,7 @@ class Model(keras.models.Model):
         # self.set_all_param_values(new)
         raise NotImplementedError
 
-    def save(self, handle, data_dir=None, **save_args):
+    def save(self, handle, data_dir=None, mapped=False, **save_args):
 
         if isinstance(handle, Handle):
             handle.ftype = 'model'
@@ -386,7 +647,15 @@ class Model(keras.models.Model):
         if not os.path.exists('/'.join(filename.split('/')[:-1])):
             os.makedirs('/'.join(filename.split('/')[:-1]))
 
-        super(Model, self).save(filename, **save_args)
+        if mapped:
+            # Header and weight blob format, memory-mapped by load_model
+            unsupported = set(save_args) - {'include_optimizer'}
+            if unsupported:
+                raise ValueError('Arguments {} are not supported by the memory-mapped format.'.format(
+                    ', '.join(sorted(unsupported))))
+            save_mapped(self, filename, include_optimizer=save_args.get('include_optimizer', False))
+        else:
+            super(Model, self).save(filename, **save_args)
 
         print('Model saved to: ' + filename)
 
@@ -0,0 +1,404 @@
+# coding=utf-8
+"""
+    Local model server. Keeps models loaded and answers prediction requests over localhost HTTP or a Unix socket.
+    Concurrent requests are coalesced into padded micro-batches, each dispatched as soon as it is full or its oldest
+    request has waited max_latency seconds.
+
+        python -m evolutron.engine.serving embedder=models/embedder.model --port 8080 --max-latency 0.01
+
+        POST /models/<name>/predict   {"sequences": ["MKV...", ...]}  ->  {"predictions": [...]}
+        POST /models/<name>/reload    {"path": "models/embedder.model"}  (path optional)
+        GET  /models                  loaded models and their input and output shapes
+        GET  /metrics                 queue depth, batch sizes and latency percentiles of every model
+"""
+from __future__ import division, print_function
+
+import argparse
+import json
+import os
+import socketserver
+import stat
+import threading
+import time
+import warnings
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, Queue
+
+import keras.backend as K
+import numpy as np
+
+from ..extra_layers import custom_layers
+from ..tools.data_tools import stream_batches
+from .krs import load_model, load_weights
+
+
+class ServingMetrics(object):
+    """ Thread-safe counters and a sliding window of request latencies.
+    """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.reloads = 0
+
+    def record_batch(self, latencies, failed=False):
+        with self.lock:
+            self.requests += len(latencies)
+            self.batches += 1
+            self.errors += len(latencies) if failed else 0
+            self.latencies.extend(latencies)
+
+    def record_reload(self):
+        with self.lock:
+            self.reloads += 1
+
+    def snapshot(self):
+        with self.lock:
+            latencies = np.asarray(self.latencies) * 1000
+            stats = {'requests': self.requests, 'batches': self.batches, 'errors': self.errors,
+                     'reloads': self.reloads,
+                     'mean_batch_size': self.requests / self.batches if self.batches else 0.0}
+        for p in (50, 95, 99):
+            stats['latency_p{}_ms'.format(p)] = float(np.percentile(latencies, p)) if len(latencies) else 0.0
+        return stats
+
+
+class ModelWorker(threading.Thread):
+    """ Owns one loaded model and serves its request queue in micro-batches.
+
+    The model is loaded, run and reloaded in the worker thread only, so the backend graph is never shared across
+    threads mid-call.
+
+    Args:
+        name (str): name the model is served under.
+        filepath (str): model saved by Model.save.
+        custom_objects (dict): custom layers needed to deserialize the model. Defaults to the Evolutron layers.
+        max_batch_size (int): largest number of sequences per micro-batch.
+        max_latency (float): seconds the oldest queued request may wait for a micro-batch to fill.
+        max_aa (int): length to clip sequences to.
+        watch (float): poll the model file every watch seconds and reload its weights when it changes.
+    """
+
+    def __init__(self, name, filepath, custom_objects=None, max_batch_size=64, max_latency=0.01, max_aa=None,
+                 watch=None):
+        super(ModelWorker, self).__init__(name='evolutron-serving-' + name, daemon=True)
+        self.model_name = name
+        self.filepath = filepath
+        self.custom_objects = custom_layers if custom_objects is None else custom_objects
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.max_aa = max_aa
+        self.watch = watch
+
+        self.model = None
+        self.error = None
+        self.ready = threading.Event()
+        self.requests = Queue()
+        self.metrics = ServingMetrics()
+        self._lock = threading.Lock()
+        self._reload = None
+        self._mtime = None
+        self._running = True
+
+    @property
+    def queue_depth(self):
+        return self.requests.qsize()
+
+    def info(self):
+        output_shapes = [list(K.int_shape(output)) for output in self.model.outputs]
+        return {'path': self.filepath,
+                'input_shape': list(K.int_shape(self.model.inputs[0])),
+                'output_shape': output_shapes[0] if len(output_shapes) == 1 else output_shapes}
+
+    def submit(self, sequences):
+        """ Queues sequences for prediction. Returns one Future per sequence, whose result is an array, or a list of
+        arrays for models with several outputs.
+        """
+        if self.error is not None:
+            raise self.error
+        futures = []
+        for seq in sequences:
+            future = Future()
+            self.requests.put((seq, future, time.monotonic()))
+            futures.append(future)
+        return futures
+
+    def predict(self, sequences, timeout=None):
+        """ Predicts sequences, blocking until their micro-batches have run.
+        """
+        return [future.result(timeout) for future in self.submit(sequences)]
+
+    def reload(self, filepath=None):
+        """ Loads new weights into the model between two micro-batches. Returns a Future of the weight file used.
+        """
+        future = Future()
+        with self._lock:
+            self._reload = (filepath or self.filepath, future)
+        self.requests.put(None)
+        return future
+
+    def stop(self):
+        self._running = False
+        self.requests.put(None)
+
+    def run(self):
+        try:
+            self.model = load_model(self.filepath, self.custom_objects, compile=False)
+            self.model._make_predict_function()
+            self._mtime = os.path.getmtime(self.filepath)
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            self.ready.set()
+
+        while self._running:
+            batch = self._collect()
+            self._apply_reload()
+            if batch:
+                self._run_batch(batch)
+
+        # Fail whatever is still queued instead of leaving its callers waiting
+        error = RuntimeError('Model {} was stopped.'.format(self.model_name))
+        while True:
+            try:
+                item = self.requests.get_nowait()
+            except Empty:
+                break
+            if item is not None:
+                item[1].set_exception(error)
+
+    def _collect(self):
+        """ Waits for a request, then gathers more until the batch is full or the first one is due.
+        """
+        try:
+            first = self.requests.get(timeout=self.watch)
+        except Empty:
+            return []
+        if first is None:
+            return []
+
+        batch = [first]
+        deadline = first[2] + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait()
+            except Empty:
+                break
+            if item is None:
+                # A reload or stop arrived, serve what was gathered first
+                break
+            batch.append(item)
+        return batch
+
+    def _run_batch(self, batch):
+        seqs = [item[0] for item in batch]
+        compact, nb_aa = self.model._input_encoding()
+        failed = False
+        try:
+            for excerpt, x_batch, _ in stream_batches(seqs, batch_size=len(seqs), nb_aa=nb_aa, compact=compact,
+                                                      max_aa=self.max_aa, length=K.int_shape(self.model.inputs[0])[1],
+                                                      window=len(seqs)):
+                outs = self.model.predict_on_batch(x_batch)
+                single = not isinstance(outs, list)
+                outs = [outs] if single else outs
+                for k, i in enumerate(excerpt):
+                    # Per-residue outputs are cut to the length of their sequence
+                    result = [out[k, :len(seqs[i])] if out.ndim == 3 else out[k] for out in outs]
+                    batch[i][1].set_result(result[0] if single else result)
+        except Exception as e:
+            failed = True
+            for item in batch:
+                if not item[1].done():
+                    item[1].set_exception(e)
+
+        now = time.monotonic()
+        self.metrics.record_batch([now - item[2] for item in batch], failed)
+
+    def _apply_reload(self):
+        with self._lock:
+            pending, self._reload = self._reload, None
+        if pending is None and self.watch:
+            try:
+                if os.path.getmtime(self.filepath) != self._mtime:
+                    pending = (self.filepath, None)
+            except OSError:
+                pass
+        if pending is None:
+            return
+
+        filepath, future = pending
+        try:
+            mtime = os.path.getmtime(filepath)
+            load_weights(self.model, filepath)
+        except Exception as e:
+            if future is None:
+                # The watched file may still be being written, it is retried on the next poll
+                warnings.warn('Reloading {0} failed: {1}'.format(filepath, e))
+            else:
+                future.set_exception(e)
+            return
+
+        self.filepath, self._mtime = filepath, mtime
+        self.metrics.record_reload()
+        if future is not None:
+            future.set_result(filepath)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'EvolutronServing/1.0'
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super(_Handler, self).log_message(format, *args)
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+
+    def do_GET(self):
+        workers = self.server.workers
+        if self.path == '/models':
+            self._reply(200, {name: worker.info() for name, worker in workers.items()})
+        elif self.path == '/metrics':
+            self._reply(200, {name: dict(worker.metrics.snapshot(), queue_depth=worker.queue_depth)
+                              for name, worker in workers.items()})
+        else:
+            self._reply(404, {'error': 'Unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'models' or parts[2] not in ('predict', 'reload'):
+            return self._reply(404, {'error': 'Unknown path {}'.format(self.path)})
+        worker = self.server.workers.get(parts[1])
+        if worker is None:
+            return self._reply(404, {'error': 'Unknown model {}'.format(parts[1])})
+
+        try:
+            body = self._body()
+        except ValueError as e:
+            return self._reply(400, {'error': 'Invalid JSON: {}'.format(e)})
+
+        try:
+            if parts[2] == 'reload':
+                return self._reply(200, {'path': worker.reload(body.get('path')).result()})
+
+            sequences = body.get('sequences')
+            if not isinstance(sequences, list) or not all(isinstance(s, str) for s in sequences):
+                return self._reply(400, {'error': '"sequences" must be a list of amino acid strings.'})
+            predictions = worker.predict(sequences)
+        except Exception as e:
+            return self._reply(500, {'error': '{0}: {1}'.format(type(e).__name__, e)})
+        self._reply(200, {'predictions': [[o.tolist() for o in p] if isinstance(p, list) else p.tolist()
+                                          for p in predictions]})
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ModelServer(object):
+    """ Serves one or more models over localhost HTTP or a Unix socket.
+
+    Args:
+        models (dict): model names mapped to saved model files.
+        host (str): interface to listen on. Only bind beyond localhost behind a trusted proxy.
+        port (int): TCP port, 0 picks a free one.
+        socket_path (str): listen on this Unix socket instead of TCP.
+        verbose (bool): log every request.
+        **worker_args: max_batch_size, max_latency, max_aa, watch and custom_objects of the ModelWorkers.
+    """
+
+    def __init__(self, models, host='127.0.0.1', port=8080, socket_path=None, verbose=False, **worker_args):
+        self.workers = {name: ModelWorker(name, filepath, **worker_args) for name, filepath in models.items()}
+        self.socket_path = socket_path
+        if socket_path:
+            # Only a socket left over by an earlier server is replaced
+            if os.path.exists(socket_path):
+                if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                    raise IOError('{} exists and is not a socket.'.format(socket_path))
+                os.remove(socket_path)
+            self.httpd = _UnixHTTPServer(socket_path, _Handler)
+        else:
+            self.httpd = ThreadingHTTPServer((host, port), _Handler)
+            self.httpd.daemon_threads = True
+        self.httpd.workers = self.workers
+        self.httpd.verbose = verbose
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        """ Loads every model. Raises the first loading error.
+        """
+        for worker in self.workers.values():
+            worker.start()
+        for worker in self.workers.values():
+            worker.ready.wait()
+            if worker.error is not None:
+                self.shutdown()
+                raise worker.error
+
+    def serve_forever(self):
+        self.start()
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        for worker in self.workers.values():
+            worker.stop()
+        self.httpd.server_close()
+        if self.socket_path and os.path.exists(self.socket_path) and stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+            os.remove(self.socket_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve Evolutron models for prediction.')
+    parser.add_argument('models', nargs='+', metavar='NAME=PATH', help='models to serve and their saved files')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--socket', dest='socket_path', help='listen on a Unix socket instead of TCP')
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-latency', type=float, default=0.01, help='seconds a request may wait for a batch')
+    parser.add_argument('--max-aa', type=int, help='length to clip sequences to')
+    parser.add_argument('--watch', type=float, help='reload weights when the model files change, polled in seconds')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    models = {}
+    for spec in args.models:
+        name, sep, filepath = spec.partition('=')
+        if not sep:
+            parser.error('Models are given as NAME=PATH, got {}'.format(spec))
+        models[name] = filepath
+
+    server = ModelServer(models, host=args.host, port=args.port, socket_path=args.socket_path, verbose=args.verbose,
+                         max_batch_size=args.max_batch_size, max_latency=args.max_latency, max_aa=args.max_aa,
+                         watch=args.watch)
+    print('Serving {0} on {1}'.format(', '.join(models), args.socket_path or '{0}:{1}'.format(*server.address)))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
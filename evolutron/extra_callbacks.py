@@ -1,5 +1,9 @@
+import os
+import threading
+import warnings
 from typing import Generator
 
+import keras.backend as K
 import numpy as np
 from keras.callbacks import Callback
 from keras.utils import GeneratorEnqueuer
@@ -78,3 +82,83 @@ class AucCallback(Callback):
 
     def on_train_end(self, logs=None):
         self.auc_eval()
+
+
+class BestWeights(Callback):
+    """Keeps the weights of the best epoch in memory and restores them at the end of training.
+
+    The weights are copied into numpy buffers that are allocated once, when training begins, so an improvement
+    costs a device to host copy and no disk I/O. The best weights can also be spilled to disk, as an .npz of the
+    model weights in order, by a background thread.
+
+    # Arguments
+        monitor: quantity to monitor.
+        mode: one of {min, max}. Whether the best epoch minimizes or maximizes the monitored quantity.
+        restore: whether to set the best weights on the model when training ends.
+        spill_path: optional path of an .npz file that receives the best weights asynchronously.
+        verbose: verbosity mode, 0 or 1.
+    """
+
+    def __init__(self, monitor='val_loss', mode='min', restore=True, spill_path=None, verbose=0):
+        super(BestWeights, self).__init__()
+        if mode not in ('min', 'max'):
+            raise ValueError('Mode should be min or max.')
+        self.monitor = monitor
+        self.better = np.less if mode == 'min' else np.greater
+        self.initial = np.inf if mode == 'min' else -np.inf
+        self.restore = restore
+        self.spill_path = spill_path
+        self.verbose = verbose
+        self.best = self.initial
+        self.best_epoch = None
+        self.buffers = None
+        self._spill_buffers = None
+        self._spill_thread = None
+
+    def on_train_begin(self, logs=None):
+        self.best = self.initial
+        self.best_epoch = None
+        self.buffers = [np.empty(K.int_shape(w), dtype=K.dtype(w)) for w in self.model.weights]
+        if self.spill_path:
+            self._spill_buffers = [np.empty_like(b) for b in self.buffers]
+
+    def on_epoch_end(self, epoch, logs=None):
+        current = (logs or {}).get(self.monitor)
+        if current is None:
+            warnings.warn('Can keep the best weights only with {} available, skipping.'.format(self.monitor),
+                          RuntimeWarning)
+            return
+        if not self.better(current, self.best):
+            return
+
+        if self.verbose > 0:
+            print('\nEpoch {0:05d}: {1} improved from {2:.5f} to {3:.5f}, keeping weights'.format(
+                epoch + 1, self.monitor, self.best, current))
+        self.best = current
+        self.best_epoch = epoch
+        for buf, value in zip(self.buffers, K.batch_get_value(self.model.weights)):
+            np.copyto(buf, value)
+
+        if self.spill_path:
+            self._join_spill()
+            for spill, buf in zip(self._spill_buffers, self.buffers):
+                np.copyto(spill, buf)
+            self._spill_thread = threading.Thread(target=self._spill, daemon=True)
+            self._spill_thread.start()
+
+    def _spill(self):
+        tmp_path = self.spill_path + '.tmp.npz'
+        np.savez(tmp_path, *self._spill_buffers)
+        os.replace(tmp_path, self.spill_path)
+
+    def _join_spill(self):
+        if self._spill_thread is not None:
+            self._spill_thread.join()
+            self._spill_thread = None
+
+    def on_train_end(self, logs=None):
+        self._join_spill()
+        if self.restore and self.best_epoch is not None:
+            K.batch_set_value(list(zip(self.model.weights, self.buffers)))
+        elif self.restore:
+            print('Unable to restore the best weights, keeping the current ones.')
@@ -12,6 +12,8 @@ from keras.layers.recurrent import Recurrent
 import keras.layers as native
 from keras.layers.convolutional import _Conv, Conv3D, conv_utils
 
+from .tools.seq_tools import idx_hot_table
+
 
 class Convolution1D(native.Conv1D):
     def __init__(self, nb_filter, filter_length, **kwargs):
@@ -82,7 +84,7 @@ class Deconvolution1D(_Conv):
             self._bound_conv_layer = bound_conv_layer
             try:
                 filters = self._bound_conv_layer.input_shape[2]
-            except ValueError:
+            except (ValueError, IndexError):
                 filters = 'Not sure yet, input shape of convolutional layer not provided during construction.'
             kernel_size = self._bound_conv_layer.kernel_size
             padding = self._bound_conv_layer.padding
@@ -117,7 +119,7 @@ class Deconvolution1D(_Conv):
         input_dim = input_shape[channel_axis]
 
         if hasattr(self, '_bound_conv_layer'):
-            self.filters = self._bound_conv_layer.input_shape[2]
+            self.filters = K.int_shape(self._bound_conv_layer.kernel)[1]
             self.kernel = K.permute_dimensions(self._bound_conv_layer.kernel, (0, 2, 1))
         else:
             # This is a hack for loading through "model_from_json". It needs a fix.
@@ -220,6 +222,109 @@ class Dedense(native.Dense):
         self.built = True
 
 
+class IndexConvolution1D(native.Conv1D):
+    """1D convolution over uint8 residue indices instead of one-hot vectors.
+
+    Computes the same output as a `Conv1D` over the one-hot expansion of its input, but
+    gathers and sums the kernel rows of each residue instead of multiplying with mostly zero
+    vectors. The kernel and bias have the same shapes and names as those of a `Conv1D` with
+    `nb_aa` input channels, so weights of a trained first layer can be loaded unchanged.
+    Index 0 is treated as padding and masked out.
+
+    # Arguments
+        filters: Integer, the number of output filters.
+        kernel_size: An integer, the length of the convolution window.
+        nb_aa: Integer, the size of the amino acid alphabet (20 or 22).
+        **kwargs: any other `Conv1D` argument. Only `strides=1` is supported.
+
+    # Input shape
+        2D integer tensor with shape: `(batch_size, steps)`
+
+    # Output shape
+        3D tensor with shape: `(batch_size, new_steps, filters)`
+    """
+
+    def __init__(self, filters, kernel_size, nb_aa=20, **kwargs):
+        self.nb_aa = nb_aa
+        super(IndexConvolution1D, self).__init__(filters, kernel_size, **kwargs)
+        if self.strides[0] != 1:
+            raise ValueError('IndexConvolution1D only supports strides=1.')
+        self.supports_masking = True
+        self.input_spec = InputSpec(ndim=2)
+
+    def build(self, input_shape):
+        super(IndexConvolution1D, self).build(tuple(input_shape) + (self.nb_aa,))
+        self.input_spec = InputSpec(ndim=2)
+
+    def call(self, inputs):
+        # Contribution of every residue index to every tap of the kernel: (kernel_size, nb_indices, filters)
+        taps = tf.einsum('ia,kaf->kif', K.constant(idx_hot_table(self.nb_aa)), self.kernel)
+
+        span = self.dilation_rate[0] * (self.kernel_size[0] - 1)
+        if self.padding == 'same':
+            pad = (span // 2, span - span // 2)
+        elif self.padding == 'causal':
+            pad = (span, 0)
+        else:
+            pad = (0, 0)
+        indices = tf.pad(K.cast(inputs, 'int32'), [[0, 0], list(pad)])
+        steps = tf.shape(indices)[1] - span
+
+        outputs = 0
+        for k in range(self.kernel_size[0]):
+            start = k * self.dilation_rate[0]
+            outputs += tf.gather(taps[k], indices[:, start:start + steps])
+
+        if self.use_bias:
+            outputs = K.bias_add(outputs, self.bias)
+        if self.activation is not None:
+            outputs = self.activation(outputs)
+        return outputs
+
+    def compute_output_shape(self, input_shape):
+        return super(IndexConvolution1D, self).compute_output_shape(tuple(input_shape) + (self.nb_aa,))
+
+    def compute_mask(self, inputs, mask=None):
+        if self.padding != 'same':
+            return None
+        return K.not_equal(inputs, 0)
+
+    def get_config(self):
+        config = {'nb_aa': self.nb_aa}
+        base_config = super(IndexConvolution1D, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+class SegmentMasking(Layer):
+    """Zeroes the positions of packed rows that belong to no segment (padding and gaps between segments).
+
+    Applied after each convolution of a model trained on packed rows, it keeps every layer seeing
+    zeros around each segment, just like at the borders of an unpacked sequence, as long as the
+    packing gap is at least half the (dilated) kernel size. The output is masked with the segments.
+
+    # Input
+        List of a 3D tensor `(batch_size, steps, channels)` and its
+        segment ids `(batch_size, steps)`, where 0 marks positions outside any segment.
+
+    # Output shape
+        Same as the first input.
+    """
+
+    def __init__(self, **kwargs):
+        super(SegmentMasking, self).__init__(**kwargs)
+        self.supports_masking = True
+
+    def call(self, inputs, mask=None):
+        x, segment_ids = inputs
+        return x * K.expand_dims(K.cast(K.not_equal(segment_ids, 0), K.dtype(x)))
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[0]
+
+    def compute_mask(self, inputs, mask=None):
+        return K.not_equal(inputs[1], 0)
+
+
 class FeedForwardLSTM(Recurrent):
     """Long-Short Term Memory unit - Hochreiter 1997.
 
@@ -1044,11 +1149,13 @@ class BilinearUpSampling2D(Layer):
 
 custom_layers = {
     'Convolution1D': Convolution1D,
+    'IndexConvolution1D': IndexConvolution1D,
     'Deconvolution1D': Deconvolution1D,
     'Convolution2D': Convolution2D,
     'MaxPooling1D': MaxPooling1D,
     'Upsampling1D': Upsampling1D,
     'Dedense': Dedense,
+    'SegmentMasking': SegmentMasking,
     'Reshape': Reshape,
     'Flatten': Flatten,
     'LocallyConnected1D': LocallyConnected1D,
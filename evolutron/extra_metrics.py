@@ -2,9 +2,23 @@
 import keras.backend as K
 import sklearn.metrics as metrics
 
+from .extra_objectives import residue_mask
+
 Beta = 1
 
 
+def class_indicators(y_true, y_pred, category):
+    """Returns the predicted and true indicators of a category, zeroed on padding and packing gaps.
+
+    Positions with an all-zero target are excluded for packed and unpacked data alike, so padding of unpacked
+    batches no longer counts as class 0 in the precision, recall and F metrics.
+    """
+    is_real = residue_mask(y_true)
+    pred_is = K.cast(K.equal(K.argmax(y_pred, -1), category), K.floatx()) * is_real
+    true_is = K.cast(K.equal(K.argmax(y_true, -1), category), K.floatx()) * is_real
+    return pred_is, true_is
+
+
 def mean_cat_acc(y_true, y_pred):
     nb_categories = K.shape(y_true)[-1]
     y_true = K.reshape(y_true, shape=(-1, nb_categories))
@@ -24,17 +38,13 @@ def multiclass_acc(y_true, y_pred):
 
 def multiclass_precision(y_true, y_pred):
     """This metric return a precision score for each class"""
-    nb_categories = K.shape(y_true)[-1]
     precision_dict = {}
 
-    pred_max = K.argmax(y_pred, -1)
-    true_max = K.argmax(y_true, -1)
-
     for i in range(8):
-        ten = i * K.equal(pred_max, pred_max)
+        pred_is, true_is = class_indicators(y_true, y_pred, i)
 
-        true_positives = K.sum(K.equal(pred_max, ten) * K.equal(true_max, ten))
-        predicted_positives = K.sum(K.equal(pred_max, ten))
+        true_positives = K.sum(pred_is * true_is)
+        predicted_positives = K.sum(pred_is)
         precision_dict['p_%d' % i] = true_positives / (predicted_positives + K.epsilon())
 
     return precision_dict
@@ -57,31 +67,24 @@ def micro_precision(y_true, y_pred):
     true_positives = 0
     predicted_positives = 0
 
-    pred_max = K.argmax(y_pred, -1)
-    true_max = K.argmax(y_true, -1)
-
     for i in range(8):
-        ten = i * K.equal(pred_max, pred_max)
+        pred_is, true_is = class_indicators(y_true, y_pred, i)
 
-        true_positives += K.sum(K.equal(pred_max, ten) * K.equal(true_max, ten))
-        predicted_positives += K.sum(K.equal(pred_max, ten))
+        true_positives += K.sum(pred_is * true_is)
+        predicted_positives += K.sum(pred_is)
 
     return true_positives / (predicted_positives + K.epsilon())
 
 
 def multiclass_recall(y_true, y_pred):
     """This metric return a recall score for each class"""
-    nb_categories = K.shape(y_true)[-1]
     recall_dict = {}
 
-    pred_max = K.argmax(y_pred, -1)
-    true_max = K.argmax(y_true, -1)
-
     for i in range(8):
-        ten = i * K.equal(pred_max, pred_max)
+        pred_is, true_is = class_indicators(y_true, y_pred, i)
 
-        true_positives = K.sum(K.equal(pred_max, ten) * K.equal(true_max, ten))
-        true_elements = K.sum(K.equal(true_max, ten))
+        true_positives = K.sum(pred_is * true_is)
+        true_elements = K.sum(true_is)
         recall_dict['r_%d' % i] = true_positives / (true_elements + K.epsilon())
 
     return recall_dict
@@ -104,14 +107,11 @@ def micro_recall(y_true, y_pred):
     true_positives = 0
     true_elements = 0
 
-    pred_max = K.argmax(y_pred, -1)
-    true_max = K.argmax(y_true, -1)
-
     for i in range(8):
-        ten = i * K.equal(pred_max, pred_max)
+        pred_is, true_is = class_indicators(y_true, y_pred, i)
 
-        true_positives += K.sum(K.equal(pred_max, ten) * K.equal(true_max, ten))
-        true_elements += K.sum(K.equal(true_max, ten))
+        true_positives += K.sum(pred_is * true_is)
+        true_elements += K.sum(true_is)
     return true_positives / (true_elements + K.epsilon())
 
 
@@ -119,15 +119,12 @@ def multiclass_fmeasure(y_true, y_pred):
     """This metric return a F-score for each class"""
     fmeasure_dict = {}
 
-    pred_max = K.argmax(y_pred, -1)
-    true_max = K.argmax(y_true, -1)
-
     for i in range(8):
-        ten = i * K.equal(pred_max, pred_max)
+        pred_is, true_is = class_indicators(y_true, y_pred, i)
 
-        true_positives = K.sum(K.equal(pred_max, ten) * K.equal(true_max, ten))
-        predicted_positives = K.sum(K.equal(pred_max, ten))
-        true_elements = K.sum(K.equal(true_max, ten))
+        true_positives = K.sum(pred_is * true_is)
+        predicted_positives = K.sum(pred_is)
+        true_elements = K.sum(true_is)
 
         fmeasure_dict['f_%d' % i] = ((Beta ** 2 + 1) * true_positives) / (
             Beta ** 2 * true_elements + predicted_positives)
@@ -1,10 +1,22 @@
 # coding=utf-8
 import keras.backend as K
-from keras.objectives import mean_squared_error
+from keras.objectives import categorical_crossentropy, mean_squared_error
 
 Beta = 1
 
 
+def residue_mask(y_true):
+    """Returns 1 for residues that carry a target and 0 for padding, including the gaps between packed segments"""
+    return K.cast(K.any(K.not_equal(y_true, 0), axis=-1), K.floatx())
+
+
+def masked_categorical_crossentropy(y_true, y_pred):
+    """Per-residue categorical crossentropy, averaged over the real residues of each row only"""
+    is_real = residue_mask(y_true)
+    loss = categorical_crossentropy(y_true, y_pred) * is_real
+    return K.sum(loss, axis=-1) / K.maximum(K.sum(is_real, axis=-1), 1)
+
+
 def masked_mse(inp, decoded, mask_value=0.0):
     boolean_mask = K.any(K.not_equal(inp, mask_value), axis=-1, keepdims=True)
     decoded = decoded * K.cast(boolean_mask, K.floatx())
@@ -47,12 +59,13 @@ def multiclass_loss_precision(y_true, y_pred):
 
     y_true = K.reshape(y_true, shape=(-1, nb_categories))
     y_pred = K.reshape(y_pred, shape=(-1, nb_categories))
+    is_real = residue_mask(y_true)
 
     for i in range(nb_categories):
         true_positives = 0
         predicted_positives = 0
 
-        pp = pred_pos_approx(y_pred, i)
+        pp = pred_pos_approx(y_pred, i) * is_real
         true_positives += K.sum(y_true[:, i] * pp)
         predicted_positives += K.sum(pp)
 
@@ -10,6 +10,7 @@ import weblogolib as wl
 from corebio.seq_io import SeqList
 
 from evolutron.tools import data_it, hot2aa
+from evolutron.tools.shard_tools import ShardedArray, ShardSequence
 
 
 def make_pfm(layer_weights):
@@ -49,6 +50,13 @@ def motif_extraction(motif_fun, x_data, filters, kernel_size, output_foldername,
         shutil.rmtree(foldername)
         os.makedirs(foldername)
 
+    # Sharded datasets are read through their one-hot input view, compact shards are expanded on access
+    if isinstance(x_data, ShardSequence):
+        inputs = x_data.inputs
+        if x_data.meta['compact'] and not inputs.nb_aa:
+            inputs = ShardedArray(inputs.shards, x_data.meta['nb_aa'])
+        x_data = inputs
+
     # Filter visual field
     vf = kernel_size + depth * (kernel_size - 1)
 
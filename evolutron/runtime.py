@@ -0,0 +1,359 @@
+# coding=utf-8
+"""
+    NumPy-only inference for models exported with evolutron.engine.export_model. Imports neither Keras nor
+    TensorFlow, so batch workers start in milliseconds.
+
+    Exported files hold a JSON header followed by one weight blob, every array aligned to 64 bytes so that
+    loading is a memory map and each weight a view into it:
+
+        magic (8 bytes) | header size (uint64) | JSON header | padding | weight blob
+"""
+from __future__ import division
+
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'EVOLWGT1'
+ALIGNMENT = 64
+# Largest im2col block, in elements, before a batch is split
+IM2COL_BLOCK = 1 << 22
+
+
+def _align(n, alignment=ALIGNMENT):
+    return -(-n // alignment) * alignment
+
+
+def write_weight_file(filename, header, arrays):
+    """ Writes a JSON header and arrays to a weight file. The file is moved into place only once complete.
+
+    Args:
+        filename (str): path of the weight file.
+        header (dict): JSON-serializable header. Its 'arrays' key is reserved for the array layout.
+        arrays (dict): arrays by name, written in the order given.
+    """
+    layout, offset = {}, 0
+    for name, value in arrays.items():
+        value = np.asarray(value)
+        layout[name] = {'offset': offset, 'shape': list(value.shape), 'dtype': value.dtype.str}
+        offset = _align(offset + value.nbytes)
+
+    header = dict(header, arrays=layout)
+    data = json.dumps(header).encode('utf-8')
+    blob_start = _align(len(MAGIC) + 8 + len(data))
+
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(data)) + data)
+        for name, value in arrays.items():
+            f.seek(blob_start + layout[name]['offset'])
+            f.write(np.ascontiguousarray(value).tobytes())
+        f.truncate(blob_start + offset)
+    os.replace(tmp_file, filename)
+
+
+def is_weight_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_weight_file(filename):
+    """ Memory-maps a weight file.
+
+    Returns: The header and a dict of read-only array views into the file.
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not an Evolutron weight file.'.format(filename))
+        size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(size).decode('utf-8'))
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    blob_start = _align(len(MAGIC) + 8 + size)
+    arrays = {}
+    for name, spec in header.pop('arrays').items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        arrays[name] = np.frombuffer(buf, dtype=dtype, count=count,
+                                     offset=blob_start + spec['offset']).reshape(spec['shape'])
+    return header, arrays
+
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+    None: lambda x: x,
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+    'hard_sigmoid': lambda x: np.clip(.2 * x + .5, 0, 1),
+    'tanh': np.tanh,
+    'softmax': _softmax,
+    'softplus': lambda x: np.logaddexp(x, 0),
+    'softsign': lambda x: x / (1 + np.abs(x)),
+    'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    'selu': lambda x: 1.0507009873554805 * np.where(x > 0, x, 1.6732632423543772 * np.expm1(np.minimum(x, 0))),
+}
+
+
+def _pad_1d(x, padding, span, strides=1, value=0):
+    """ Pads the steps of x like the TensorFlow padding modes, for a window covering span + 1 steps.
+    """
+    steps = x.shape[1]
+    if padding == 'same':
+        total = max((-(-steps // strides) - 1) * strides + span + 1 - steps, 0)
+        pad = (total // 2, total - total // 2)
+    elif padding == 'causal':
+        pad = (span, 0)
+    else:
+        pad = (0, 0)
+    if not any(pad):
+        return x
+    widths = [(0, 0)] * x.ndim
+    widths[1] = pad
+    return np.pad(x, widths, mode='constant', constant_values=value)
+
+
+def _windows(x, size, strides=1, dilation=1):
+    """ Strided (N, L_out, size, C) view of the sliding windows over the steps of a (N, L, C) array.
+    """
+    x = np.ascontiguousarray(x)
+    nb_steps = (x.shape[1] - dilation * (size - 1) - 1) // strides + 1
+    s_n, s_l, s_c = x.strides
+    return np.lib.stride_tricks.as_strided(x, shape=(x.shape[0], max(nb_steps, 0), size, x.shape[2]),
+                                           strides=(s_n, strides * s_l, dilation * s_l, s_c), writeable=False)
+
+
+def conv1d(x, kernel, bias=None, strides=1, padding='valid', dilation=1):
+    """ 1D convolution of (N, L, C) inputs with a (K, C, F) kernel, as one matrix product over the im2col
+    matrix of the windows. Large batches are split so the im2col matrix stays bounded.
+    """
+    size = kernel.shape[0]
+    x = _pad_1d(x, padding, dilation * (size - 1), strides)
+    windows = _windows(x, size, strides, dilation)
+    n, nb_steps = windows.shape[:2]
+    weights = kernel.reshape(-1, kernel.shape[-1])
+
+    out = np.empty((n, nb_steps, kernel.shape[-1]), dtype=np.result_type(x, kernel))
+    rows = max(1, IM2COL_BLOCK // max(1, nb_steps * weights.shape[0]))
+    for start in range(0, n, rows):
+        cols = windows[start:start + rows].reshape(-1, weights.shape[0])
+        np.dot(cols, weights, out=out[start:start + rows].reshape(-1, weights.shape[1]))
+    if bias is not None:
+        out += bias
+    return out
+
+
+def index_conv1d(indices, taps, bias=None, padding='valid', dilation=1):
+    """ 1D convolution of (N, L) residue indices, summing the rows of taps, the (K, nb_indices, F) contribution of
+    every index to every position of the kernel.
+    """
+    size = taps.shape[0]
+    span = dilation * (size - 1)
+    indices = _pad_1d(indices.astype(np.intp), padding, span)
+    steps = indices.shape[1] - span
+    out = np.zeros((indices.shape[0], max(steps, 0), taps.shape[-1]), dtype=taps.dtype)
+    for k in range(size):
+        out += taps[k][indices[:, k * dilation:k * dilation + steps]]
+    if bias is not None:
+        out += bias
+    return out
+
+
+def max_pool1d(x, pool_size, strides, padding='valid'):
+    x = _pad_1d(x, padding, pool_size - 1, strides, value=-np.inf)
+    return _windows(x, pool_size, strides).max(axis=2)
+
+
+def locally_connected1d(x, kernel, bias=None, strides=1):
+    """ Unshared 1D convolution with a (L_out, K * C, F) kernel.
+    """
+    size = kernel.shape[1] // x.shape[2]
+    windows = _windows(x, size, strides)
+    out = np.einsum('nlj,ljf->nlf', windows.reshape(windows.shape[:2] + (-1,)), kernel)
+    if bias is not None:
+        out += bias
+    return out
+
+
+def _combine_masks(masks):
+    masks = [m for m in masks if m is not None]
+    if not masks:
+        return None
+    return np.logical_and.reduce(masks) if len(masks) > 1 else masks[0]
+
+
+class NumpyModel(object):
+    """ Runs exported models with NumPy. Weights are memory-mapped from the exported file.
+
+    Args:
+        filename (str): file written by export_model.
+    """
+
+    def __init__(self, filename):
+        header, self.arrays = read_weight_file(filename)
+        if header.get('format') != 'runtime':
+            raise ValueError('{} was not written by export_model.'.format(filename))
+        self.name = header.get('name')
+        self.layers = header['layers']
+        self.input_names = header['inputs']
+        self.output_names = header['outputs']
+        self.input_shapes = [tuple(shape) for shape in header['input_shapes']]
+        self.compact = header['compact']
+        self.nb_aa = header['nb_aa']
+
+    def _weight(self, layer, name):
+        key = layer.get('weights', {}).get(name)
+        return None if key is None else self.arrays[key]
+
+    def _call(self, layer, inputs, masks):
+        kind, config = layer['type'], layer.get('config', {})
+        x, mask = inputs[0], _combine_masks(masks)
+
+        if kind == 'conv1d':
+            out = conv1d(x, self._weight(layer, 'kernel'), self._weight(layer, 'bias'), config['strides'],
+                         config['padding'], config['dilation_rate'])
+        elif kind == 'index_conv1d':
+            out = index_conv1d(x, self._weight(layer, 'taps'), self._weight(layer, 'bias'), config['padding'],
+                               config['dilation_rate'])
+            mask = x != 0 if config['padding'] == 'same' else None
+        elif kind == 'locally_connected1d':
+            out = locally_connected1d(x, self._weight(layer, 'kernel'), self._weight(layer, 'bias'),
+                                      config['strides'])
+        elif kind == 'max_pool1d':
+            out = max_pool1d(x, config['pool_size'], config['strides'], config['padding'])
+        elif kind == 'dense':
+            out = np.dot(x, self._weight(layer, 'kernel'))
+            if self._weight(layer, 'bias') is not None:
+                out += self._weight(layer, 'bias')
+        elif kind == 'flatten':
+            out = x.reshape(len(x), -1)
+        elif kind == 'reshape':
+            out = x.reshape((len(x),) + tuple(config['target_shape']))
+        elif kind == 'upsampling1d':
+            out = np.repeat(x, config['size'], axis=1)
+        elif kind == 'masking':
+            mask = np.any(x != config['mask_value'], axis=-1)
+            out = x * mask[..., None]
+        elif kind == 'segment_masking':
+            mask = inputs[1] != 0
+            out = x * mask[..., None]
+        elif kind == 'batch_normalization':
+            scale = 1 / np.sqrt(self._weight(layer, 'moving_variance') + config['epsilon'])
+            if self._weight(layer, 'gamma') is not None:
+                scale = scale * self._weight(layer, 'gamma')
+            out = (x - self._weight(layer, 'moving_mean')) * scale
+            if self._weight(layer, 'beta') is not None:
+                out += self._weight(layer, 'beta')
+        elif kind == 'concatenate':
+            out = np.concatenate(inputs, axis=config['axis'])
+        elif kind == 'add':
+            out = np.sum(inputs, axis=0)
+        elif kind == 'multiply':
+            out = np.prod(inputs, axis=0)
+        elif kind == 'average':
+            out = np.mean(inputs, axis=0)
+        elif kind == 'maximum':
+            out = np.max(inputs, axis=0)
+        elif kind == 'global_max_pool1d':
+            out, mask = x.max(axis=1), None
+        elif kind == 'global_average_pool1d':
+            out, mask = x.mean(axis=1), None
+        elif kind in ('identity', 'activation'):
+            out = x
+        else:
+            raise ValueError('Unsupported layer type {}'.format(kind))
+
+        out = ACTIVATIONS[config.get('activation')](out)
+        if config.get('apply_mask') and mask is not None and mask.shape == out.shape[:2]:
+            # Deconvolution1D masks its activated outputs
+            out = out * mask[..., None]
+        return out, mask
+
+    def predict_on_batch(self, x):
+        """ Runs one batch through the model.
+
+        Args:
+            x (np.ndarray or list): the model input, or a list of them for models with several inputs.
+
+        Returns: The model output, or a list of them for models with several outputs.
+        """
+        x = x if isinstance(x, (list, tuple)) else [x]
+        if len(x) != len(self.input_names):
+            raise ValueError('Model expects {0} inputs, got {1}.'.format(len(self.input_names), len(x)))
+
+        values = {}
+        for name, value in zip(self.input_names, x):
+            value = np.asarray(value)
+            values[name] = (value if value.dtype.kind in 'iub' else value.astype(np.float32, copy=False), None)
+
+        for layer in self.layers:
+            if layer['type'] == 'input':
+                continue
+            inputs, masks = zip(*[values[name] for name in layer['inbound']])
+            values[layer['name']] = self._call(layer, list(inputs), list(masks))
+
+        outputs = [values[name][0] for name in self.output_names]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def encode(self, seqs, max_len=None):
+        """ Encodes amino acid strings as a padded batch in the model's input encoding.
+        """
+        length = self.input_shapes[0][1] or max_len
+        lengths = [len(s) for s in seqs]
+        width = length or max(lengths)
+        batch = np.zeros((len(seqs), width), dtype=np.uint8)
+        table = self.arrays['index_table']
+        for row, seq in zip(batch, seqs):
+            codes = table[np.frombuffer(seq[:width].encode('ascii', errors='replace'), dtype=np.uint8)]
+            row[:len(codes)] = codes
+        if self.compact:
+            return batch
+        return self.arrays['hot_table'][batch]
+
+    def predict(self, x, batch_size=32, max_aa=None):
+        """ Predicts a dataset in batches.
+
+        Args:
+            x: amino acid strings, which are encoded and predicted in length-sorted batches, or model inputs.
+            batch_size (int): number of samples per batch.
+            max_aa (int): length to clip sequences to.
+
+        Returns: The predictions in input order. Per-residue predictions of strings are returned as a list of
+            arrays, each clipped to the length of its sequence.
+        """
+        if len(x) and isinstance(x[0], str):
+            seqs = list(x)
+            lengths = np.array([min(len(s), max_aa) if max_aa else len(s) for s in seqs], dtype=np.int64)
+            order = np.argsort(lengths, kind='stable')
+            outputs = [[None] * len(seqs) for _ in self.output_names]
+            for start in range(0, len(seqs), batch_size):
+                excerpt = order[start:start + batch_size]
+                outs = self.predict_on_batch(self.encode([seqs[i] for i in excerpt], max_aa))
+                for results, out in zip(outputs, outs if isinstance(outs, list) else [outs]):
+                    for i, o in zip(excerpt, out):
+                        results[i] = o[:lengths[i]] if out.ndim == 3 else o
+            outputs = [np.asarray(results) if len(results) and results[0].ndim < 2 else results
+                       for results in outputs]
+            return outputs[0] if len(outputs) == 1 else outputs
+
+        multi = isinstance(x, (list, tuple))
+        size = len(x[0]) if multi else len(x)
+        outputs = [self.predict_on_batch([v[start:start + batch_size] for v in x] if multi
+                                         else x[start:start + batch_size])
+                   for start in range(0, size, batch_size)]
+        if outputs and isinstance(outputs[0], list):
+            return [np.concatenate(out) for out in zip(*outputs)]
+        return np.concatenate(outputs)
+
+
+def load_runtime(filename):
+    """ Loads an exported model for NumPy inference.
+    """
+    return NumpyModel(filename)
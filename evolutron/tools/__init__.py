@@ -3,6 +3,7 @@
     Define the tools top level
 """
 from .data_tools import data_it, load_dataset, pad_or_clip_seq, pad_or_clip_img, preprocess_dataset, load_random_aa_seqs, train_valid_split
-from .seq_tools import aa2hot, aa_map, aa_map_rev, hot2aa, nt2prob, nt_map, prob2nt
+from .seq_tools import (aa2hot, aa2hot_batch, aa2idx, aa2idx_batch, aa_map, aa_map_rev, hot2aa, hot2aa_batch, hot2idx,
+                        idx2hot, labels2hot, nt2prob, nt2prob_batch, nt_map, prob2nt, prob2nt_batch)
 from .structure_tools import *
 from .utils import Handle, get_args, nested_to_categorical, nested_unique, none2str, probability, shape
@@ -0,0 +1,294 @@
+# coding=utf-8
+"""
+    Parse cache for datasets. Parsed results are stored column by column as .npy files under a cache directory,
+    keyed by the source file and the parser options, and least recently used entries are evicted when the cache
+    grows past its size limit.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = os.environ.get('EVOLUTRON_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'evolutron'))
+CACHE_MAX_BYTES = int(os.environ.get('EVOLUTRON_CACHE_MAX_BYTES', 20 * 2 ** 30))
+MANIFEST = 'manifest.json'
+# Version of the column storage format, part of every key
+FORMAT_VERSION = 1
+# Temporary entries older than this are left over from crashed builds
+STALE_TMP_SECONDS = 24 * 3600
+
+
+class Uncacheable(TypeError):
+    pass
+
+
+def file_digest(filename, chunk_size=1 << 20):
+    """ SHA-1 of the contents of a file, read in chunks.
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(filename, parser, options=None, content_hash=False, version=0):
+    """ Builds the cache key of parsing a file with a parser and its options.
+
+    Args:
+        filename (str): path of the source file.
+        parser (str): name of the parser.
+        options (dict): parser options. Values must have a stable repr.
+        content_hash (bool): identify the source by its contents instead of its path, mtime and size.
+        version (int): version of the parser output. Bumping it invalidates the entries of older versions.
+
+    Returns: The hex digest of the key.
+    """
+    if content_hash:
+        source = {'sha1': file_digest(filename)}
+    else:
+        stat = os.stat(filename)
+        source = {'path': os.path.abspath(filename), 'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+    key = json.dumps({'source': source, 'parser': parser, 'version': version, 'format': FORMAT_VERSION,
+                      'options': options or {}}, sort_keys=True, default=repr)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _save_strings(values, dirname, name):
+    buffers = [str(v).encode('utf-8') for v in values]
+    offsets = np.zeros(len(buffers) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in buffers], out=offsets[1:])
+    np.save(os.path.join(dirname, name + '.offsets.npy'), offsets)
+    np.save(os.path.join(dirname, name + '.npy'), np.frombuffer(b''.join(buffers), dtype=np.uint8))
+
+
+def _load_strings(dirname, name):
+    offsets = np.load(os.path.join(dirname, name + '.offsets.npy')).tolist()
+    buf = np.load(os.path.join(dirname, name + '.npy')).tobytes()
+    return [buf[a:b].decode('utf-8') for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def _is_strings(values):
+    return all(isinstance(v, str) for v in values)
+
+
+def _save_value(value, dirname, name):
+    """ Saves a parser output column by column. Returns its manifest node.
+    """
+    if value is None:
+        return {'type': 'none'}
+
+    if isinstance(value, pd.Series):
+        index = np.asarray(value.index)
+        if index.dtype == object:
+            raise Uncacheable('Series with a non-numeric index')
+        np.save(os.path.join(dirname, name + '.index.npy'), index)
+        node = {'type': 'series', 'name': value.name, 'data': _save_value(value.tolist(), dirname, name)}
+        return node
+
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        np.save(os.path.join(dirname, name + '.npy'), value)
+        return {'type': 'array'}
+
+    if isinstance(value, (list, tuple, np.ndarray)):
+        value = list(value)
+        if value and all(isinstance(v, np.ndarray) and v.dtype != object for v in value):
+            if len({(v.shape[1:], v.dtype) for v in value}) == 1:
+                # Ragged arrays become one array and the offsets of its parts
+                offsets = np.zeros(len(value) + 1, dtype=np.int64)
+                np.cumsum([len(v) for v in value], out=offsets[1:])
+                np.save(os.path.join(dirname, name + '.offsets.npy'), offsets)
+                np.save(os.path.join(dirname, name + '.npy'), np.concatenate(value))
+                return {'type': 'ragged'}
+        elif value and _is_strings(value):
+            _save_strings(value, dirname, name)
+            return {'type': 'strings'}
+        elif all(isinstance(v, (bool, int, float, np.number)) for v in value):
+            np.save(os.path.join(dirname, name + '.npy'), np.asarray(value))
+            return {'type': 'list'}
+        return {'type': 'nested', 'tuple': isinstance(value, tuple),
+                'items': [_save_value(v, dirname, '{0}.{1}'.format(name, i)) for i, v in enumerate(value)]}
+
+    raise Uncacheable('Cannot cache values of type {}'.format(type(value).__name__))
+
+
+def _load_value(node, dirname, name):
+    kind = node['type']
+    if kind == 'none':
+        return None
+    if kind == 'series':
+        index = np.load(os.path.join(dirname, name + '.index.npy'))
+        return pd.Series(_load_value(node['data'], dirname, name), index=index, name=node['name'])
+    if kind == 'array':
+        return np.load(os.path.join(dirname, name + '.npy'))
+    if kind == 'list':
+        return np.load(os.path.join(dirname, name + '.npy')).tolist()
+    if kind == 'strings':
+        return _load_strings(dirname, name)
+    if kind == 'ragged':
+        offsets = np.load(os.path.join(dirname, name + '.offsets.npy'))
+        return np.split(np.load(os.path.join(dirname, name + '.npy')), offsets[1:-1])
+    items = [_load_value(item, dirname, '{0}.{1}'.format(name, i)) for i, item in enumerate(node['items'])]
+    return tuple(items) if node['tuple'] else items
+
+
+def _entry(key, cache_dir):
+    return os.path.join(cache_dir or CACHE_DIR, key[:2], key)
+
+
+def _commit(tmp_dir, entry_dir):
+    """ Moves a fully written entry into place, so readers never see partial entries.
+    """
+    os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another process stored the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _touch(entry_dir):
+    os.utime(os.path.join(entry_dir, MANIFEST))
+
+
+def load_cached(key, cache_dir=None):
+    """ Returns the cached result of a key, or None when it is not cached.
+    """
+    entry_dir = _entry(key, cache_dir)
+    try:
+        with open(os.path.join(entry_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+        result = _load_value(manifest['value'], entry_dir, 'value')
+    except (IOError, OSError, ValueError, KeyError):
+        # Missing, or unreadable and due to be rewritten
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        return None
+    _touch(entry_dir)
+    return result
+
+
+def save_cached(key, result, cache_dir=None, max_bytes=None):
+    """ Stores a parser result under a key. Results that cannot be stored column by column are skipped.
+
+    Returns: Whether the result was stored.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp', dir=cache_dir)
+    try:
+        manifest = {'value': _save_value(result, tmp_dir, 'value')}
+        with open(os.path.join(tmp_dir, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+        _commit(tmp_dir, _entry(key, cache_dir))
+    except Uncacheable:
+        return False
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    evict(cache_dir, max_bytes, keep=_entry(key, cache_dir))
+    return True
+
+
+def cached_file(key, name, build, cache_dir=None, max_bytes=None):
+    """ Returns the path of a cached file artifact, calling build(path) to create it when missing.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    entry_dir = _entry(key, cache_dir)
+    path = os.path.join(entry_dir, name)
+    if os.path.exists(os.path.join(entry_dir, MANIFEST)):
+        _touch(entry_dir)
+        return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp', dir=cache_dir)
+    try:
+        build(os.path.join(tmp_dir, name))
+        with open(os.path.join(tmp_dir, MANIFEST), 'w') as f:
+            json.dump({'file': name}, f)
+        _commit(tmp_dir, entry_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    evict(cache_dir, max_bytes, keep=entry_dir)
+    return path
+
+
+def cache_entries(cache_dir=None):
+    """ Lists the (last use, size, path) of every cache entry.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+    for prefix in os.listdir(cache_dir):
+        prefix_dir = os.path.join(cache_dir, prefix)
+        if prefix.startswith('.') or not os.path.isdir(prefix_dir):
+            continue
+        for key in os.listdir(prefix_dir):
+            entry_dir = os.path.join(prefix_dir, key)
+            try:
+                last_use = os.path.getmtime(os.path.join(entry_dir, MANIFEST))
+                size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+            except OSError:
+                continue
+            entries.append((last_use, size, entry_dir))
+    return entries
+
+
+def _remove_stale_tmp(cache_dir):
+    """ Removes the temporary entries of builds that crashed before cleaning up.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            if name.startswith('.tmp') and time.time() - os.path.getmtime(path) > STALE_TMP_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            continue
+
+
+def evict(cache_dir=None, max_bytes=None, keep=None):
+    """ Removes least recently used entries until the cache fits in max_bytes.
+
+    Args:
+        cache_dir (str): the cache directory.
+        max_bytes (int): size limit of the cache.
+        keep (str): entry directory that is never removed, e.g. the one just written.
+
+    Returns: The number of entries removed.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    _remove_stale_tmp(cache_dir)
+    entries = sorted(cache_entries(cache_dir))
+    total = sum(size for _, size, _ in entries)
+
+    removed = 0
+    for _, size, entry_dir in entries:
+        if total <= max_bytes:
+            break
+        if keep is not None and os.path.abspath(entry_dir) == os.path.abspath(keep):
+            continue
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed
+
+
+def cached_parse(parser, filename, cache_dir=None, content_hash=False, max_bytes=None, version=0, **options):
+    """ Calls parser(filename, **options), reusing the stored result of an identical earlier call with the same
+    parser output version.
+    """
+    key = cache_key(filename, parser.__name__, options, content_hash, version)
+    result = load_cached(key, cache_dir)
+    if result is None:
+        result = parser(filename, **options)
+        save_cached(key, result, cache_dir, max_bytes)
+    return result
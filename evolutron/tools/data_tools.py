@@ -1,11 +1,19 @@
 # coding=utf-8
+import bisect
+import glob
+import os
+import threading
 from functools import partial
+from multiprocessing import Pool
+from queue import Empty, Queue
 
 import numpy as np
 import pandas as pd
 from sklearn.model_selection import train_test_split
 
-from .seq_tools import aa2hot
+from .cache_tools import cached_parse
+from .ragged_tools import RaggedStore, RaggedWriter
+from .seq_tools import aa2hot, aa2hot_batch, aa2idx, aa2idx_batch, aa_index_table, idx2hot, labels2hot
 from ..tools import io_tools as io
 
 
@@ -22,6 +30,376 @@ def data_it(dataset, block_size, multi_data=False):
             yield dataset[excerpt]
 
 
+def is_index_encoded(x):
+    """ Checks whether x holds integer residue indices of shape (N, L) instead of one-hot vectors.
+    """
+    return isinstance(x, np.ndarray) and x.ndim == 2 and np.issubdtype(x.dtype, np.integer)
+
+
+def hot_batch_generator(x, y=None, batch_size=32, nb_aa=20, nb_categories=None, shuffle=True, sample_weight=None):
+    """ Yields batches of index encoded data indefinitely, expanding them to one-hot vectors on the fly.
+
+    Args:
+        x (np.ndarray): uint8 residue indices of shape (N, L).
+        y (np.ndarray): targets. Integer per-residue labels of shape (N, L) are expanded when nb_categories is set.
+        batch_size (int): number of sequences per batch.
+        nb_aa (int): size of the amino acid alphabet.
+        nb_categories (int): number of target categories, if y should be expanded.
+        shuffle (bool): whether to shuffle the order of the sequences at every pass.
+        sample_weight (np.ndarray): weights of the samples, yielded with their batch after the targets.
+    """
+    size = len(x)
+    if y is not None:
+        y = np.asarray(y)
+    if sample_weight is not None:
+        sample_weight = np.asarray(sample_weight)
+
+    while True:
+        order = np.random.permutation(size) if shuffle else np.arange(size)
+        for start_idx in range(0, size, batch_size):
+            excerpt = np.sort(order[start_idx:start_idx + batch_size])
+            x_batch = idx2hot(x[excerpt], nb_aa)
+            if y is None:
+                yield x_batch
+                continue
+            y_batch = labels2hot(y[excerpt], nb_categories) if nb_categories else y[excerpt]
+            if sample_weight is None:
+                yield x_batch, y_batch
+            else:
+                yield x_batch, y_batch, sample_weight[excerpt]
+
+
+def pad_batch(seqs, max_len=None, dtype=None):
+    """ Stacks a batch of variable-length arrays into one zero-padded array, clipping them to max_len.
+    """
+    length = max(len(x) for x in seqs)
+    if max_len:
+        length = min(length, max_len)
+
+    return pad_to_length(seqs, length, dtype)
+
+
+def encode_batch(seqs, nb_aa=20, compact=False, max_len=None):
+    """ Encodes a batch of sequences, padded only to the longest of them (or max_len if shorter).
+
+    Args:
+        seqs (list): amino acid strings, or already encoded index or one-hot arrays.
+        nb_aa (int): size of the amino acid alphabet.
+        compact (bool): return uint8 residue indices instead of one-hot vectors.
+        max_len (int): length to clip to.
+    """
+    if isinstance(seqs[0], str):
+        length = max(len(x) for x in seqs)
+        if max_len:
+            length = min(length, max_len)
+        if compact:
+            return aa2idx_batch(seqs, nb_aa, max_len=length)
+        return aa2hot_batch(seqs, nb_aa, max_len=length)
+
+    batch = pad_batch(seqs, max_len)
+    if is_index_encoded(batch) and not compact:
+        return idx2hot(batch, nb_aa)
+    return batch
+
+
+def bucket_batches(lengths, batch_size=32, shuffle=True):
+    """ Groups sequence indices into batches of similar length.
+
+    Sequences are sorted by length, with ties broken randomly when shuffling, and cut into consecutive batches.
+    When shuffling, the order of the batches is also shuffled.
+
+    Returns: A list of index arrays, one per batch.
+    """
+    lengths = np.asarray(lengths)
+    if shuffle:
+        order = np.lexsort((np.random.random(len(lengths)), lengths))
+    else:
+        order = np.argsort(lengths, kind='mergesort')
+
+    batches = [order[start_idx:start_idx + batch_size] for start_idx in range(0, len(order), batch_size)]
+    if shuffle:
+        np.random.shuffle(batches)
+    return batches
+
+
+def bucket_batch_generator(x_data, y_data=None, batch_size=32, nb_aa=20, compact=False, max_aa=None,
+                           pad_y_data=False, shuffle=True, loop=True):
+    """ Yields length-bucketed batches, each padded only to its own longest sequence.
+
+    Use it with Model.fit_generator and steps_per_epoch=int(np.ceil(len(x_data) / batch_size)).
+
+    Args:
+        x_data (pd.Series or list): amino acid strings, or unpadded index or one-hot arrays.
+        y_data (list or np.ndarray): targets.
+        batch_size (int): number of sequences per batch.
+        nb_aa (int): size of the amino acid alphabet.
+        compact (bool): yield uint8 residue indices instead of one-hot vectors.
+        max_aa (int): length to clip sequences to.
+        pad_y_data (bool): targets are per-residue arrays that should be padded like the sequences.
+        shuffle (bool): whether to shuffle sequences within equal lengths and the order of the batches.
+        loop (bool): whether to loop over the data indefinitely.
+    """
+    x_data = list(x_data)
+    lengths = np.fromiter(map(len, x_data), dtype=np.int64, count=len(x_data))
+    if y_data is not None and not pad_y_data:
+        y_data = np.asarray(y_data)
+
+    while True:
+        for excerpt in bucket_batches(lengths, batch_size, shuffle):
+            x_batch = encode_batch([x_data[i] for i in excerpt], nb_aa, compact, max_aa)
+            if y_data is None:
+                yield x_batch
+            elif pad_y_data:
+                yield x_batch, pad_batch([y_data[i] for i in excerpt], x_batch.shape[1])
+            else:
+                yield x_batch, y_data[excerpt]
+        if not loop:
+            break
+
+
+def _fit_length(batch, length):
+    """ Zero-pads or clips the second axis of a batch to exactly length.
+    """
+    if batch.shape[1] >= length:
+        return batch[:, :length]
+    pad = [(0, 0)] * batch.ndim
+    pad[1] = (0, length - batch.shape[1])
+    return np.pad(batch, pad, mode='constant')
+
+
+def stream_batches(x_data, y_data=None, batch_size=32, nb_aa=20, compact=False, max_aa=None, length=None,
+                   window=10000, pad_y_data=False, nb_categories=None):
+    """ Streams a dataset in length-bucketed batches, without holding more than one window of it in memory.
+
+    Sequences are bucketed by length within consecutive windows of the input. Keras Sequences and generators of
+    batches are passed through in their own order.
+
+    Args:
+        x_data: amino acid strings, unpadded arrays, a RaggedStore or a padded (memory-mapped) array. Or a keras
+            Sequence or generator of x or (x, y, ...) batches.
+        y_data: targets, indexable like x_data.
+        batch_size (int): number of sequences per batch.
+        nb_aa (int): size of the amino acid alphabet.
+        compact (bool): encode sequences as uint8 residue indices instead of one-hot vectors.
+        max_aa (int): length to clip sequences to.
+        length (int): pad or clip every batch to exactly this length, for models with a fixed input length.
+        window (int): number of sequences bucketed together.
+        pad_y_data (bool): targets are per-residue and are padded like the sequences.
+        nb_categories (int): expand per-residue index targets to one-hot vectors of this size.
+
+    Returns: A generator of (indices, x_batch, y_batch). indices is None for Sequences and generators.
+    """
+    if not hasattr(x_data, '__getitem__') or not hasattr(x_data, '__len__') or hasattr(x_data, 'on_epoch_end'):
+        # Sequences and generators
+        items = (x_data[i] for i in range(len(x_data))) if hasattr(x_data, 'on_epoch_end') else x_data
+        for item in items:
+            if isinstance(item, tuple):
+                yield None, item[0], item[1] if len(item) > 1 else None
+            else:
+                yield None, item, None
+        return
+
+    if isinstance(x_data, pd.Series):
+        x_data = x_data.values
+    if isinstance(y_data, pd.Series):
+        y_data = y_data.values
+
+    max_len = min(max_aa, length) if max_aa and length else max_aa or length
+    padded = isinstance(x_data, np.ndarray) and x_data.dtype != object and x_data.ndim > 1
+    for start_idx in range(0, len(x_data), window):
+        stop_idx = min(start_idx + window, len(x_data))
+        if padded:
+            # Already padded arrays are read in contiguous batches
+            batches = [np.arange(i, min(i + batch_size, stop_idx)) for i in range(start_idx, stop_idx, batch_size)]
+        else:
+            if hasattr(x_data, 'lengths'):
+                lengths = x_data.lengths[start_idx:stop_idx]
+            else:
+                lengths = [len(x_data[i]) for i in range(start_idx, stop_idx)]
+            batches = [b + start_idx for b in bucket_batches(lengths, batch_size, shuffle=False)]
+
+        for excerpt in batches:
+            if padded:
+                x_batch = np.asarray(x_data[excerpt[0]:excerpt[-1] + 1])
+                if max_len:
+                    x_batch = x_batch[:, :max_len]
+                if is_index_encoded(x_batch) and not compact:
+                    x_batch = idx2hot(x_batch, nb_aa)
+            elif hasattr(x_data, 'batch'):
+                x_batch = x_data.batch(excerpt, max_len)
+                if not compact:
+                    x_batch = idx2hot(x_batch, nb_aa)
+            else:
+                x_batch = encode_batch([x_data[i] for i in excerpt], nb_aa, compact, max_len)
+            if length:
+                x_batch = _fit_length(x_batch, length)
+
+            if y_data is None:
+                y_batch = None
+            elif pad_y_data:
+                y_batch = pad_to_length([np.asarray(y_data[i]) for i in excerpt], x_batch.shape[1])
+                if nb_categories and is_index_encoded(y_batch):
+                    y_batch = labels2hot(y_batch, nb_categories)
+            else:
+                y_batch = np.asarray([y_data[i] for i in excerpt])
+            yield excerpt, x_batch, y_batch
+
+
+def prefetch(iterable, max_queue_size=10):
+    """ Iterates in a background thread, keeping up to max_queue_size items ready, so that loading the next items
+    overlaps with the work done on the current one. Exceptions are re-raised in the consuming thread.
+    """
+    queue = Queue(max_queue_size)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                queue.put((item, None))
+        except Exception as e:
+            queue.put((done, e))
+            return
+        queue.put((done, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        while thread.is_alive():
+            try:
+                queue.get_nowait()
+            except Empty:
+                thread.join(0.01)
+
+
+def pack_sequences(lengths, row_len, gap):
+    """ Assigns sequences to fixed-length rows by best-fit decreasing packing.
+
+    Consecutive segments of a row are separated by gap empty positions, which should be at least kernel_size - 1
+    of the widest (dilated) convolution the rows are fed to. Sequences longer than row_len get a row of their own
+    and are clipped.
+
+    Returns: A list of index lists, one per row.
+    """
+    lengths = np.minimum(np.asarray(lengths), row_len)
+
+    rows = []
+    spaces, space_rows = [], []  # free space of the open rows, kept sorted
+    for i in np.argsort(-lengths, kind='mergesort'):
+        need = lengths[i] + gap
+        k = bisect.bisect_left(spaces, need)
+        if k == len(spaces):
+            rows.append([i])
+            row, space = len(rows) - 1, row_len + gap - need
+        else:
+            row, space = space_rows.pop(k), spaces.pop(k) - need
+            rows[row].append(i)
+        if space > gap:
+            k = bisect.bisect_left(spaces, space)
+            spaces.insert(k, space)
+            space_rows.insert(k, row)
+
+    return rows
+
+
+def pack_batch(rows, row_len, gap, dtype=None):
+    """ Concatenates the arrays of each row into one zero-filled array of shape (len(rows), row_len, ...).
+
+    Args:
+        rows (list): one list of arrays per row.
+        row_len (int): length of each row.
+        gap (int): empty positions between consecutive segments.
+        dtype: data type of the packed array.
+
+    Returns: The packed array and the (len(rows), row_len) segment ids, which number the segments of each row
+        from 1 and are 0 on padding and gaps.
+    """
+    first = np.asarray(rows[0][0])
+    packed = np.zeros((len(rows), row_len) + first.shape[1:], dtype=dtype or first.dtype)
+    segment_ids = np.zeros((len(rows), row_len), dtype=np.int32)
+
+    for r, row in enumerate(rows):
+        start = 0
+        for s, x in enumerate(row, 1):
+            n = min(len(x), row_len - start)
+            packed[r, start:start + n] = x[:n]
+            segment_ids[r, start:start + n] = s
+            start += n + gap
+
+    return packed, segment_ids
+
+
+def unpack_batch(packed, segment_ids):
+    """ Splits packed rows back into their segments, in the order of pack_sequences.
+    """
+    return [row[seg == s] for row, seg in zip(packed, segment_ids) for s in range(1, seg.max() + 1)]
+
+
+def packed_batch_generator(x_data, y_data=None, row_len=1000, batch_size=32, nb_aa=20, compact=False, gap=None,
+                           segment_ids=True, shuffle=True, loop=True):
+    """ Yields batches of fixed-length rows, each packed with several sequences, to avoid padding short sequences.
+
+    Use it with Model.fit_generator for per-residue tasks, with steps_per_epoch=int(np.ceil(nb_rows / batch_size))
+    where nb_rows = len(pack_sequences(lengths, row_len, gap)). The gap is required: set it to at least
+    kernel_size - 1 of the widest (dilated) convolution, and mask each convolution with SegmentMasking, so that
+    convolutions never mix residues of neighbouring segments.
+
+    Args:
+        x_data (pd.Series or list): amino acid strings, or unpadded index or one-hot arrays.
+        y_data (list): per-residue targets, packed like the sequences.
+        row_len (int): length of each packed row.
+        batch_size (int): number of rows per batch.
+        nb_aa (int): size of the amino acid alphabet.
+        compact (bool): yield uint8 residue indices instead of one-hot vectors.
+        gap (int): empty positions between consecutive segments, at least kernel_size - 1.
+        segment_ids (bool): yield [x, segment_ids] as inputs instead of x alone.
+        shuffle (bool): whether to shuffle the order of the rows at every pass.
+        loop (bool): whether to loop over the data indefinitely.
+    """
+    if gap is None:
+        raise ValueError('Packing requires a gap of at least kernel_size - 1 of the widest convolution.')
+    x_data = [aa2idx(x, nb_aa) if isinstance(x, str) else x for x in x_data]
+    rows = pack_sequences([len(x) for x in x_data], row_len, gap)
+
+    while True:
+        order = np.random.permutation(len(rows)) if shuffle else np.arange(len(rows))
+        for start_idx in range(0, len(rows), batch_size):
+            batch_rows = [rows[r] for r in order[start_idx:start_idx + batch_size]]
+
+            x_batch, seg_batch = pack_batch([[x_data[i] for i in row] for row in batch_rows], row_len, gap)
+            if is_index_encoded(x_batch) and not compact:
+                x_batch = idx2hot(x_batch, nb_aa)
+            inputs = [x_batch, seg_batch] if segment_ids else x_batch
+
+            if y_data is None:
+                yield inputs
+            else:
+                yield inputs, pack_batch([[y_data[i] for i in row] for row in batch_rows], row_len, gap)[0]
+        if not loop:
+            break
+
+
+def pad_to_length(seqs, length, dtype=None):
+    """ Pads or clips a list of arrays to exactly length, into one preallocated array.
+    """
+    batch = np.zeros((len(seqs), length) + np.shape(seqs[0])[1:], dtype=dtype or np.asarray(seqs[0]).dtype)
+    for i, x in enumerate(seqs):
+        n = min(len(x), length)
+        batch[i, :n] = x[:n]
+    return batch
+
+
 def pad_or_clip_seq(x, n):
     if n >= x.shape[0]:
         b = np.zeros((n, x.shape[1]))
@@ -57,7 +435,7 @@ def load_random_aa_seqs(n, length=None, min_length=100, max_length=1000):
 
 
 def preprocess_dataset(x_data, y_data=None, one_hot='x', padded=True, pad_y_data=False, nb_aa=20, min_aa=None,
-                       max_aa=None):
+                       max_aa=None, compact=False, dtype=np.float32, chunk_size=1000):
     """
 
     Args:
@@ -69,33 +447,52 @@ def preprocess_dataset(x_data, y_data=None, one_hot='x', padded=True, pad_y_data
         nb_aa:
         min_aa:
         max_aa:
+        compact (bool): encode sequences as uint8 residue indices instead of one-hot vectors.
+        dtype: data type of the padded output.
+        chunk_size (int): number of sequences encoded at a time into the preallocated output.
 
     Returns:
 
     """
-    if 'x' in one_hot:
-        x_data = x_data.apply(lambda x: aa2hot(x, nb_aa)).tolist()
-    else:
-        x_data = x_data.tolist()
-
     if 'y' in one_hot:
         pass
 
     if padded:
+        lengths = np.fromiter(map(len, x_data), dtype=np.int64, count=len(x_data))
         if not max_aa:
-            max_aa = int(np.percentile([len(x) for x in x_data], 99))  # pad so that 99% of datapoints are complete
+            max_aa = int(np.percentile(lengths, 99))  # pad so that 99% of datapoints are complete
         else:
-            max_aa = min(max_aa, np.max([len(x) for x in x_data]))
-
-        x_data = np.asarray([pad_or_clip_seq(x, max_aa) for x in x_data], dtype=np.float32)
-
+            max_aa = min(max_aa, int(lengths.max()))
         if min_aa:
-            min_aa = max(min_aa, np.max([len(x) for x in x_data]))
-            x_data = np.asarray([pad_or_clip_seq(x, min_aa) for x in x_data], dtype=np.float32)
+            max_aa = min_aa = max(min_aa, max_aa)
+
+        if 'x' in one_hot:
+            # Encode straight into one preallocated buffer, a chunk of sequences at a time
+            x_list = list(x_data)
+            if compact:
+                x_data = np.empty((len(x_list), max_aa), dtype=np.uint8)
+            else:
+                x_data = np.empty((len(x_list), max_aa, nb_aa), dtype=dtype)
+            for start_idx in range(0, len(x_list), chunk_size):
+                excerpt = slice(start_idx, start_idx + chunk_size)
+                if compact:
+                    aa2idx_batch(x_list[excerpt], nb_aa, max_len=max_aa, out=x_data[excerpt])
+                else:
+                    aa2hot_batch(x_list[excerpt], nb_aa, max_len=max_aa, dtype=dtype, out=x_data[excerpt])
+        else:
+            x_data = pad_to_length(list(x_data), max_aa, dtype)
 
-    if y_data:
+    elif 'x' in one_hot:
+        if compact:
+            x_data = [aa2idx(x, nb_aa) for x in x_data]
+        else:
+            x_data = [aa2hot(x, nb_aa, dtype) for x in x_data]
+    else:
+        x_data = list(x_data)
+
+    if y_data is not None and len(y_data):
         if padded and pad_y_data:
-            y_data = np.asarray([pad_or_clip_seq(y, min_aa) for y in y_data])
+            y_data = pad_to_length(list(y_data), max_aa, dtype)
         else:
             y_data = np.asarray(y_data)
 
@@ -109,38 +506,208 @@ def preprocess_dataset(x_data, y_data=None, one_hot='x', padded=True, pad_y_data
         return x_data
 
 
-def load_dataset(infile, codes=None, code_key=None, nb_aa=20, **parser_options):
+def _load_part(args):
+    filename, options = args
+    return load_dataset(filename, **options)
+
+
+def _encode_part(args):
+    filename, options, nb_aa = args
+    x_data, y_data = load_dataset(filename, **options)
+    seqs = list(x_data)
+    residues = aa_index_table(nb_aa)[np.frombuffer(''.join(seqs).encode('ascii', errors='replace'), dtype=np.uint8)]
+    return residues, [len(x) for x in seqs], y_data, _label_layout(filename, **options)
+
+
+def _merge(parts):
+    """ Concatenates the outputs of a parser on several files, in order.
+    """
+    if all(p is None for p in parts):
+        return None
+    if isinstance(parts[0], pd.Series):
+        return pd.concat(parts, ignore_index=True)
+    if isinstance(parts[0], np.ndarray):
+        return np.concatenate(parts)
+    return [v for p in parts for v in p]
+
+
+def _label_layout(filename, codes=None, code_key=None, y_codes=None, **options):
+    """ Returns the (name, 'sequence' or 'residue') target columns that load_dataset returns for a file, in the
+    order of its targets. A single column stands for targets that are not wrapped in a list.
+    """
+    filetype = io.file_type(filename)
+    if filetype in ('tsv', 'csv'):
+        if not codes:
+            return []
+        return [(code_key, 'sequence')] if type(code_key) == str else [(code, 'sequence') for code in code_key]
+    if filetype == 'fasta':
+        return [('y', 'sequence')] if codes else []
+    if filetype == 'sec':
+        return [('y', 'residue')]
+    if filetype in ('gz', 'npy'):
+        return [('y', 'sequence')]
+    if filetype in ('h5', 'rgd'):
+        if not y_codes:
+            return []
+        names = [y_codes] if type(y_codes) == str else list(y_codes)
+        if filetype == 'h5':
+            return [(name, 'sequence') for name in names]
+        store = RaggedStore(filename)
+        try:
+            return [(name, 'sequence' if name in store.labels else 'residue') for name in names]
+        finally:
+            store.close()
+    raise NotImplementedError('There is no parser for current file type.')
+
+
+def _label_columns(y_data, lengths, layout):
+    """ Splits the targets of one file into the per-sequence and per-residue label columns of a ragged store,
+    following the layout of _label_layout.
+    """
+    if y_data is None or not layout:
+        return {}, {}
+    columns = [y_data] if len(layout) == 1 else y_data
+
+    labels, residue_labels = {}, {}
+    for (name, kind), column in zip(layout, columns):
+        if kind == 'residue':
+            if any(len(y) != n for y, n in zip(column, lengths)):
+                raise ValueError('Per-residue targets {} do not match the sequence lengths.'.format(name))
+            residue_labels[name] = np.concatenate(column)
+        elif len({np.shape(y) for y in column}) > 1:
+            raise ValueError('Only per-residue targets can have variable lengths in a ragged store.')
+        else:
+            labels[name] = np.asarray(column)
+    return labels, residue_labels
+
+
+def _split_ids(filenames, ids):
+    """ Assigns the requested FASTA record ids to the files that contain them.
+    """
+    if any(not isinstance(k, str) for k in ids):
+        raise ValueError('Records of several files can only be selected by id, not by ordinal.')
+    file_ids, found = [], set()
+    for filename in filenames:
+        with io.IndexedFasta(filename) as fasta:
+            file_ids.append([k for k in ids if k in fasta])
+        found.update(file_ids[-1])
+    missing = [k for k in ids if k not in found]
+    if missing:
+        raise KeyError('Records {} were not found in any of the files.'.format(', '.join(missing[:10])))
+    return file_ids
+
+
+def load_datasets(filenames, processes=None, output=None, nb_aa=20, **options):
+    """ Loads a dataset spread over several files, parsing them in a process pool.
+
+    Args:
+        filenames (str or list): a glob pattern, which is expanded in sorted order, or a list of files.
+        processes (int): number of worker processes. Defaults to the number of CPUs.
+        output (str): path of a ragged store (.rgd) to merge the encoded files into. By default, the parsed
+            files are merged in memory.
+        nb_aa (int): size of the amino acid alphabet.
+        **options: load_dataset options, applied to every file. FASTA record ids are looked up in every file, and
+            each file loads the ones it contains.
+
+    Returns: The merged dataset, in the order of the files (and of the ids within each file). With an output store,
+        the sequences are returned as a RaggedStore and the targets as its label columns, named after the codes.
+    """
+    if isinstance(filenames, str):
+        pattern, filenames = filenames, sorted(glob.glob(filenames))
+        if not filenames:
+            raise IOError('No files match {}'.format(pattern))
+    options['nb_aa'] = nb_aa
+    processes = min(processes or os.cpu_count() or 1, len(filenames))
+
+    file_options = [options] * len(filenames)
+    if options.get('ids') is not None and len(filenames) > 1:
+        file_options = [dict(options, ids=ids) for ids in _split_ids(filenames, options['ids'])]
+
+    pool = Pool(processes) if processes > 1 else None
+    imap = pool.imap if pool else map
+    try:
+        if output is None:
+            parts = list(imap(_load_part, list(zip(filenames, file_options))))
+            x_data = _merge([x for x, _ in parts])
+            y_parts = [y for _, y in parts]
+            if len(_label_layout(filenames[0], **options)) > 1:
+                y_data = [_merge(list(codes)) for codes in zip(*y_parts)]
+            else:
+                y_data = _merge(y_parts)
+            return x_data, y_data
+
+        y_codes = None
+        with RaggedWriter(output, nb_aa) as writer:
+            parts = [(f, o, nb_aa) for f, o in zip(filenames, file_options)]
+            for residues, lengths, y_data, layout in imap(_encode_part, parts):
+                labels, residue_labels = _label_columns(y_data, lengths, layout)
+                writer.append(residues, lengths, labels=labels, residue_labels=residue_labels)
+                y_codes = y_codes or [name for name, _ in layout]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if not y_codes:
+        y_codes = None
+    elif len(y_codes) == 1:
+        y_codes = y_codes[0]
+    return io.ragged_parser(output, y_codes=y_codes)
+
+
+def load_dataset(infile, codes=None, code_key=None, nb_aa=20, ids=None, cache=True, **parser_options):
     """
     Loads the Evolutron formatted dataset from the input file. Automatically recognizes file format and calls
-    corresponding parser.
+    corresponding parser. Text formats can be gzip, bgzip or xz compressed, e.g. data.fasta.gz.
+    A glob pattern or a list of files is loaded in parallel by load_datasets.
 
     Args:
         infile:
         codes:
         code_key:
         nb_aa:
+        ids (list): load only the FASTA records with these ids (or ordinals), through the FASTA index.
+        cache (bool or str): reuse the parsed result of text formats from the parse cache. The source is identified
+            by its path, mtime and size, or by its contents with cache='hash'.
         **parser_options:
 
     Returns: The dataset with the appropriate format given the options.
 
     """
+    if not isinstance(infile, str) or any(c in infile for c in '*?['):
+        return load_datasets(infile, codes=codes, code_key=code_key, nb_aa=nb_aa, ids=ids, cache=cache,
+                             **parser_options)
+
     filename = infile
-    filetype = filename.split('.')[-1]
+    filetype = io.file_type(filename)
+
+    if ids is not None and filetype != 'fasta':
+        raise NotImplementedError('Loading a subset of records by id is only supported for FASTA files.')
 
     if filetype == 'tsv':
-        x_data, y_data = io.csv_parser(filename, codes, code_key, sep='\t')
+        parser, options = io.csv_parser, dict(codes=codes, code_key=code_key, sep='\t')
     elif filetype == 'csv':
-        x_data, y_data = io.csv_parser(filename, codes, code_key, sep=',')
+        parser, options = io.csv_parser, dict(codes=codes, code_key=code_key, sep=',')
     elif filetype == 'fasta':
-        x_data, y_data = io.fasta_parser(filename, codes, code_key)
+        parser, options = io.fasta_parser, dict(codes=codes, code_key=code_key, ids=ids)
     elif filetype == 'sec':
-        x_data, y_data = io.secs_parser(filename, nb_aa=nb_aa, **parser_options)
-    elif filetype == 'gz':
-        x_data, y_data = io.npz_parser(filename, nb_aa=nb_aa, **parser_options)
+        parser, options = io.secs_parser, dict(nb_aa=nb_aa, **parser_options)
+    elif filetype in ('gz', 'npy'):
+        parser, options = io.npz_parser, dict(nb_aa=nb_aa, cache=bool(cache), **parser_options)
     elif filetype == 'h5':
-        x_data, y_data = io.h5_parser(filename, **parser_options)
+        if parser_options.get('chunksize') is not None:
+            raise ValueError('load_dataset returns the whole dataset, stream the chunks with io_tools.h5_parser.')
+        parser, options = io.h5_parser, parser_options
+    elif filetype == 'rgd':
+        parser, options = io.ragged_parser, parser_options
     else:
         raise NotImplementedError('There is no parser for current file type.')
+
+    if cache and filetype in ('tsv', 'csv', 'fasta', 'sec'):
+        x_data, y_data = cached_parse(parser, filename, content_hash=(cache == 'hash'),
+                                      version=io.PARSER_VERSIONS[parser.__name__], **options)
+    else:
+        x_data, y_data = parser(filename, **options)
     return x_data, y_data
 
 
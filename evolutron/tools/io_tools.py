@@ -3,11 +3,152 @@ try:
     import cPickle
 except ImportError:
     import pickle as cPickle
+import gzip
+import lzma
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import warnings
+import zlib
+from multiprocessing import Pool
+
+import h5py
 import numpy as np
 import pandas as pd
-from Bio import SeqIO
 
-from .seq_tools import aa2codon, hot2aa, nt_map, secs2hot
+from .cache_tools import cache_key, cached_file
+from .ragged_tools import RaggedStore, RaggedWriter, _extend
+from .seq_tools import (aa2hot_batch, aa2idx_batch, aa_index_table, hot2codon_batch, hot2idx, nt2prob, nt2prob_batch,
+                        secs2hot, secs_index_table)
+
+
+COMPRESSION_SUFFIXES = ('gz', 'bgz', 'xz')
+
+# Output versions of the cached parsers. Bump a version whenever the output of its parser changes.
+PARSER_VERSIONS = {'csv_parser': 2, 'fasta_parser': 1, 'secs_parser': 1, 'decompress': 1}
+
+
+def compression(filename):
+    """ Detects the compression of a file from its magic bytes. Returns 'bgzip', 'gzip', 'xz' or None.
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(32)
+    if magic[:2] == b'\x1f\x8b':
+        return 'bgzip' if _bgzf_header_size(magic, 0) else 'gzip'
+    if magic[:6] == b'\xfd7zXZ\x00':
+        return 'xz'
+    return None
+
+
+def open_compressed(filename):
+    """ Opens a plain, gzip, bgzip or xz compressed file for streaming binary reads.
+    """
+    kind = compression(filename)
+    if kind in ('gzip', 'bgzip'):
+        return gzip.open(filename, 'rb')
+    if kind == 'xz':
+        return lzma.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def file_type(filename):
+    """ Returns the format extension of a file, looking past a compression suffix (e.g. fasta for .fasta.gz).
+    """
+    suffixes = os.path.basename(filename).split('.')[1:]
+    if len(suffixes) > 1 and suffixes[-1] in COMPRESSION_SUFFIXES:
+        return suffixes[-2]
+    return suffixes[-1] if suffixes else ''
+
+
+def _bgzf_header_size(buf, pos):
+    """ Returns the header size and total size of the BGZF block at pos, or None for other gzip members.
+    """
+    if buf[pos:pos + 4] != b'\x1f\x8b\x08\x04':
+        return None
+    xlen, = struct.unpack_from('<H', buf, pos + 10)
+    sub = pos + 12
+    while sub < pos + 12 + xlen:
+        si, slen = buf[sub:sub + 2], struct.unpack_from('<H', buf, sub + 2)[0]
+        if si == b'BC' and slen == 2:
+            return 12 + xlen, struct.unpack_from('<H', buf, sub + 4)[0] + 1
+        sub += 4 + slen
+    return None
+
+
+def build_bgzf_index(filename, index_file=None):
+    """ Records the compressed and uncompressed start offset of every block of a bgzip file.
+
+    The index is written in the .gzi layout of bgzip: the number of entries followed by (compressed, uncompressed)
+    uint64 pairs for all blocks but the first.
+
+    Returns: The compressed and uncompressed block offsets, starting with (0, 0).
+    """
+    index_file = index_file or filename + '.gzi'
+
+    comp_offsets, uncomp_offsets = [0], [0]
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        pos = total = 0
+        while pos < len(mm):
+            _, block_size = _bgzf_header_size(mm, pos)
+            total += struct.unpack_from('<I', mm, pos + block_size - 4)[0]
+            pos += block_size
+            comp_offsets.append(pos)
+            uncomp_offsets.append(total)
+        mm.close()
+
+    # The last entries mark the end of the file, not the start of a block
+    offsets = np.asarray([comp_offsets[1:-1], uncomp_offsets[1:-1]], dtype='<u8').T
+    with open(index_file, 'wb') as f:
+        f.write(struct.pack('<Q', len(offsets)))
+        f.write(offsets.tobytes())
+
+    return np.asarray(comp_offsets[:-1], dtype=np.int64), np.asarray(uncomp_offsets[:-1], dtype=np.int64)
+
+
+class BgzfReader(object):
+    """ Random access to the uncompressed bytes of a bgzip file. Only the blocks that are read get decompressed.
+    """
+
+    def __init__(self, filename, index_file=None):
+        index_file = index_file or filename + '.gzi'
+        if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(filename):
+            self.comp_offsets, self.uncomp_offsets = build_bgzf_index(filename, index_file)
+        else:
+            offsets = np.fromfile(index_file, dtype='<u8', offset=8).reshape((-1, 2)).astype(np.int64)
+            self.comp_offsets = np.concatenate(([0], offsets[:, 0]))
+            self.uncomp_offsets = np.concatenate(([0], offsets[:, 1]))
+
+        self.file = open(filename, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._cache = (None, b'')
+
+    def _block(self, i):
+        if self._cache[0] != i:
+            start = self.comp_offsets[i]
+            header_size, block_size = _bgzf_header_size(self.mm, start)
+            self._cache = (i, zlib.decompress(self.mm[start + header_size:start + block_size - 8], -15))
+        return self._cache[1]
+
+    def read(self, offset, size):
+        """ Reads size bytes starting at an uncompressed offset.
+        """
+        i = np.searchsorted(self.uncomp_offsets, offset, side='right') - 1
+        pos = offset - self.uncomp_offsets[i]
+        chunks = []
+        while size > 0 and i < len(self.comp_offsets):
+            chunk = self._block(i)[pos:pos + size]
+            chunks.append(chunk)
+            size -= len(chunk)
+            pos = 0
+            i += 1
+        return b''.join(chunks)
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
 
 
 def type2p_code(description):
@@ -17,40 +158,245 @@ def type2p_code(description):
     # Read fasta input
     rec_site = description.split(' ')[-1]
 
-    code = np.zeros((len(rec_site), 4), dtype=np.float32)
-    for j, nt in enumerate(rec_site):
-        code[j, :] = np.asarray(nt_map[nt])
+    return nt2prob(rec_site).flatten()
+
 
-    return code.flatten()
+def type2p_codes(descriptions):
+    """
+        Batch version of type2p_code. Encodes all recognition sites into one preallocated tensor
+        and returns a flattened view of each site.
+    """
+    rec_sites = [description.split(' ')[-1] for description in descriptions]
+
+    codes = nt2prob_batch(rec_sites)
+    codes = codes.reshape((len(rec_sites), -1))
+
+    return [code[:4 * len(site)] for code, site in zip(codes, rec_sites)]
 
 
-def fasta_parser(filename, codes=False, code_key=None):
+def fasta_records(filename, keep_spaces=False, raw=False, chunk_size=1 << 20):
+    """ Streams the records of a FASTA file, reading it in large binary blocks instead of line by line.
+
+    Args:
+        filename (str): path of the FASTA file.
+        keep_spaces (bool): keep blanks inside sequences, e.g. the coil positions of secondary structure records.
+        raw (bool): yield sequences as bytes instead of str.
+        chunk_size (int): number of bytes read at a time.
+
+    Returns: A generator of (id, description, sequence) tuples.
+    """
+    delete = b'\r\n' if keep_spaces else b'\r\n \t'
+
+    with open_compressed(filename) as handle:
+        for _, record in _fasta_chunks(handle, chunk_size):
+            yield _fasta_record(record, delete, raw)
+
+
+def _fasta_chunks(handle, chunk_size):
+    """ Splits a FASTA stream on record boundaries. Yields the byte offset and the bytes of each record.
+
+    Text before the first record, such as blank lines or ';' comments, is skipped.
+    """
+    offset = 0
+    tail = b''
+    leading = True
+    while True:
+        block = handle.read(chunk_size)
+        if not block:
+            break
+        tail += block
+        if leading:
+            start = 0 if tail.startswith(b'>') else tail.find(b'\n>') + 1
+            if not start and not tail.startswith(b'>'):
+                # Keep a trailing newline, the next block may open a record right after it
+                skipped = len(tail) - 1 if tail.endswith(b'\n') else len(tail)
+                offset += skipped
+                tail = tail[skipped:]
+                continue
+            offset += start
+            tail = tail[start:]
+            leading = False
+        records = tail.split(b'\n>')
+        tail = records.pop()
+        for record in records:
+            yield offset, record
+            offset += len(record) + 2
+    if tail.strip():
+        yield offset, tail
+
+
+def _fasta_record(record, delete, raw):
+    header, _, body = record.lstrip(b'\r\n>').partition(b'\n')
+    description = header.rstrip(b'\r').decode('ascii', errors='replace')
+    seq = body.translate(None, delete)
+    return description.split(None, 1)[0] if description else '', description, seq if raw else seq.decode('ascii')
+
+
+def build_fasta_index(filename, index_file=None, chunk_size=1 << 20):
+    """ Indexes a FASTA file in one streaming pass, similar to a .fai index.
+
+    The index is a tab separated file with the id, byte offset, byte size and sequence length of every record.
+
+    Args:
+        filename (str): path of the FASTA file.
+        index_file (str): path of the index. Defaults to the FASTA path with an .fidx suffix.
+        chunk_size (int): number of bytes read at a time.
+
+    Returns: The path of the index.
+    """
+    index_file = index_file or filename + '.fidx'
+
+    with open_compressed(filename) as handle, open(index_file, 'w') as out:
+        for offset, record in _fasta_chunks(handle, chunk_size):
+            idx, _, seq = _fasta_record(record, b'\r\n \t', raw=True)
+            out.write('{0}\t{1}\t{2}\t{3}\n'.format(idx, offset, len(record), len(seq)))
+
+    return index_file
+
+
+class IndexedFasta(object):
+    """ Random access to the records of a FASTA file by id or ordinal, through mmap and a build_fasta_index index.
+
+    The index is built on first use, and rebuilt when it is older than the FASTA file. Compressed files must use
+    bgzip, whose blocks are located through a block-offset index and decompressed on demand.
+    """
+
+    def __init__(self, filename, index_file=None):
+        index_file = index_file or filename + '.fidx'
+        if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(filename):
+            build_fasta_index(filename, index_file)
+
+        index = pd.read_csv(index_file, sep='\t', header=None, names=['id', 'offset', 'size', 'length'],
+                            dtype={'id': str}, keep_default_na=False)
+        self.ids = index['id'].values
+        self.offsets = index['offset'].values
+        self.sizes = index['size'].values
+        self.lengths = index['length'].values
+        self._ordinals = None
+
+        kind = compression(filename)
+        if kind == 'bgzip':
+            self.reader = BgzfReader(filename)
+        elif kind:
+            raise ValueError('Random access to a compressed FASTA file requires bgzip compression.')
+        else:
+            self.reader = None
+            self.file = open(filename, 'rb')
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets.size else b''
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, key):
+        return key in self.ordinals
+
+    def __getitem__(self, key):
+        """ Returns the (id, description, sequence) record of an id (str) or ordinal (int).
+        """
+        i = self.ordinals[key] if isinstance(key, str) else key
+        offset, size = int(self.offsets[i]), int(self.sizes[i])
+        if self.reader is None:
+            record = self.mm[offset:offset + size]
+        else:
+            record = self.reader.read(offset, size)
+        return _fasta_record(record, b'\r\n \t', raw=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def ordinals(self):
+        if self._ordinals is None:
+            self._ordinals = {idx: i for i, idx in enumerate(self.ids)}
+        return self._ordinals
+
+    def fetch(self, keys):
+        """ Returns the records of a list of ids or ordinals, reading them in file order.
+        """
+        ordinals = np.asarray([self.ordinals[k] if isinstance(k, str) else k for k in keys], dtype=np.int64)
+        order = np.argsort(self.offsets[ordinals], kind='mergesort')
+        records = [None] * len(ordinals)
+        for k in order:
+            records[k] = self[int(ordinals[k])]
+        return records
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            return
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        self.file.close()
+
+
+def fasta_batches(filename, batch_size=1000, **kwargs):
+    """ Streams the records of a FASTA file in lists of batch_size (id, description, sequence) tuples.
+    """
+    batch = []
+    for record in fasta_records(filename, **kwargs):
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def fasta_encoded_batches(filename, batch_size=1000, nb_aa=20, max_len=None, compact=True, dtype=np.float32):
+    """ Streams a FASTA file straight into the batch encoder. Sequences are never decoded to str.
+
+    Args:
+        filename (str): path of the FASTA file.
+        batch_size (int): number of sequences per batch.
+        nb_aa (int): size of the amino acid alphabet.
+        max_len (int): pad or clip every batch to this length. Defaults to the longest sequence of the batch.
+        compact (bool): encode sequences as uint8 residue indices instead of one-hot vectors.
+        dtype: data type of the one-hot batches.
+
+    Returns: A generator of (ids, encoded batch, lengths) tuples.
+    """
+    for batch in fasta_batches(filename, batch_size, raw=True):
+        ids = [record[0] for record in batch]
+        seqs = [record[2] for record in batch]
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        if compact:
+            yield ids, aa2idx_batch(seqs, nb_aa, max_len=max_len), lengths
+        else:
+            yield ids, aa2hot_batch(seqs, nb_aa, max_len=max_len, dtype=dtype), lengths
+
+
+def fasta_parser(filename, codes=False, code_key=None, ids=None):
     """
         This module parses data from FASTA files and transforms them to Evolutron format.
+        Given a list of record ids, only those records are read, through the FASTA index.
     """
-    input_file = open(filename, "rU")
+    if codes and code_key not in ('scop', 'type2p'):
+        raise IOError('Fasta parser code option set to True, but code was not recognized')
+
+    if ids is None:
+        records = fasta_records(filename)
+    else:
+        with IndexedFasta(filename) as fasta:
+            records = fasta.fetch(ids)
 
     aa_list = []
     code_list = []
-    for record in SeqIO.parse(input_file, "fasta"):
-        aa_list.append(str(record.seq))
+    for _, description, seq in records:
+        aa_list.append(seq)
         if codes:
-            try:
-                if code_key == 'scop':
-                    code_list.append(record.description.split('|')[-1])
-                elif code_key == 'type2p':
-                    code_list.append(type2p_code(record.description))
-                else:
-                    raise IOError('You had codes=True but did not provide a code_key')
-            except:
-                raise IOError('Fasta parser code option set to True, but code was not recognized')
+            if code_key == 'scop':
+                code_list.append(description.split('|')[-1])
+            else:
+                code_list.append(description)
 
-    raw_data = pd.DataFrame()
-    raw_data['sequence'] = pd.Series(aa_list)
-
-    x_data = raw_data.sequence
+    x_data = pd.Series(aa_list, name='sequence')
 
     if codes:
+        if code_key == 'type2p':
+            code_list = type2p_codes(code_list)
         y_data = code_list
     else:
         y_data = None
@@ -58,47 +404,147 @@ def fasta_parser(filename, codes=False, code_key=None):
     return x_data, y_data
 
 
-def csv_parser(filename, codes=False, code_key=None, sep='\t'):
-    def fam(x):
-        dt = str(x).split(',')
-        f = [d for d in dt if d.find(' family') >= 0]
+# First comma separated item that names a superfamily, family and subfamily, in a single pass over the string
+FAMILY_PATTERN = (r'^(?=(?:.*?(?:^|,)(?P<sup>[^,]*superfamily[^,]*))?)'
+                  r'(?=(?:.*?(?:^|,)(?P<fam>[^,]* family[^,]*))?)'
+                  r'(?=(?:.*?(?:^|,)(?P<sub>[^,]*subfamily[^,]*))?)')
 
-        try:
-            return f[0]
-        except IndexError:
-            return "Unassigned"
 
-    def supfam(x):
-        dt = str(x).split(',')
-        f = [d for d in dt if d.find('superfamily') >= 0]
+def family_columns(protein_families):
+    """ Derives the fam, sup and sub columns from a UniProt protein_families column with one vectorized extraction.
+    """
+    return protein_families.str.extract(FAMILY_PATTERN, expand=True)[['fam', 'sup', 'sub']].fillna('Unassigned')
 
-        try:
-            return f[0]
-        except IndexError:
-            return "Unassigned"
 
-    def subfam(x):
-        dt = str(x).split(',')
-        f = [d for d in dt if d.find('subfamily') >= 0]
+def _tsv_chunks(filename, sep, chunksize):
+    """ Parses a UniProt table export chunk by chunk, with normalized column names and the family columns.
+
+    Columns that are numeric in the first chunk keep their inferred type, widened to float64 so that later chunks may
+    miss values. The other columns are read as strings.
+    """
+    nb_rows = 0
+    numeric = None
+    with open_compressed(filename) as handle:
+        for chunk in pd.read_csv(handle, sep=sep, header='infer', chunksize=chunksize):
+            chunk.columns = chunk.columns.str.strip().str.lower().str.replace(' ', '_')
+            chunk.index = pd.RangeIndex(nb_rows, nb_rows + len(chunk))
+            if numeric is None:
+                numeric = {c for c in chunk if chunk[c].dtype.kind in 'iuf' and chunk[c].notnull().any()}
+                numeric.add('length')
+            for c in chunk:
+                if c in numeric:
+                    chunk[c] = pd.to_numeric(chunk[c], errors='coerce').astype(np.float64)
+                elif pd.api.types.infer_dtype(chunk[c], skipna=True) not in ('string', 'empty'):
+                    chunk[c] = chunk[c].astype(str).where(chunk[c].notnull())
+            if 'protein_families' in chunk:
+                chunk = chunk.join(family_columns(chunk['protein_families']))
+            nb_rows += len(chunk)
+            yield chunk
+
+
+def _string_widths(chunk, data_columns):
+    """ Measures the longest value of each string data column of a chunk, and of the other string columns together.
+    """
+    widths = {'values': 1}
+    for c in chunk:
+        if chunk[c].dtype == object:
+            width = int(chunk[c].str.len().max()) if chunk[c].notnull().any() else 1
+            name = c if c in data_columns else 'values'
+            widths[name] = max(widths.get(name, 1), width)
+    return widths
 
-        try:
-            return f[0]
-        except IndexError:
-            return "Unassigned"
 
+def _copy_table(store, h5_file, key, data_columns, itemsize, chunksize):
+    """ Copies a table of an open store into a new store with wider string columns. Returns the new store, open.
+    """
+    copy_file = h5_file + '.copy'
+    with pd.HDFStore(copy_file, mode='w', complevel=5, complib='blosc') as copy:
+        for chunk in store.select(key, chunksize=chunksize):
+            copy.append(key, chunk, format='table', data_columns=data_columns, min_itemsize=itemsize)
+    store.close()
+    os.replace(copy_file, h5_file)
+    return pd.HDFStore(h5_file, mode='a', complevel=5, complib='blosc')
+
+
+def tsv_to_hdf(filename, h5_file, sep='\t', key='raw_data', chunksize=100000, min_itemsize=None):
+    """ Ingests a UniProt table export chunk by chunk, appending it to a queryable table-format HDF5 store.
+
+    Memory use is bounded by the chunk size. The string columns of the table have a fixed width, which starts at the
+    longest value of the first chunk. When a later chunk holds a longer value, the rows written so far are copied into
+    a store with at least twice the width, so the table is parsed only once. The store is written to a temporary file
+    and only moved to h5_file once complete.
+
+    Args:
+        filename (str): path of the (optionally compressed) table.
+        h5_file (str): path of the HDF5 store.
+        sep (str): column separator.
+        key (str): key of the table in the store.
+        chunksize (int): number of rows parsed at a time.
+        min_itemsize (dict): fixed string column widths, which are never grown. Use 'values' for non-data columns.
+
+    Returns: The number of rows written.
+    """
+    fixed = dict(min_itemsize or {})
+    itemsize = {}
+    nb_rows = 0
+    tmp_file = h5_file + '.tmp'
+    store = pd.HDFStore(tmp_file, mode='w', complevel=5, complib='blosc')
     try:
-        raw_data = pd.read_hdf(filename.split('.')[0] + '.h5', 'raw_data')
-    except FileNotFoundError:
-        raw_data = pd.read_csv(filename, sep=sep, header='infer')
-        raw_data.columns = raw_data.columns.str.strip().str.lower().str.replace(' ', '_')
-        try:
-            raw_data['fam'] = raw_data['protein_families'].apply(fam)
-            raw_data['sup'] = raw_data['protein_families'].apply(supfam)
-            raw_data['sub'] = raw_data['protein_families'].apply(subfam)
-        except KeyError:
-            pass
+        for chunk in _tsv_chunks(filename, sep, chunksize):
+            if not nb_rows:
+                data_columns = [c for c in ('entry', 'sequence', 'length', 'fam', 'sup', 'sub') if c in chunk]
+
+            widths = _string_widths(chunk, data_columns)
+            grown = {c: w for c, w in widths.items() if c not in fixed and w > itemsize.get(c, 0)}
+            if grown and nb_rows:
+                itemsize.update({c: max(w, 2 * itemsize.get(c, 0)) for c, w in grown.items()})
+                store = _copy_table(store, tmp_file, key, data_columns, itemsize, chunksize)
+            else:
+                itemsize.update(grown)
+            itemsize.update(fixed)
+
+            try:
+                store.append(key, chunk, format='table', data_columns=data_columns, min_itemsize=itemsize)
+            except ValueError as e:
+                raise ValueError('{0}\nPass larger column widths to tsv_to_hdf with min_itemsize.'.format(e))
+            nb_rows += len(chunk)
+        store.close()
+        os.replace(tmp_file, h5_file)
+    finally:
+        store.close()
+        for path in (tmp_file, tmp_file + '.copy'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    return nb_rows
+
+
+def csv_parser(filename, codes=False, code_key=None, sep='\t', h5_file=None, min_itemsize=None):
+    """
+        This module parses UniProt table exports. The table is ingested into an HDF5 store, which is kept at h5_file
+        when a path is given and removed after parsing otherwise (load_dataset caches the parsed result instead).
+        min_itemsize fixes the string column widths of the store.
+    """
+    # Only read the columns that are used
+    if not codes:
+        columns = ['sequence']
+    elif type(code_key) == str:
+        columns = ['sequence', code_key]
+    else:
+        columns = ['sequence'] + list(code_key)
 
-        raw_data.to_hdf(filename.split('.')[0] + '.h5', 'raw_data')
+    if h5_file is None:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            tmp_file = os.path.join(tmp_dir, 'raw_data.h5')
+            tsv_to_hdf(filename, tmp_file, sep=sep, min_itemsize=min_itemsize)
+            raw_data = pd.read_hdf(tmp_file, 'raw_data', columns=columns)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    else:
+        if not os.path.exists(h5_file):
+            tsv_to_hdf(filename, h5_file, sep=sep, min_itemsize=min_itemsize)
+        raw_data = pd.read_hdf(h5_file, 'raw_data', columns=columns)
 
     if codes:
         if type(code_key) == str:
@@ -121,86 +567,455 @@ def csv_parser(filename, codes=False, code_key=None, sep='\t'):
     return x_data, y_data
 
 
-def h5_parser(filename, key='raw_data', x_codes='sequence', y_codes=None):
-    raw_data = pd.read_hdf(filename, key)
+def h5_parser(filename, key='raw_data', x_codes='sequence', y_codes=None, min_length=None, max_length=None,
+              families=None, family_key='fam', where=None, chunksize=None):
+    """
+        This module reads datasets from HDF5 stores. For table-format stores, only the x_codes and y_codes columns
+        are read, and the length range, family membership and where predicates are evaluated by the HDF5 query
+        when the columns are data columns. Rows with missing y codes are dropped.
+        With a chunksize, returns a generator of (x_data, y_data) chunks instead.
+    """
+    x_list = [x_codes] if type(x_codes) == str else list(x_codes)
+    y_list = [] if not y_codes else [y_codes] if type(y_codes) == str else list(y_codes)
+    columns = list(dict.fromkeys(x_list + y_list))
+
+    chunks = _h5_chunks(filename, key, columns, y_list, min_length, max_length, families, family_key, where,
+                        chunksize)
+
+    def split(frame):
+        x_data = frame[x_codes] if type(x_codes) == str else [frame[code] for code in x_codes]
+        if not y_codes:
+            y_data = None
+        elif type(y_codes) == str:
+            y_data = frame[y_codes].values
+        else:
+            y_data = [frame[code].values for code in y_codes]
+        return x_data, y_data
+
+    if chunksize:
+        return (split(frame) for frame in chunks)
+    return split(pd.concat(list(chunks)))
+
+
+def _h5_chunks(filename, key, columns, required, min_length, max_length, families, family_key, where, chunksize):
+    with pd.HDFStore(filename, mode='r') as store:
+        storer = store.get_storer(key)
+        data_columns = set(storer.data_columns) if storer.is_table else set()
+
+        # Predicates on data columns run inside the query, the rest on the selected rows
+        terms = [] if where is None else [where] if type(where) == str else list(where)
+        post = {}
+        if min_length is not None:
+            if 'length' in data_columns:
+                terms.append('length >= {0!r}'.format(min_length))
+            else:
+                post['min_length'] = min_length
+        if max_length is not None:
+            if 'length' in data_columns:
+                terms.append('length <= {0!r}'.format(max_length))
+            else:
+                post['max_length'] = max_length
+        if families is not None:
+            if family_key in data_columns:
+                terms.append('{0} == {1!r}'.format(family_key, [str(f) for f in families]))
+            else:
+                post['families'] = families
+
+        if storer.is_table:
+            selected = list(dict.fromkeys(columns + _post_columns(post, family_key)))
+            frames = store.select(key, where=terms or None, columns=selected, chunksize=chunksize)
+            if not chunksize:
+                frames = [frames]
+        elif terms:
+            raise ValueError('where predicates need a table-format HDF5 store.')
+        else:
+            frames = [store.select(key)]
+
+        for frame in frames:
+            yield _filter_frame(frame, columns, required, post, family_key)
+
+
+def _post_columns(post, family_key):
+    columns = []
+    if 'min_length' in post or 'max_length' in post:
+        columns.append('sequence')
+    if 'families' in post:
+        columns.append(family_key)
+    return columns
 
-    if y_codes:
-        if type(y_codes) == str:
-            pos_data = raw_data[raw_data[y_codes].notnull()]
-            y_data = pos_data[y_codes].values
+
+def _filter_frame(frame, columns, required, post, family_key):
+    mask = frame[required].notnull().all(axis=1)
+    if 'min_length' in post or 'max_length' in post:
+        lengths = frame['sequence'].str.len()
+        if 'min_length' in post:
+            mask &= lengths >= post['min_length']
+        if 'max_length' in post:
+            mask &= lengths <= post['max_length']
+    if 'families' in post:
+        mask &= frame[family_key].isin(post['families'])
+    return frame.loc[mask, columns]
+
+
+def sec_records(filename, errors='raise'):
+    """ Streams the validated (name, sequence, structure) pairs of a .sec file, as bytes.
+
+    Every sequence record must be followed by the structure record of the same chain (name:sequence, name:secstr),
+    of the same length and with known structure letters. Records without the suffixes pair up by alternation.
+
+    Args:
+        filename (str): path of the (optionally compressed) .sec file.
+        errors (str): 'raise' a ValueError on malformed pairs, or 'skip' them with a warning.
+
+    Returns: A generator of (name, sequence, structure) tuples.
+    """
+    table = secs_index_table(8)
+    skipped = 0
+
+    def malformed(problem):
+        if errors == 'raise':
+            raise ValueError('{0}: {1}'.format(filename, problem))
+
+    pending = None
+    for record_id, _, body in fasta_records(filename, keep_spaces=True, raw=True):
+        name, _, kind = record_id.rpartition(':')
+        if kind not in ('sequence', 'secstr'):
+            name, kind = record_id, 'secstr' if pending else 'sequence'
+
+        if kind == 'sequence':
+            if pending:
+                malformed('sequence {} has no structure record'.format(pending[0]))
+                skipped += 1
+            pending = (name, body.replace(b' ', b''))
+            continue
+
+        if not pending:
+            malformed('structure {} has no sequence record'.format(record_id))
+        elif ':' in record_id and pending[0] != name:
+            malformed('sequence {0} is followed by the structure of {1}'.format(pending[0], name))
+        elif len(pending[1]) != len(body):
+            malformed('{0} has {1} residues but {2} structure labels'.format(name, len(pending[1]), len(body)))
+        elif not table[np.frombuffer(body, dtype=np.uint8)].all():
+            malformed('{} has unknown structure letters'.format(name))
         else:
-            pf = raw_data[y_codes]
-            pos_data = raw_data[pf[y_codes[0]].notnull() & pf[y_codes[1]].notnull()]
-            y_data = [pos_data[code].values for code in y_codes]
-    else:
-        pos_data = raw_data
-        y_data = None
+            yield pending[0], pending[1], body
+            pending = None
+            continue
+        skipped += 1
+        pending = None
+
+    if pending:
+        malformed('sequence {} has no structure record'.format(pending[0]))
+        skipped += 1
+    if skipped:
+        warnings.warn('Skipped {0} malformed records in {1}'.format(skipped, filename))
+
+
+def sec_chunks(filename, nb_aa=20, errors='raise', chunk_size=10000):
+    """ Streams a .sec file as encoded chunks of (names, lengths, residue indices, structure indices).
+    Residues and 8-state structure labels are concatenated uint8 codes, with structure classes shifted by one.
+    """
+    aa_table = aa_index_table(nb_aa)
+    secs_table = secs_index_table(8)
+
+    def encode(pairs):
+        lengths = np.fromiter((len(seq) for _, seq, _ in pairs), dtype=np.int64, count=len(pairs))
+        residues = aa_table[np.frombuffer(b''.join(seq for _, seq, _ in pairs), dtype=np.uint8)]
+        labels = secs_table[np.frombuffer(b''.join(sec for _, _, sec in pairs), dtype=np.uint8)]
+        return [name for name, _, _ in pairs], lengths, residues, labels
+
+    pairs = []
+    for pair in sec_records(filename, errors):
+        pairs.append(pair)
+        if len(pairs) == chunk_size:
+            yield encode(pairs)
+            pairs = []
+    if pairs:
+        yield encode(pairs)
+
+
+def _write_sec_chunks(writer, chunks):
+    for names, lengths, residues, labels in chunks:
+        writer.append(residues, lengths, labels={'id': names}, residue_labels={'secs': labels})
+
+
+def _encode_sec_file(args):
+    # Chunks go to a store of the file's own as they are encoded, so a worker never holds more than one chunk
+    filename, nb_aa, errors, chunk_size, part = args
+    with RaggedWriter(part, nb_aa) as writer:
+        _write_sec_chunks(writer, sec_chunks(filename, nb_aa, errors, chunk_size))
+    return part
+
+
+def secs_to_ragged(filenames, output, nb_aa=20, errors='raise', processes=None, chunk_size=10000):
+    """ Builds a ragged store from .sec files, with the sequences and their 8-state structure labels as uint8 codes.
+
+    Files are parsed in parallel into temporary stores next to the output, which are appended to it in the given
+    order. The structure labels are stored as the 'secs' residue labels (class index + 1) and the chain names as
+    the 'id' labels.
+
+    Args:
+        filenames (str or list): .sec file(s).
+        output (str): path of the ragged store.
+        nb_aa (int): size of the amino acid alphabet.
+        errors (str): 'raise' on malformed records, or 'skip' them.
+        processes (int): number of worker processes. Defaults to the number of CPUs.
+        chunk_size (int): number of records encoded and copied at a time.
+
+    Returns: The number of sequences written.
+    """
+    if isinstance(filenames, str):
+        filenames = [filenames]
 
-    if type(x_codes) == str:
-        x_data = pos_data[x_codes]
-    else:
-        x_data = [pos_data[code] for code in x_codes]
+    with RaggedWriter(output, nb_aa) as writer:
+        if processes == 1 or len(filenames) == 1:
+            for filename in filenames:
+                _write_sec_chunks(writer, sec_chunks(filename, nb_aa, errors, chunk_size))
+            return writer.count
 
-    return x_data, y_data
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp', dir=os.path.dirname(os.path.abspath(output)))
+        pool = Pool(processes)
+        try:
+            tasks = [(filename, nb_aa, errors, chunk_size, os.path.join(tmp_dir, '{}.rgd'.format(i)))
+                     for i, filename in enumerate(filenames)]
+            for part in pool.imap(_encode_sec_file, tasks):
+                with RaggedStore(part) as store:
+                    writer.extend(store, chunk_size)
+                os.remove(part)
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return writer.count
 
 
-def secs_parser(filename, nb_categories=8, nb_aa=20, dummy_option=None):
+def secs_parser(filename, nb_categories=8, nb_aa=20, errors='raise', dummy_option=None):
     """
         This module parses data from files containing sequence and secondary structure
         and transforms them to Evolutron format.
     """
-
-    input_file = open(filename, "rU")
-
     aa_list = []
     secs_list = []
-    flag = True
-    for record in SeqIO.parse(input_file, "fasta"):
-        if flag:
-            seq = str(record.seq)
-            aa_list.append(seq)
+    for _, seq, sec in sec_records(filename, errors):
+        aa_list.append(seq.decode('ascii'))
+        secs_list.append(sec.decode('ascii'))
 
-            flag = False
-        else:
-            sec = str(record.seq)
-            secs_list.append(sec)
+    x_data = pd.Series(aa_list, name='sequence')
 
-            flag = True
+    y_data = list(map(lambda x: secs2hot(x, nb_categories), secs_list))
 
-    raw_data = pd.DataFrame()
-    raw_data['sequence'] = pd.Series(aa_list)
-    raw_data['secs'] = pd.Series(secs_list)
+    return x_data, y_data
 
-    x_data = raw_data.sequence
 
-    y_data = list(map(lambda x: secs2hot(x, nb_categories), secs_list))
+def npy_path(filename, cache=True):
+    """ Returns the path of an uncompressed .npy copy of filename. Compressed arrays are decompressed once, into
+    the parse cache, so that every later load can memory-map them. Without the cache, returns None for compressed
+    arrays.
+    """
+    if compression(filename) is None:
+        return filename
+    if not cache:
+        return None
 
-    return x_data, y_data
+    def decompress(path):
+        with open_compressed(filename) as src, open(path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+
+    return cached_file(cache_key(filename, 'decompress', version=PARSER_VERSIONS['decompress']), 'data.npy', decompress)
+
+
+class FeatureAssembler(object):
+    """ Selected feature columns of a memory-mapped CB513-style (N, 700, 57) array, assembled for the requested
+    rows only. Indexing with a batch of rows reads just those rows and returns their (B, 700, nb_features) features.
+    """
+
+    def __init__(self, data, nb_aa=22, pssm=False, extra_features=False, codon_table=False):
+        self.data = data
+        self.columns = [slice(0, nb_aa)]
+        if pssm:
+            self.columns.append(slice(35, 35 + nb_aa))
+        if extra_features:
+            self.columns.append(slice(31, 33))
+        self.codon_table = codon_table
+        self.nb_features = sum(c.stop - c.start for c in self.columns) + codon_table * 64
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def shape(self):
+        return self.data.shape[:-1] + (self.nb_features,)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def __getitem__(self, rows):
+        block = self.data[rows]
+        out = np.empty(block.shape[:-1] + (self.nb_features,), dtype=block.dtype)
+        col = 0
+        for column in self.columns:
+            width = column.stop - column.start
+            out[..., col:col + width] = block[..., column]
+            col += width
+        if self.codon_table:
+            hot2codon_batch(block[..., 0:22], out=out[..., col:col + 64])
+        return out
+
+    def gather(self):
+        """ Assembles the features of all rows into one array.
+        """
+        return self[:]
+
+
+# Residue column of CB513-style arrays that marks padding positions
+NOSEQ = 21
 
 
 def npz_parser(filename, nb_categories=8, pssm=False, codon_table=False,
-               extra_features=False, nb_aa=22, dummy_option=None):
+               extra_features=False, nb_aa=22, compact=False, lazy=False, cache=True, dummy_option=None):
     """
         This module parses data from npz files containing sequence and secondary structure
         and transforms them to Evolutron format.
+        With compact=True, sequences and structure labels are returned as uint8 indices (0 marks padding, which
+        the NoSeq residue column also maps to).
+        The array is decompressed once into the parse cache and memory-mapped. With lazy=True, the structure labels
+        are returned as a view of the memory map and the features as a view too, or as a FeatureAssembler when
+        features other than the residues are selected, so only the rows that are used get read.
+        With cache=False, compressed arrays are read into memory instead.
     """
+    path = npy_path(filename, cache)
+    if path is None:
+        with open_compressed(filename) as f:
+            data = np.lib.format.read_array(f)
+    else:
+        data = np.load(path, mmap_mode='r')
 
-    data = np.load(filename)
+    data = np.reshape(data, (-1, 700, 57))
 
-    data = np.reshape(data[:], (-1, 700, 57))
+    if compact:
+        if pssm or extra_features or codon_table:
+            raise ValueError('Compact encoding supports only the amino acid features.')
+        # Padding positions are NoSeq residues, left out so that they collapse to index 0
+        return hot2idx(data[:, :, :min(nb_aa, NOSEQ)]), hot2idx(data[:, :, 22:30])
 
-    x_data = data[:, :, :nb_aa]
+    features = FeatureAssembler(data, nb_aa, pssm, extra_features, codon_table)
 
-    if pssm:
-        x_data = np.concatenate((x_data, data[:, :, 35:35 + nb_aa]), axis=-1)
-    if extra_features:
-        x_data = np.concatenate((x_data, data[:, :, 31:33]), axis=-1)
-    if codon_table:
-        codons = []
-        for i in range(data.shape[0]):
-            codons.append(aa2codon(hot2aa(data[i, :, 0:22])))
-        x_data = np.concatenate((x_data, codons), axis=-1)
+    if lazy:
+        if not (pssm or extra_features or codon_table):
+            return data[:, :, :nb_aa], data[:, :, 22:30]
+        return features, data[:, :, 22:30]
 
-    y_data = data[:, :, 22:30]
+    # Allocate the selected features once and fill them in place
+    return features.gather(), np.array(data[:, :, 22:30])
 
-    return x_data, y_data
+
+def ragged_parser(filename, y_codes=None):
+    """
+        This module opens a ragged sequence store. The sequences are returned as a RaggedStore, which reads them
+        on access, and the labels as arrays (per-sequence columns) or lists of arrays (per-residue columns).
+    """
+    store = RaggedStore(filename)
+
+    def column(code):
+        if code in store.labels:
+            labels = store.labels[code]
+            return labels.asstr()[:] if h5py.check_string_dtype(labels.dtype) else labels[:]
+        return [store.residue_label(code, i) for i in range(len(store))]
+
+    if y_codes is None:
+        y_data = None
+    elif type(y_codes) == str:
+        y_data = column(y_codes)
+    else:
+        y_data = [column(code) for code in y_codes]
+
+    return store, y_data
+
+
+class PredictionSink(object):
+    """ Writes model predictions to disk batch by batch, in the order they are written.
+
+    HDF5 sinks (.h5, .hdf5) grow as predictions arrive. Predictions of fixed shape go to a (N, ...) 'predictions'
+    dataset, per-residue predictions of varying length are concatenated like the residues of a ragged store, with
+    the sequence boundaries in 'offsets'. Numpy sinks (.npy) are preallocated and need the number of sequences, and
+    per-residue predictions are zero padded to max_len.
+
+    Args:
+        filename (str): path of the .h5/.hdf5 or .npy file.
+        nb_samples (int): total number of predictions, required for .npy sinks.
+        max_len (int): padded length of per-residue predictions in .npy sinks.
+    """
+
+    def __init__(self, filename, nb_samples=None, max_len=None):
+        self.filename = filename
+        self.nb_samples = nb_samples
+        self.max_len = max_len
+        self.count = 0
+        self.file = self.predictions = self.offsets = None
+
+        if file_type(filename) in ('h5', 'hdf5'):
+            self.file = h5py.File(filename, 'w')
+        elif file_type(filename) == 'npy':
+            if nb_samples is None:
+                raise ValueError('Writing predictions to a .npy file needs the number of samples.')
+        else:
+            raise ValueError('Unsupported prediction file {}, use .h5 or .npy'.format(filename))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _create(self, outputs, ragged):
+        shape, dtype = (outputs[0].shape[1:], outputs[0].dtype) if ragged else (outputs.shape[1:], outputs.dtype)
+        if self.file is None:
+            if ragged:
+                if not self.max_len:
+                    raise ValueError('Writing per-residue predictions to a .npy file needs max_len.')
+                shape = (self.max_len,) + shape
+            self.predictions = np.lib.format.open_memmap(self.filename, mode='w+', dtype=dtype,
+                                                         shape=(self.nb_samples,) + shape)
+            return
+
+        self.predictions = self.file.create_dataset('predictions', shape=(0,) + shape, maxshape=(None,) + shape,
+                                                    dtype=dtype, chunks=True)
+        if ragged:
+            self.offsets = self.file.create_dataset('offsets', data=np.zeros(1, dtype=np.int64), maxshape=(None,))
+
+    def write(self, outputs):
+        """ Appends a batch of predictions.
+
+        Args:
+            outputs (np.ndarray or list): a (N, ...) array of predictions, or a list of per-residue prediction
+                arrays of varying length.
+        """
+        ragged = isinstance(outputs, list)
+        if not len(outputs):
+            return
+        if self.predictions is None:
+            self._create(outputs, ragged)
+
+        if self.file is None:
+            if ragged:
+                # New .npy files are zero filled, so only the sequences are copied
+                for row, out in zip(self.predictions[self.count:self.count + len(outputs)], outputs):
+                    n = min(len(out), self.max_len)
+                    row[:n] = out[:n]
+            else:
+                self.predictions[self.count:self.count + len(outputs)] = outputs
+        elif ragged:
+            _extend(self.offsets, self.offsets[-1] + np.cumsum([len(out) for out in outputs]))
+            _extend(self.predictions, np.concatenate(outputs))
+        else:
+            _extend(self.predictions, outputs)
+        self.count += len(outputs)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        elif self.predictions is not None:
+            self.predictions.flush()
+            self.predictions = None
@@ -0,0 +1,210 @@
+# coding=utf-8
+"""
+    Padding-free sequence store. All residues are kept as one concatenated uint8 index array in an HDF5 file,
+    together with the offsets of each sequence and its label columns.
+"""
+import h5py
+import numpy as np
+
+from .seq_tools import aa_idx_alphabet, aa_index_table
+
+
+def _extend(dataset, values):
+    size = len(dataset)
+    dataset.resize((size + len(values),) + dataset.shape[1:])
+    dataset[size:] = values
+
+
+class RaggedWriter(object):
+    """ Appends batches of encoded sequences and their labels to a new ragged store.
+
+    Args:
+        filename (str): path of the store, conventionally with a .rgd extension.
+        nb_aa (int): size of the amino acid alphabet of the residue indices.
+    """
+
+    def __init__(self, filename, nb_aa=20):
+        self.file = h5py.File(filename, 'w')
+        self.file.attrs['nb_aa'] = nb_aa
+        self.offsets = self.file.create_dataset('offsets', data=np.zeros(1, dtype=np.int64), maxshape=(None,))
+        self.residues = self.file.create_dataset('residues', shape=(0,), maxshape=(None,), dtype=np.uint8,
+                                                 chunks=(1 << 16,))
+        self.labels = self.file.create_group('labels')
+        self.residue_labels = self.file.create_group('residue_labels')
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _column(self, group, name, column):
+        if name not in group:
+            if column.dtype.kind in 'OU':
+                group.create_dataset(name, shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+            else:
+                group.create_dataset(name, shape=(0,) + column.shape[1:], maxshape=(None,) + column.shape[1:],
+                                     dtype=column.dtype)
+        if column.dtype.kind in 'OU':
+            column = column.astype(str).astype(object)
+        _extend(group[name], column)
+
+    def append(self, residues, lengths, labels=None, residue_labels=None):
+        """ Appends a batch of sequences.
+
+        Args:
+            residues (np.ndarray): the concatenated uint8 residue indices of the batch.
+            lengths (np.ndarray): the length of every sequence of the batch.
+            labels (dict): per-sequence label columns of the batch.
+            residue_labels (dict): per-residue label columns of the batch, concatenated like the residues.
+        """
+        lengths = np.asarray(lengths, dtype=np.int64)
+        assert lengths.sum() == len(residues), 'Sequence lengths do not add up to the number of residues.'
+
+        _extend(self.offsets, self.offsets[-1] + np.cumsum(lengths))
+        _extend(self.residues, residues)
+        for name, column in (labels or {}).items():
+            column = np.asarray(column)
+            assert len(column) == len(lengths), 'Label column {} has the wrong length.'.format(name)
+            self._column(self.labels, name, column)
+        for name, column in (residue_labels or {}).items():
+            column = np.asarray(column)
+            assert len(column) == len(residues), 'Residue labels {} do not match the sequence lengths.'.format(name)
+            self._column(self.residue_labels, name, column)
+        self.count += len(lengths)
+
+    def extend(self, store, chunk_size=10000):
+        """ Appends all sequences of a RaggedStore and their labels, chunk_size sequences at a time.
+        """
+        offsets = store.offsets
+        for start_idx in range(0, len(store), chunk_size):
+            stop_idx = min(start_idx + chunk_size, len(store))
+            begin, end = offsets[start_idx], offsets[stop_idx]
+            labels = {name: column.asstr()[start_idx:stop_idx] if h5py.check_string_dtype(column.dtype)
+                      else column[start_idx:stop_idx] for name, column in store.labels.items()}
+            self.append(store.residues[begin:end], np.diff(offsets[start_idx:stop_idx + 1]), labels=labels,
+                        residue_labels={name: column[begin:end] for name, column in store.residue_labels.items()})
+
+    def close(self):
+        self.file.close()
+
+
+def write_ragged(filename, x_data, labels=None, residue_labels=None, nb_aa=20, chunk_size=10000):
+    """ Writes sequences and their labels to a ragged store.
+
+    Args:
+        filename (str): path of the store, conventionally with a .rgd extension.
+        x_data (pd.Series or list): amino acid strings.
+        labels (dict or pd.DataFrame): per-sequence label columns, each of length N.
+        residue_labels (dict): per-residue label columns, each a list of N arrays with the sequence lengths.
+        nb_aa (int): size of the amino acid alphabet used for the residue indices.
+        chunk_size (int): number of sequences encoded at a time.
+
+    Returns: The number of sequences written.
+    """
+    x_data = list(x_data)
+    labels = {name: np.asarray(column) for name, column in (labels or {}).items()}
+    residue_labels = {name: list(column) for name, column in (residue_labels or {}).items()}
+    for name, column in list(labels.items()) + list(residue_labels.items()):
+        assert len(column) == len(x_data), 'Label column {} has the wrong length.'.format(name)
+
+    table = aa_index_table(nb_aa)
+    with RaggedWriter(filename, nb_aa) as writer:
+        for start_idx in range(0, len(x_data), chunk_size):
+            excerpt = slice(start_idx, start_idx + chunk_size)
+            seqs = x_data[excerpt]
+            lengths = [len(x) for x in seqs]
+            for name, column in residue_labels.items():
+                assert [len(c) for c in column[excerpt]] == lengths, \
+                    'Residue labels {} do not match the sequence lengths.'.format(name)
+            buf = np.frombuffer(''.join(seqs).encode('ascii', errors='replace'), dtype=np.uint8)
+            writer.append(table[buf], lengths,
+                          labels={name: column[excerpt] for name, column in labels.items()},
+                          residue_labels={name: np.concatenate([np.asarray(c) for c in column[excerpt]])
+                                          for name, column in residue_labels.items()})
+
+    return len(x_data)
+
+
+class RaggedStore(object):
+    """ Read access to a ragged store written by write_ragged.
+
+    The offsets are held in memory, so fetching sequence i is a single contiguous read of its residues.
+    Indexing returns amino acid strings, which makes the store a drop-in replacement for the sequence
+    column of the other parsers. Use codes and batch to work with the residue indices directly.
+    """
+
+    def __init__(self, filename):
+        self.file = h5py.File(filename, 'r')
+        self.nb_aa = int(self.file.attrs['nb_aa'])
+        self.offsets = self.file['offsets'][:]
+        self.residues = self.file['residues']
+        self.labels = self.file['labels']
+        self.residue_labels = self.file['residue_labels']
+        # Stored sequences hold no padding, so index 0 can only be a residue unknown to the alphabet
+        self.alphabet = np.frombuffer(('X' + aa_idx_alphabet(self.nb_aa)[1:]).encode('ascii'), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        return self.alphabet[self.codes(item)].tobytes().decode('ascii')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def codes(self, i):
+        """ Returns the uint8 residue indices of sequence i.
+        """
+        if i < 0:
+            i += len(self)
+        return self.residues[self.offsets[i]:self.offsets[i + 1]]
+
+    def residue_label(self, name, i):
+        """ Returns the per-residue labels of sequence i.
+        """
+        if i < 0:
+            i += len(self)
+        return self.residue_labels[name][self.offsets[i]:self.offsets[i + 1]]
+
+    def batch(self, indices, max_len=None):
+        """ Gathers sequences into a (len(indices), L) uint8 array, zero padded to the longest one in the batch.
+
+        Args:
+            indices (list or np.ndarray): sequence ordinals.
+            max_len (int): clip sequences to this length.
+
+        Returns: The padded batch.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts, lengths = self.offsets[indices], self.offsets[indices + 1] - self.offsets[indices]
+        if max_len:
+            lengths = np.minimum(lengths, max_len)
+
+        out = np.zeros((len(indices), lengths.max() if len(indices) else 0), dtype=np.uint8)
+        if len(indices) and np.all(np.diff(indices) == 1):
+            # Consecutive sequences come from one read
+            span = self.residues[starts[0]:self.offsets[indices[-1] + 1]]
+            starts = starts - starts[0]
+        else:
+            span = self.residues
+        for row, start, length in zip(out, starts.tolist(), lengths.tolist()):
+            row[:length] = span[start:start + length]
+        return out
@@ -1,4 +1,6 @@
 # coding=utf-8
+from functools import lru_cache
+
 import numpy as np
 
 """
@@ -173,32 +175,160 @@ Transformations between representations
 """
 
 
-def aa2hot(aa_seq, n=20):
-    if n == 20:
-        aa_map.pop('U', 0)
-        aa_map.pop('O', 0)
-    hot = np.zeros(shape=(len(aa_seq), n))
-    for idx, aa in enumerate(aa_seq):
-        if aa in aa_map:
-            hot[idx, aa_map[aa]] = 1
-        elif aa == 'X':
-            hot[idx, :] = [1 / n for _ in range(n)]
-        elif aa == 'B':
-            hot[idx, aa_map['D']] = .5
-            hot[idx, aa_map['N']] = .5
-        elif aa == 'Z':
-            hot[idx, aa_map['E']] = .5
-            hot[idx, aa_map['Q']] = .5
-        elif aa == 'J':
-            hot[idx, aa_map['I']] = .5
-            hot[idx, aa_map['L']] = .5
-    return hot
+@lru_cache(maxsize=None)
+def aa_lookup_table(n=20, dtype=np.float32):
+    """ Builds a read-only (256, n) table that maps the byte value of each residue letter to its one-hot row.
+
+    Ambiguous residues get fractional rows (X: uniform, B: D/N, Z: E/Q, J: I/L), any other byte
+    (including the zero byte used for padding) maps to a row of zeros. With n=20, U and O are not encoded.
+    """
+    table = np.zeros((256, n), dtype=dtype)
+    for aa, idx in aa_map.items():
+        if idx < n:
+            table[ord(aa), idx] = 1
+    table[ord('X'), :] = 1. / n
+    table[ord('B'), [aa_map['D'], aa_map['N']]] = .5
+    table[ord('Z'), [aa_map['E'], aa_map['Q']]] = .5
+    table[ord('J'), [aa_map['I'], aa_map['L']]] = .5
+    table.flags.writeable = False
+    return table
+
+
+def seqs2bytes(seqs, max_len=None):
+    """ Packs sequences (str or bytes) into a zero-padded (N, max_len) uint8 array of their byte values.
+
+    Sequences longer than max_len are clipped. Returns the array together with the (unclipped) lengths.
+    """
+    seqs = list(seqs)
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    if max_len is None:
+        max_len = int(lengths.max()) if len(seqs) else 0
+
+    codes = np.zeros((len(seqs), max_len), dtype=np.uint8)
+    if not len(seqs):
+        return codes, lengths
+
+    if isinstance(seqs[0], bytes):
+        buf = np.frombuffer(b''.join(seqs), dtype=np.uint8)
+    else:
+        buf = np.frombuffer(''.join(seqs).encode('ascii', errors='replace'), dtype=np.uint8)
+
+    # The kept bytes of every row, gathered from the joined buffer in row-major order
+    clipped = np.minimum(lengths, max_len)
+    shift = np.repeat(np.cumsum(lengths) - lengths - (np.cumsum(clipped) - clipped), clipped)
+    codes[np.arange(max_len) < clipped[:, None]] = buf[np.arange(int(clipped.sum())) + shift]
+
+    return codes, lengths
+
+
+def aa2hot(aa_seq, n=20, dtype=np.float64):
+    return aa_lookup_table(n, np.dtype(dtype).type)[np.frombuffer(aa_seq.encode('ascii', errors='replace'),
+                                                                  dtype=np.uint8)]
+
+
+def aa2hot_batch(aa_seqs, n=20, max_len=None, dtype=np.float32, out=None):
+    """ Encodes a collection of amino acid sequences into a zero-padded (N, max_len, n) tensor in one pass.
+
+    Args:
+        aa_seqs (pd.Series or list): amino acid sequences.
+        n (int): size of the alphabet, 20 or 22.
+        max_len (int): length to pad or clip to. Defaults to the longest sequence.
+        dtype: data type of the output tensor.
+        out (np.ndarray): optional preallocated output of shape (N, max_len, n) and the given dtype.
+
+    Returns: The one-hot encoded tensor.
+    """
+    codes, _ = seqs2bytes(aa_seqs, max_len)
+    return np.take(aa_lookup_table(n, np.dtype(dtype).type), codes, axis=0, out=out, mode='clip')
+
+
+def aa_idx_alphabet(n=20):
+    """ Residue letters in index order. Index 0 is reserved for padding, followed by the n residues of aa_map and
+    the ambiguous residues X, B, Z and J.
+    """
+    return '\0' + ''.join(aa_map_rev[i] for i in range(n)) + 'XBZJ'
+
+
+@lru_cache(maxsize=None)
+def aa_index_table(n=20):
+    """ Builds a read-only (256,) table that maps the byte value of each residue letter to its uint8 index.
+    """
+    table = np.zeros(256, dtype=np.uint8)
+    for idx, aa in enumerate(aa_idx_alphabet(n)[1:], 1):
+        table[ord(aa)] = idx
+    table.flags.writeable = False
+    return table
+
+
+@lru_cache(maxsize=None)
+def idx_hot_table(n=20, dtype=np.float32):
+    """ Builds a read-only (n + 5, n) table that maps residue indices back to their one-hot rows.
+    """
+    table = aa_lookup_table(n, dtype)[np.frombuffer(aa_idx_alphabet(n).encode('ascii'), dtype=np.uint8)]
+    table.flags.writeable = False
+    return table
+
+
+def aa2idx(aa_seq, n=20):
+    return aa_index_table(n)[np.frombuffer(aa_seq.encode('ascii', errors='replace'), dtype=np.uint8)]
+
+
+def aa2idx_batch(aa_seqs, n=20, max_len=None, out=None):
+    """ Encodes a collection of amino acid sequences into a zero-padded (N, max_len) uint8 index array.
+    """
+    codes, _ = seqs2bytes(aa_seqs, max_len)
+    return np.take(aa_index_table(n), codes, out=out, mode='clip')
+
+
+def idx2hot(idx, n=20, dtype=np.float32):
+    """ Expands residue indices of any shape to one-hot vectors along a new last axis.
+    """
+    return idx_hot_table(n, np.dtype(dtype).type)[idx]
+
+
+def hot2idx(hot):
+    """ Collapses one-hot vectors along the last axis to uint8 indices, with all-zero rows mapped to 0.
+    """
+    return np.where(np.any(hot, axis=-1), np.argmax(hot, axis=-1) + 1, 0).astype(np.uint8)
+
+
+def labels2hot(labels, cats, dtype=np.float32):
+    """ Expands 1-based class labels of any shape to one-hot vectors, with label 0 (padding) mapped to zeros.
+    """
+    return np.eye(cats + 1, dtype=dtype)[labels][..., 1:]
+
+
+def decode_batch(hot, alphabet, lengths=None, pad='-'):
+    """ Decodes an (N, L, C) batch of one-hot vectors into N strings with a single argmax and a character lookup.
+
+    Args:
+        hot (np.ndarray): one-hot (or probability) vectors, also accepts a single (L, C) sequence.
+        alphabet (str): character of each of the C categories.
+        lengths (list or np.ndarray): length of each sequence, the decoded strings are clipped to it.
+        pad (str): character for all-zero (padding) vectors.
+
+    Returns: The list of decoded strings.
+    """
+    hot = np.asarray(hot)
+    if hot.ndim == 2:
+        hot = hot[np.newaxis]
+
+    lookup = np.frombuffer((alphabet[:hot.shape[-1]] + pad).encode('ascii'), dtype=np.uint8)
+    num = np.argmax(hot, axis=-1)
+    num[~np.any(hot, axis=-1)] = len(lookup) - 1
+    chars = lookup[num]
+
+    if lengths is None:
+        return [row.tobytes().decode('ascii') for row in chars]
+    return [row[:l].tobytes().decode('ascii') for row, l in zip(chars, lengths)]
+
+
+def hot2aa_batch(hot, lengths=None, pad='-'):
+    return decode_batch(hot, ''.join(aa_map_rev[i] for i in range(len(aa_map))), lengths, pad)
 
 
 def hot2aa(hot):
-    num = [np.argmax(h) for h in hot if np.sum(h) != 0.0]
-    pad = [22 for h in hot if np.sum(h) == 0.0]
-    return ''.join([aa_map_rev[n] for n in num+pad])
+    return hot2aa_batch(hot)[0]
 
 
 def secs2hot(sec_seq, cats=3):
@@ -211,26 +341,95 @@ def secs2hot(sec_seq, cats=3):
     return np.eye(cats, dtype=np.float32)[num]
 
 
-# TODO: refactor this
-def hot2SecS_8cat(hot):
-    num = [np.argmax(h) for h in hot]
+@lru_cache(maxsize=None)
+def secs_index_table(cats=8):
+    """ Builds a read-only (256,) table that maps the byte value of each structure letter to its class index + 1.
+    Unknown letters map to 0, the padding index.
+    """
+    if cats == 3:
+        mapping = SecS_map_3cat
+    elif cats == 8:
+        mapping = SecS_map_8cat
+    else:
+        raise ValueError('Invalid option for secondary structure . Should be 8 or 3.')
+    table = np.zeros(256, dtype=np.uint8)
+    for s, idx in mapping.items():
+        table[ord(s)] = idx + 1
+    table.flags.writeable = False
+    return table
+
 
-    return ''.join([SecS_map_8cat_rev[n] for n in num])
+def hot2SecS_8cat_batch(hot, lengths=None, pad='C'):
+    return decode_batch(hot, ''.join(SecS_map_8cat_rev[i] for i in range(8)), lengths, pad)
+
+
+def hot2SecS_3cat_batch(hot, lengths=None, pad='C'):
+    return decode_batch(hot, ''.join(SecS_map_3cat_rev[i] for i in range(3)), lengths, pad)
+
+
+def hot2SecS_8cat(hot):
+    return hot2SecS_8cat_batch(hot)[0]
 
 
 def hot2SecS_3cat(hot):
-    num = [np.argmax(h) for h in hot]
+    return hot2SecS_3cat_batch(hot)[0]
+
+
+@lru_cache(maxsize=None)
+def nt_lookup_table():
+    """ Builds a read-only (256, 4) table that maps the byte value of each IUPAC nucleotide letter to its
+    probability row. Any other byte (including the zero byte used for padding) maps to a row of zeros.
+    """
+    table = np.zeros((256, 4), dtype=np.float32)
+    for nt, prob in nt_map.items():
+        table[ord(nt)] = prob
+    table.flags.writeable = False
+    return table
+
 
-    return ''.join([SecS_map_3cat_rev[n] for n in num])
+@lru_cache(maxsize=None)
+def _iupac_lookup(pad='-'):
+    # IUPAC letter for each 4-bit set of present nucleotides (bit i for column i of nt_map)
+    lookup = np.full(16, ord(pad), dtype=np.uint8)
+    for nt, prob in nt_map.items():
+        lookup[np.dot(np.greater(prob, 0), [1, 2, 4, 8])] = ord(nt)
+    lookup.flags.writeable = False
+    return lookup
+
+
+def _check_iupac(prob, sites, lengths):
+    """ Raises on positions within the site lengths that no IUPAC nucleotide letter was encoded to.
+    """
+    unknown = (prob == 0).all(-1) & (np.arange(prob.shape[-2]) < np.reshape(lengths, (-1, 1)))
+    if unknown.any():
+        row = int(np.argmax(unknown.any(-1)))
+        raise IOError('Site {} contains letters outside the IUPAC nucleotide code.'.format(sites[row]))
 
 
 def nt2prob(seq):
-    nt = []
+    prob = nt_lookup_table()[np.frombuffer(seq.encode('ascii', errors='replace'), dtype=np.uint8)]
+    _check_iupac(prob, [seq], [len(seq)])
+    return prob
+
+
+def nt2prob_batch(sites, max_len=None, out=None):
+    """ Encodes a collection of IUPAC recognition sites into a zero-padded (N, max_len, 4) tensor.
 
-    for s in seq:
-        nt.append(nt_map[s])
+    Args:
+        sites (list): nucleotide sequences.
+        max_len (int): length to pad or clip to. Defaults to the longest site.
+        out (np.ndarray): optional preallocated float32 output of shape (N, max_len, 4).
 
-    return np.asarray(nt, dtype=np.float32)
+    Returns: The encoded tensor.
+
+    Raises:
+        IOError: if a site contains letters outside the IUPAC nucleotide code.
+    """
+    sites = list(sites)
+    codes, lengths = seqs2bytes(sites, max_len)
+    prob = np.take(nt_lookup_table(), codes, axis=0, out=out, mode='clip')
+    _check_iupac(prob, sites, lengths)
+    return prob
 
 
 def ntround(x):
@@ -247,19 +446,68 @@ def ntround(x):
         return 1.0
 
 
+def ntround_batch(prob):
+    """ Vectorized ntround over an array of any shape.
+    """
+    prob = np.asarray(prob)
+    assert np.all(prob >= 0)
+    assert np.all(prob <= 1)
+    levels = np.array([0.0, 0.33, 0.5, 1.0])
+    return levels[np.digitize(np.round(prob, 2), [0.2, 0.4, 0.6], right=True)]
+
+
 def prob2nt(prob):
     assert (isinstance(prob, np.ndarray))
 
-    prob = prob.reshape((-1, 4))
+    return ntround_batch(prob.reshape((-1, 4)))
+
 
-    f = np.vectorize(ntround)
+def prob2nt_batch(prob, lengths=None, pad='-'):
+    """ Rounds an (N, L, 4) batch of predicted nucleotide probabilities back to N IUPAC recognition sites.
 
-    return f(prob)
+    Args:
+        prob (np.ndarray): predicted probabilities, also accepts flattened (N, L * 4) predictions.
+        lengths (list or np.ndarray): length of each site, the decoded strings are clipped to it.
+        pad (str): character for positions where no nucleotide survives rounding.
+
+    Returns: The list of decoded sites.
+    """
+    prob = np.asarray(prob)
+    prob = prob.reshape((len(prob), -1, 4))
+
+    present = ntround_batch(prob) > 0
+    chars = _iupac_lookup(pad)[np.dot(present, [1, 2, 4, 8])]
+
+    if lengths is None:
+        return [row.tobytes().decode('ascii') for row in chars]
+    return [row[:l].tobytes().decode('ascii') for row, l in zip(chars, lengths)]
+
+
+@lru_cache(maxsize=None)
+def codon_lookup_table(n=22, dtype=np.float32):
+    """ Builds a read-only (n + 5, 64) table that maps residue indices to their codon indicator rows, following
+    aa2cod_map. Padding and ambiguous residues map to rows of zeros.
+    """
+    table = np.zeros((n + 5, 64), dtype=dtype)
+    for idx, aa in enumerate(aa_idx_alphabet(n)):
+        if aa in aa2cod_map:
+            table[idx, list(aa2cod_map[aa])] = 1
+    table.flags.writeable = False
+    return table
 
 
 def aa2codon(aa_seq):
-    cod = np.zeros((len(aa_seq), 64))
-    for i in range(len(aa_seq)):
-        cod[i, aa2cod_map[aa_seq[i]]] = 1
+    return codon_lookup_table(22, np.float64)[aa2idx(aa_seq, 22)]
+
+
+def hot2codon_batch(hot, out=None):
+    """ Maps an (N, L, n) batch of one-hot residues straight to an (N, L, 64) codon indicator tensor.
+
+    Args:
+        hot (np.ndarray): one-hot residues in aa_map order.
+        out (np.ndarray): optional preallocated output of shape (N, L, 64), e.g. a slice of a larger feature array.
 
-    return cod
+    Returns: The codon indicator tensor.
+    """
+    table = codon_lookup_table(hot.shape[-1], np.float32 if out is None else out.dtype.type)
+    return np.take(table, hot2idx(hot), axis=0, out=out, mode='clip')
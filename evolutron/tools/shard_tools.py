@@ -0,0 +1,176 @@
+# coding=utf-8
+"""
+    On-disk dataset shards, read back in batches through memory maps.
+"""
+import json
+import os
+
+import numpy as np
+from keras.utils import Sequence
+
+from .data_tools import is_index_encoded, pad_to_length
+from .seq_tools import aa2hot_batch, aa2idx_batch, idx2hot
+
+META_FILE = 'shards.json'
+
+
+def write_shards(x_data, output_dir, y_data=None, shard_size=100000, nb_aa=20, max_aa=None, compact=True,
+                 pad_y_data=False, chunk_size=1000):
+    """ Encodes a dataset and writes it to .npy shards, without holding the encoded dataset in memory.
+
+    Args:
+        x_data (pd.Series, list or np.ndarray): amino acid strings, or an already encoded (padded) array.
+        output_dir (str): directory of the shards.
+        y_data (list or np.ndarray): targets.
+        shard_size (int): number of sequences per shard.
+        nb_aa (int): size of the amino acid alphabet.
+        max_aa (int): length to pad or clip sequences to. Defaults to the 99th percentile of the lengths.
+        compact (bool): store uint8 residue indices instead of one-hot vectors.
+        pad_y_data (bool): targets are per-residue arrays that should be padded like the sequences.
+        chunk_size (int): number of sequences encoded at a time.
+
+    Returns: The list of shard sizes.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    encode = not isinstance(x_data, np.ndarray)
+    if encode:
+        x_data = list(x_data)
+        if not max_aa:
+            max_aa = int(np.percentile([len(x) for x in x_data], 99))
+    else:
+        max_aa = x_data.shape[1]
+        compact = is_index_encoded(x_data)
+
+    sizes = []
+    for k, start_idx in enumerate(range(0, len(x_data), shard_size)):
+        stop_idx = min(start_idx + shard_size, len(x_data))
+        x_path = os.path.join(output_dir, 'x_{0:05d}.npy'.format(k))
+
+        if encode:
+            shape = (stop_idx - start_idx, max_aa) if compact else (stop_idx - start_idx, max_aa, nb_aa)
+            x_shard = np.lib.format.open_memmap(x_path, mode='w+', shape=shape,
+                                                dtype=np.uint8 if compact else np.float32)
+            for chunk_idx in range(start_idx, stop_idx, chunk_size):
+                excerpt = slice(chunk_idx - start_idx, min(chunk_idx + chunk_size, stop_idx) - start_idx)
+                seqs = x_data[chunk_idx:min(chunk_idx + chunk_size, stop_idx)]
+                if compact:
+                    aa2idx_batch(seqs, nb_aa, max_len=max_aa, out=x_shard[excerpt])
+                else:
+                    aa2hot_batch(seqs, nb_aa, max_len=max_aa, out=x_shard[excerpt])
+            x_shard.flush()
+            del x_shard
+        else:
+            np.save(x_path, x_data[start_idx:stop_idx])
+
+        if y_data is not None:
+            y_shard = y_data[start_idx:stop_idx]
+            if pad_y_data:
+                y_shard = pad_to_length(list(y_shard), max_aa, np.float32)
+            np.save(os.path.join(output_dir, 'y_{0:05d}.npy'.format(k)), np.asarray(y_shard))
+
+        sizes.append(stop_idx - start_idx)
+
+    with open(os.path.join(output_dir, META_FILE), 'w') as f:
+        json.dump({'sizes': sizes,
+                   'compact': compact,
+                   'nb_aa': nb_aa,
+                   'max_aa': max_aa,
+                   'targets': y_data is not None}, f)
+
+    print('Wrote {0} sequences to {1} shards in {2}'.format(sum(sizes), len(sizes), output_dir))
+    return sizes
+
+
+class ShardedArray(object):
+    """ Read-only, row-indexable view over the memory-mapped shards of one array.
+
+    Compact shards are expanded to one-hot vectors on access, when nb_aa is given.
+    """
+
+    def __init__(self, shards, nb_aa=None):
+        self.shards = shards
+        self.nb_aa = nb_aa
+        self.offsets = np.cumsum([0] + [len(s) for s in shards])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self),) + self.shards[0].shape[1:] + ((self.nb_aa,) if self.nb_aa else ())
+
+    def _expand(self, x):
+        return idx2hot(x, self.nb_aa) if self.nb_aa else np.asarray(x)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            assert step == 1, 'Only contiguous slices are supported.'
+            parts = []
+            for k, shard in enumerate(self.shards):
+                lo, hi = max(start, self.offsets[k]), min(stop, self.offsets[k + 1])
+                if lo < hi:
+                    parts.append(shard[lo - self.offsets[k]:hi - self.offsets[k]])
+            if not parts:
+                return self._expand(self.shards[0][:0])
+            return self._expand(parts[0] if len(parts) == 1 else np.concatenate(parts))
+
+        if item < 0:
+            item += len(self)
+        k = np.searchsorted(self.offsets, item, side='right') - 1
+        return self._expand(self.shards[k][item - self.offsets[k]])
+
+
+class ShardSequence(Sequence):
+    """ Keras Sequence that reads batches from the shards written by write_shards through np.memmap.
+
+    Batches are contiguous rows of a single shard, so every batch is one sequential read. When shuffling,
+    the order of the batches changes after every epoch.
+
+    Args:
+        shard_dir (str): directory of the shards.
+        batch_size (int): number of sequences per batch.
+        shuffle (bool): whether to shuffle the order of the batches.
+        expand (bool): expand compact shards to one-hot vectors. Set it to False for models that take indices.
+        targets (bool): whether to yield targets along the inputs.
+    """
+
+    def __init__(self, shard_dir, batch_size=32, shuffle=True, expand=True, targets=True):
+        with open(os.path.join(shard_dir, META_FILE)) as f:
+            self.meta = json.load(f)
+
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.targets = targets and self.meta['targets']
+        nb_aa = self.meta['nb_aa'] if expand and self.meta['compact'] else None
+
+        nb_shards = len(self.meta['sizes'])
+        self.inputs = ShardedArray([np.load(os.path.join(shard_dir, 'x_{0:05d}.npy'.format(k)), mmap_mode='r')
+                                    for k in range(nb_shards)], nb_aa)
+        if self.targets:
+            self.outputs = ShardedArray([np.load(os.path.join(shard_dir, 'y_{0:05d}.npy'.format(k)), mmap_mode='r')
+                                         for k in range(nb_shards)])
+        else:
+            self.outputs = None
+
+        self.batches = [slice(offset + start, offset + min(start + batch_size, size))
+                        for offset, size in zip(self.inputs.offsets, self.meta['sizes'])
+                        for start in range(0, size, batch_size)]
+        self.on_epoch_end()
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, idx):
+        excerpt = self.batches[self.order[idx]]
+        if self.outputs is None:
+            return self.inputs[excerpt]
+        return self.inputs[excerpt], self.outputs[excerpt]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.order = np.random.permutation(len(self.batches))
+        else:
+            self.order = np.arange(len(self.batches))
@@ -0,0 +1,14 @@
+# coding=utf-8
+import pytest
+
+from evolutron.tools import cache_tools
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir, monkeypatch):
+    """ Points the parse cache at a per test directory, so tests never read or write the user cache.
+    """
+    path = str(tmpdir.join('evolutron_cache'))
+    monkeypatch.setenv('EVOLUTRON_CACHE', path)
+    monkeypatch.setattr(cache_tools, 'CACHE_DIR', path)
+    return path
@@ -0,0 +1,74 @@
+# coding=utf-8
+"""
+Test of the Evolutron callbacks.
+
+"""
+import os
+
+import pytest
+import numpy as np
+
+keras = pytest.importorskip('keras')
+
+from keras.layers import Dense, Input
+from keras.models import Model
+from evolutron.extra_callbacks import BestWeights
+
+
+def dense_model():
+    inp = Input(shape=(4,))
+    return Model(inputs=inp, outputs=Dense(2)(inp))
+
+
+def set_weights(model, value):
+    model.set_weights([np.full_like(w, value) for w in model.get_weights()])
+
+
+def test_best_weights(tmpdir):
+    model = dense_model()
+    spill_path = str(tmpdir.join('best.npz'))
+    callback = BestWeights(monitor='val_loss', mode='min', spill_path=spill_path)
+    callback.set_model(model)
+    callback.on_train_begin()
+    assert [b.shape for b in callback.buffers] == [w.shape for w in model.get_weights()]
+    buffers = [id(b) for b in callback.buffers]
+
+    for epoch, loss in enumerate([3.0, 1.0, 2.0, 1.5]):
+        set_weights(model, epoch)
+        callback.on_epoch_end(epoch, {'val_loss': loss})
+    assert callback.best == 1.0 and callback.best_epoch == 1
+    # Improvements are copied into the buffers allocated when training began
+    assert [id(b) for b in callback.buffers] == buffers
+    assert all((b == 1).all() for b in callback.buffers)
+
+    with pytest.warns(RuntimeWarning):
+        callback.on_epoch_end(4, {'loss': 0.1})
+
+    callback.on_train_end()
+    assert all((w == 1).all() for w in model.get_weights())
+
+    # The spilled file holds the best weights in order and replaces its temporary file
+    spilled = np.load(spill_path)
+    assert len(spilled.files) == len(model.weights)
+    assert all((spilled['arr_{}'.format(i)] == 1).all() for i in range(len(model.weights)))
+    assert not os.path.exists(spill_path + '.tmp.npz')
+
+
+def test_best_weights_max(tmpdir, capsys):
+    model = dense_model()
+    callback = BestWeights(monitor='acc', mode='max', restore=False, verbose=1)
+    callback.set_model(model)
+    callback.on_train_begin()
+    for epoch, acc in enumerate([0.5, 0.7, 0.6]):
+        set_weights(model, epoch)
+        callback.on_epoch_end(epoch, {'acc': acc})
+    assert callback.best_epoch == 1 and all((b == 1).all() for b in callback.buffers)
+    # The first epoch improves on -inf, like ModelCheckpoint
+    assert 'acc improved from -inf to 0.50000' in capsys.readouterr().out
+
+    # Without restore, training ends on the last weights
+    callback.on_train_end()
+    assert all((w == 2).all() for w in model.get_weights())
+
+    with pytest.raises(ValueError):
+        BestWeights(mode='auto')
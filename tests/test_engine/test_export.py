@@ -0,0 +1,51 @@
+# coding=utf-8
+"""
+Test of the model exporter against the NumPy runtime.
+
+"""
+import pytest
+import numpy as np
+
+keras = pytest.importorskip('keras')
+
+from keras.layers import Conv1D, Dense, GlobalMaxPooling1D, Input
+from evolutron.engine import Model, export_model
+from evolutron.extra_layers import Deconvolution1D, Dedense, IndexConvolution1D
+from evolutron.runtime import load_runtime
+from evolutron.tools.data_tools import encode_batch
+
+
+def tied_model(bound=True):
+    inp = Input(shape=(None,), dtype='uint8')
+    residues = IndexConvolution1D(8, 3, nb_aa=20, activation='relu')(inp)
+    conv = Conv1D(6, 3, padding='same', activation='relu')
+    features = conv(residues)
+    if bound:
+        decoded = Deconvolution1D(conv, activation='sigmoid')(features)
+    else:
+        decoded = Deconvolution1D(filters=8, kernel_size=3, padding='same')(features)
+    dense = Dense(4, activation='tanh')
+    code = dense(GlobalMaxPooling1D()(features))
+    return Model(inputs=inp, outputs=[decoded, Dedense(dense)(code)])
+
+
+def test_export_model(tmpdir):
+    model = tied_model()
+    filepath = str(tmpdir.join('tied.evw'))
+    assert export_model(model, filepath) == len(model.layers)
+
+    rng = np.random.RandomState(0)
+    seqs = [''.join(rng.choice(list('ACDEFGHIKLMNPQRSTVWY'), 15)) for _ in range(5)]
+    decoded, code = load_runtime(filepath).predict(seqs, batch_size=2)
+    assert len(decoded) == len(seqs) and code.shape == (len(seqs), 6)
+    for i, seq in enumerate(seqs):
+        expected = model.predict_on_batch(encode_batch([seq], 20, compact=True))
+        assert decoded[i].shape == expected[0][0].shape == (13, 8)
+        assert np.allclose(decoded[i], expected[0][0], atol=1e-4)
+        assert np.allclose(code[i], expected[1][0], atol=1e-4)
+
+
+def test_export_unbound(tmpdir):
+    # The placeholder kernel of an unbound Deconvolution1D is never exported
+    with pytest.raises(ValueError):
+        export_model(tied_model(bound=False), str(tmpdir.join('unbound.evw')))
@@ -0,0 +1,74 @@
+# coding=utf-8
+"""
+Test of the Evolutron model.
+
+"""
+import pytest
+import numpy as np
+
+keras = pytest.importorskip('keras')
+
+from keras.layers import Dense, GlobalMaxPooling1D, Input
+from evolutron.engine import Model, load_model
+from evolutron.engine.krs import load_weights
+from evolutron.extra_layers import IndexConvolution1D
+
+
+def residue_model():
+    inp = Input(shape=(None,), dtype='uint8')
+    out = IndexConvolution1D(4, 1, nb_aa=20, padding='same')(inp)
+    return Model(inputs=inp, outputs=out)
+
+
+def test_predict_bucketed():
+    model = residue_model()
+    seqs = ['ACDEFGHIKL', 'MKV', 'WYWYWYWYWYWY', 'QQ', 'PPPPPPPPPPPPPPP', 'ST']
+
+    predictions = model.predict_bucketed(seqs, batch_size=2, max_aa=8)
+    for seq, prediction in zip(seqs, predictions):
+        expected = model.predict_bucketed([seq], max_aa=8)[0]
+        assert len(prediction) == min(len(seq), 8)
+        assert np.allclose(prediction, expected)
+
+
+
+def classifier_model():
+    inp = Input(shape=(None,), dtype='uint8')
+    out = Dense(3, activation='softmax')(GlobalMaxPooling1D()(IndexConvolution1D(4, 3, nb_aa=20)(inp)))
+    return Model(inputs=inp, outputs=out)
+
+
+def test_save_mapped(tmpdir):
+    model = classifier_model()
+    model.compile('adam', 'categorical_crossentropy')
+    x = np.random.randint(1, 21, (8, 12)).astype(np.uint8)
+    y = np.eye(3)[np.random.randint(0, 3, 8)]
+    model.train_on_batch(x, y)
+
+    data_dir = str(tmpdir)
+    model.save('mapped', data_dir=data_dir, mapped=True, include_optimizer=True)
+    model.save('plain', data_dir=data_dir, mapped=True)
+    model.save('hdf5', data_dir=data_dir)
+    with pytest.raises(ValueError):
+        model.save('other', data_dir=data_dir, mapped=True, overwrite=True)
+
+    expected = model.predict_on_batch(x)
+    optimizer_weights = keras.backend.batch_get_value(model.optimizer.weights)
+    for name in ('mapped', 'plain', 'hdf5'):
+        filepath = str(tmpdir.join('models', name + '.model'))
+        assert np.allclose(load_model(filepath, compile=False).predict_on_batch(x), expected, atol=1e-6)
+
+        # Compiled models resume training with the saved optimizer state, when it was included
+        loaded = load_model(filepath)
+        assert loaded.loss == 'categorical_crossentropy'
+        loaded_weights = keras.backend.batch_get_value(loaded.optimizer.weights)
+        if name == 'plain':
+            assert not loaded_weights
+        else:
+            assert all(np.allclose(a, b) for a, b in zip(loaded_weights, optimizer_weights))
+        loaded.train_on_batch(x, y)
+
+        # Weights of either format load into a fresh model of the same architecture
+        other = classifier_model()
+        load_weights(other, filepath)
+        assert np.allclose(other.predict_on_batch(x), expected, atol=1e-6)
@@ -0,0 +1,196 @@
+# coding=utf-8
+"""
+Test of the local model server.
+
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+from http.client import HTTPConnection
+
+import pytest
+import numpy as np
+
+keras = pytest.importorskip('keras')
+
+from keras.layers import Dense, GlobalMaxPooling1D, Input
+from evolutron.engine import Model
+from evolutron.engine.krs import save_mapped
+from evolutron.engine.serving import ModelServer, ModelWorker, ServingMetrics
+from evolutron.extra_layers import IndexConvolution1D
+from evolutron.tools.data_tools import encode_batch
+
+SEQS = ['ACDEFGHIKL', 'MKV', 'WYWYWYWYWYWY', 'QQ', 'PPPPPPPPPPPPPPP']
+
+
+def residue_model():
+    inp = Input(shape=(None,), dtype='uint8')
+    out = IndexConvolution1D(4, 3, nb_aa=20, padding='same')(inp)
+    return Model(inputs=inp, outputs=out)
+
+
+def two_output_model():
+    inp = Input(shape=(None,), dtype='uint8')
+    residues = IndexConvolution1D(4, 3, nb_aa=20, padding='same')(inp)
+    pooled = Dense(2)(GlobalMaxPooling1D()(residues))
+    return Model(inputs=inp, outputs=[residues, pooled])
+
+
+def start_worker(filepath, **worker_args):
+    worker = ModelWorker('model', filepath, **worker_args)
+    worker.start()
+    worker.ready.wait()
+    assert worker.error is None
+    return worker
+
+
+def test_serving_metrics():
+    metrics = ServingMetrics(window=3)
+    assert metrics.snapshot()['latency_p99_ms'] == 0.0
+
+    metrics.record_batch([0.001, 0.002])
+    metrics.record_batch([0.004, 0.008], failed=True)
+    metrics.record_reload()
+    stats = metrics.snapshot()
+    assert (stats['requests'], stats['batches'], stats['errors'], stats['reloads']) == (4, 2, 2, 1)
+    assert stats['mean_batch_size'] == 2.0
+    # Only the latest latencies are kept
+    assert stats['latency_p50_ms'] == pytest.approx(4.0)
+
+
+def test_collect():
+    worker = ModelWorker('model', 'unused.model', max_batch_size=3, max_latency=0.05)
+
+    def put(seq, queued=None):
+        worker.requests.put((seq, Future(), time.monotonic() if queued is None else queued))
+
+    for seq in SEQS:
+        put(seq)
+    assert [item[0] for item in worker._collect()] == SEQS[:3]
+    start = time.monotonic()
+    assert [item[0] for item in worker._collect()] == SEQS[3:]
+    assert time.monotonic() - start < 1.0
+
+    # A request that is already due is served without waiting for more
+    put('MKV', queued=time.monotonic() - 1.0)
+    start = time.monotonic()
+    assert len(worker._collect()) == 1
+    assert time.monotonic() - start < 0.04
+
+    # A reload or stop closes the batch gathered so far
+    put('MKV')
+    worker.requests.put(None)
+    put('QQ')
+    assert [item[0] for item in worker._collect()] == ['MKV']
+    assert [item[0] for item in worker._collect()] == ['QQ']
+
+
+def test_model_worker(tmpdir):
+    model = residue_model()
+    filepath = str(tmpdir.join('residue.model'))
+    save_mapped(model, filepath)
+    worker = start_worker(filepath, max_batch_size=2, max_latency=0.01)
+
+    predictions = worker.predict(SEQS, timeout=30)
+    for prediction, expected in zip(predictions, model.predict_bucketed(SEQS)):
+        assert prediction.shape == expected.shape
+        assert np.allclose(prediction, expected, atol=1e-5)
+    assert worker.metrics.snapshot()['requests'] == len(SEQS)
+
+    # New weights are used from the next batch on
+    model.set_weights([2 * w for w in model.get_weights()])
+    doubled = str(tmpdir.join('doubled.model'))
+    save_mapped(model, doubled)
+    assert worker.reload(doubled).result(30) == doubled
+    assert np.allclose(worker.predict(SEQS[:1], timeout=30)[0], model.predict_bucketed(SEQS[:1])[0], atol=1e-5)
+    assert worker.metrics.snapshot()['reloads'] == 1
+
+    with pytest.raises(Exception):
+        worker.reload(str(tmpdir.join('missing.model'))).result(30)
+    assert worker.filepath == doubled
+
+    worker.stop()
+    worker.join(30)
+
+
+def test_model_worker_outputs(tmpdir):
+    model = two_output_model()
+    filepath = str(tmpdir.join('two_outputs.model'))
+    save_mapped(model, filepath)
+    worker = start_worker(filepath, max_batch_size=4)
+
+    for seq, prediction in zip(SEQS[:2], worker.predict(SEQS[:2], timeout=30)):
+        residues, pooled = model.predict_on_batch(encode_batch([seq], 20, True))
+        assert len(prediction) == 2
+        assert prediction[0].shape == (len(seq), 4) and prediction[1].shape == (2,)
+        assert np.allclose(prediction[0], residues[0], atol=1e-5)
+        assert np.allclose(prediction[1], pooled[0], atol=1e-5)
+    worker.stop()
+    worker.join(30)
+
+
+def test_model_worker_stop(tmpdir):
+    filepath = str(tmpdir.join('residue.model'))
+    save_mapped(residue_model(), filepath)
+
+    # Requests still queued when the worker stops are failed instead of left waiting
+    worker = ModelWorker('model', filepath)
+    futures = worker.submit(SEQS)
+    worker.stop()
+    worker.start()
+    worker.join(30)
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(0)
+
+
+def test_model_server(tmpdir):
+    filepath = str(tmpdir.join('residue.model'))
+    save_mapped(residue_model(), filepath)
+    server = ModelServer({'residue': filepath}, port=0, max_latency=0.01)
+    server.start()
+    threading.Thread(target=server.httpd.serve_forever, daemon=True).start()
+
+    def request(method, path, body=None):
+        connection = HTTPConnection(*server.address, timeout=30)
+        data = body if isinstance(body, bytes) or body is None else json.dumps(body).encode('utf-8')
+        connection.request(method, path, body=data)
+        response = connection.getresponse()
+        status, reply = response.status, json.loads(response.read().decode('utf-8'))
+        connection.close()
+        return status, reply
+
+    try:
+        status, reply = request('POST', '/models/residue/predict', {'sequences': SEQS[:2]})
+        assert status == 200
+        assert [len(p) for p in reply['predictions']] == [len(seq) for seq in SEQS[:2]]
+
+        assert request('POST', '/models/missing/predict', {'sequences': SEQS})[0] == 404
+        assert request('POST', '/models/residue/train', {})[0] == 404
+        assert request('GET', '/nowhere')[0] == 404
+        assert request('POST', '/models/residue/predict', b'{"sequences": [')[0] == 400
+        assert request('POST', '/models/residue/predict', {'sequences': 'MKV'})[0] == 400
+        assert request('POST', '/models/residue/predict', {'sequences': [1, 2]})[0] == 400
+
+        status, reply = request('GET', '/metrics')
+        assert status == 200 and reply['residue']['requests'] == 2
+        status, reply = request('GET', '/models')
+        assert status == 200 and reply['residue']['output_shape'] == [None, None, 4]
+    finally:
+        server.httpd.shutdown()
+        server.shutdown()
+
+
+def test_model_server_socket_path(tmpdir):
+    filepath = str(tmpdir.join('residue.model'))
+    save_mapped(residue_model(), filepath)
+
+    # Regular files are never replaced by the server socket
+    socket_path = str(tmpdir.join('server.sock'))
+    with open(socket_path, 'w') as f:
+        f.write('data')
+    with pytest.raises(IOError):
+        ModelServer({'residue': filepath}, socket_path=socket_path)
+    assert os.path.exists(socket_path)
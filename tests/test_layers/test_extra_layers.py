@@ -0,0 +1,47 @@
+# coding=utf-8
+"""
+Test of the Evolutron layers.
+
+"""
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+
+keras = pytest.importorskip('keras')
+
+import keras.backend as K  # noqa: E402
+from keras.layers import Conv1D, Input  # noqa: E402
+from keras.models import Model  # noqa: E402
+from evolutron.extra_layers import IndexConvolution1D  # noqa: E402
+from evolutron.tools.seq_tools import idx2hot  # noqa: E402
+
+
+@pytest.mark.parametrize('padding,dilation_rate', [('valid', 1), ('same', 1), ('causal', 1), ('same', 2),
+                                                   ('causal', 3)])
+def test_index_convolution(tmpdir, padding, dilation_rate):
+    # Residues, ambiguous residues (X, B, Z, J) and padding at the end of the first row
+    x_idx = np.random.RandomState(0).randint(1, 25, (4, 17)).astype(np.uint8)
+    x_idx[0, 12:] = 0
+
+    hot_input = Input(shape=(None, 20))
+    hot_model = Model(inputs=hot_input, outputs=Conv1D(5, 3, padding=padding, dilation_rate=dilation_rate,
+                                                       activation='relu')(hot_input))
+    idx_input = Input(shape=(None,), dtype='uint8')
+    layer = IndexConvolution1D(5, 3, nb_aa=20, padding=padding, dilation_rate=dilation_rate, activation='relu')
+    idx_model = Model(inputs=idx_input, outputs=layer(idx_input))
+
+    # Weights saved from a Conv1D first layer load unchanged
+    filepath = str(tmpdir.join('conv.h5'))
+    hot_model.save_weights(filepath)
+    idx_model.load_weights(filepath)
+    for a, b in zip(idx_model.get_weights(), hot_model.get_weights()):
+        assert_allclose(a, b)
+
+    assert_allclose(idx_model.predict(x_idx), hot_model.predict(idx2hot(x_idx, 20)), rtol=1e-5, atol=1e-5)
+
+    # Index 0 is masked when the output is aligned with the input
+    mask = layer.compute_mask(K.constant(x_idx, dtype='int32'))
+    if padding == 'same':
+        assert np.array_equal(K.eval(mask), x_idx != 0)
+    else:
+        assert mask is None
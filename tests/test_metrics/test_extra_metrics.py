@@ -1,7 +1,87 @@
-#
-#
-#
-# def test_mean_cat_acc():
-#
-#     a =
-#     K.function( )
\ No newline at end of file
+# coding=utf-8
+"""
+Test of the per-residue metrics and losses on packed and padded batches.
+
+"""
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+
+keras = pytest.importorskip('keras')
+
+import keras.backend as K  # noqa: E402
+from sklearn import metrics  # noqa: E402
+from evolutron.extra_layers import SegmentMasking  # noqa: E402
+from evolutron.extra_metrics import micro_precision, multiclass_precision, multiclass_recall  # noqa: E402
+from evolutron.extra_objectives import masked_categorical_crossentropy, residue_mask  # noqa: E402
+from evolutron.tools.data_tools import pack_batch, pad_to_length  # noqa: E402
+
+
+def samples(lengths=(3, 2, 4), nb_categories=8, seed=0):
+    rng = np.random.RandomState(seed)
+    y_true = [np.eye(nb_categories, dtype=np.float32)[rng.randint(0, nb_categories, n)] for n in lengths]
+    y_pred = [rng.dirichlet(np.ones(nb_categories), n).astype(np.float32) for n in lengths]
+    return y_true, y_pred
+
+
+def packed_and_padded(y_true, y_pred):
+    rng = np.random.RandomState(1)
+    lengths = [len(y) for y in y_true]
+    row_len = max(lengths[0] + lengths[1] + 2, lengths[2]) + 1
+    packed_true, segment_ids = pack_batch([y_true[:2], y_true[2:]], row_len=row_len, gap=2)
+    packed_pred, _ = pack_batch([y_pred[:2], y_pred[2:]], row_len=row_len, gap=2)
+    padded_true = pad_to_length(y_true, max(lengths) + 1)
+    padded_pred = pad_to_length(y_pred, max(lengths) + 1)
+
+    # Predictions on padding and gaps are arbitrary and must not count
+    packed_pred[segment_ids == 0] = rng.dirichlet(np.ones(8), (segment_ids == 0).sum())
+    is_pad = ~padded_true.any(-1)
+    padded_pred[is_pad] = rng.dirichlet(np.ones(8), is_pad.sum())
+    return (packed_true, packed_pred, segment_ids), (padded_true, padded_pred)
+
+
+def test_residue_mask():
+    y_true, y_pred = samples()
+    (packed_true, _, segment_ids), _ = packed_and_padded(y_true, y_pred)
+    assert np.array_equal(K.eval(residue_mask(K.constant(packed_true))), segment_ids > 0)
+
+
+def test_masked_categorical_crossentropy():
+    y_true, y_pred = samples()
+    (packed_true, packed_pred, segment_ids), (padded_true, padded_pred) = packed_and_padded(y_true, y_pred)
+    expected = sum(-np.sum(t * np.log(p)) for t, p in zip(y_true, y_pred))
+
+    # Row means over the real residues, weighted back by their counts, give the loss of every residue once
+    packed = K.eval(masked_categorical_crossentropy(K.constant(packed_true), K.constant(packed_pred)))
+    padded = K.eval(masked_categorical_crossentropy(K.constant(padded_true), K.constant(padded_pred)))
+    assert_allclose(np.sum(packed * (segment_ids > 0).sum(-1)), expected, rtol=1e-4)
+    assert_allclose(np.sum(padded * padded_true.any(-1).sum(-1)), expected, rtol=1e-4)
+
+
+def test_class_metrics():
+    y_true, y_pred = samples(lengths=(30, 20, 40))
+    (packed_true, packed_pred, _), (padded_true, padded_pred) = packed_and_padded(y_true, y_pred)
+    labels = np.concatenate(y_true).argmax(-1)
+    predictions = np.concatenate(y_pred).argmax(-1)
+
+    for y_t, y_p in [(packed_true, packed_pred), (padded_true, padded_pred)]:
+        y_t, y_p = K.constant(y_t), K.constant(y_p)
+        assert_allclose(K.eval(micro_precision(y_t, y_p)), metrics.precision_score(labels, predictions,
+                                                                                    average='micro'), rtol=1e-4)
+        precision = multiclass_precision(y_t, y_p)
+        recall = multiclass_recall(y_t, y_p)
+        for i in range(8):
+            true_positives = np.sum((predictions == i) & (labels == i))
+            assert_allclose(K.eval(precision['p_%d' % i]), true_positives / max(np.sum(predictions == i), 1e-7),
+                            rtol=1e-4, atol=1e-6)
+            assert_allclose(K.eval(recall['r_%d' % i]), true_positives / max(np.sum(labels == i), 1e-7),
+                            rtol=1e-4, atol=1e-6)
+
+
+def test_segment_masking():
+    x = np.random.rand(2, 8, 3).astype(np.float32)
+    segment_ids = np.array([[1, 1, 0, 0, 2, 2, 2, 0], [1, 1, 1, 1, 0, 0, 0, 0]], dtype=np.int32)
+    layer = SegmentMasking()
+    inputs = [K.constant(x), K.constant(segment_ids, dtype='int32')]
+    assert_allclose(K.eval(layer(inputs)), x * (segment_ids > 0)[..., np.newaxis])
+    assert np.array_equal(K.eval(layer.compute_mask(inputs)), segment_ids > 0)
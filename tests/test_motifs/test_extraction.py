@@ -0,0 +1,39 @@
+# coding=utf-8
+"""
+Test of motif extraction.
+
+"""
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+pytest.importorskip('weblogolib')
+from evolutron.motifs import motif_extraction  # noqa: E402
+from evolutron.tools import aa_map  # noqa: E402
+from evolutron.tools.shard_tools import ShardSequence, write_shards  # noqa: E402
+
+
+def w_window_scores(inputs):
+    # One filter that counts the W residues of every window of 4 residues
+    w = inputs[0][..., aa_map['W']]
+    scores = sum(np.pad(w, [(0, 0), (0, 3)], mode='constant')[:, k:k + w.shape[1]] for k in range(4))
+    return scores[np.newaxis, ..., np.newaxis]
+
+
+@pytest.mark.parametrize('expand', [True, False])
+def test_motif_extraction_shards(tmpdir, expand):
+    rng = np.random.RandomState(0)
+    seqs = [''.join(rng.choice(list('ACDEFGHIKLMNPQRSTVY'), 30)) for _ in range(30)]
+    seqs[7] = seqs[7][:5] + 'WWWW' + seqs[7][9:]
+    write_shards(seqs, str(tmpdir.join('shards')), shard_size=10, max_aa=30)
+
+    # Compact shards read without expansion are expanded for scoring and decoding
+    x_data = ShardSequence(str(tmpdir.join('shards')), shuffle=False, expand=expand, targets=False)
+    output = str(tmpdir.join('motifs'))
+    motif_extraction(w_window_scores, x_data, filters=1, kernel_size=4, output_foldername=output, depth=0,
+                     filetype='txt')
+
+    with open(os.path.join(output, '1', '0_1.txt')) as f:
+        assert f.read().split() == ['WWWW']
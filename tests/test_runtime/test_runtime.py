@@ -0,0 +1,70 @@
+# coding=utf-8
+"""
+Test of the NumPy inference runtime.
+
+"""
+import numpy as np
+from evolutron import runtime
+from evolutron.tools.seq_tools import aa_index_table, idx_hot_table
+
+
+def reference_conv1d(x, kernel, padding):
+    size = kernel.shape[0]
+    pad = {'valid': (0, 0), 'same': ((size - 1) // 2, size // 2), 'causal': (size - 1, 0)}[padding]
+    x = np.pad(x, [(0, 0), pad, (0, 0)], mode='constant')
+    return np.stack([sum(x[:, i + k] @ kernel[k] for k in range(size)) for i in range(x.shape[1] - size + 1)], 1)
+
+
+def test_conv1d():
+    x = np.random.rand(5, 23, 4).astype(np.float32)
+    kernel = np.random.rand(3, 4, 6).astype(np.float32)
+
+    for padding in ('valid', 'same', 'causal'):
+        assert np.allclose(runtime.conv1d(x, kernel, padding=padding), reference_conv1d(x, kernel, padding),
+                           atol=1e-4)
+    assert runtime.conv1d(x, kernel, strides=2, padding='same').shape == (5, 12, 6)
+
+    # Residue indices give the same output as their one-hot vectors
+    table = idx_hot_table(20)
+    indices = np.random.randint(0, len(table), (4, 17))
+    kernel = np.random.rand(5, 20, 6).astype(np.float32)
+    taps = np.einsum('ia,kaf->kif', table, kernel)
+    assert np.allclose(runtime.index_conv1d(indices, taps, padding='same', dilation=2),
+                       runtime.conv1d(table[indices], kernel, padding='same', dilation=2), atol=1e-4)
+
+
+def test_numpy_model(tmpdir):
+    kernel = np.random.rand(3, 20, 8).astype(np.float32)
+    dense = np.random.rand(40, 4).astype(np.float32)
+    layers = [{'name': 'input', 'type': 'input', 'inbound': []},
+              {'name': 'conv', 'type': 'conv1d', 'inbound': ['input'], 'weights': {'kernel': 'conv/kernel'},
+               'config': {'strides': 1, 'padding': 'same', 'dilation_rate': 1, 'activation': 'relu'}},
+              {'name': 'deconv', 'type': 'conv1d', 'inbound': ['conv'], 'weights': {'kernel': 'deconv/kernel'},
+               'config': {'strides': 1, 'padding': 'same', 'dilation_rate': 1, 'activation': 'softmax'}},
+              {'name': 'pool', 'type': 'max_pool1d', 'inbound': ['conv'],
+               'config': {'pool_size': 2, 'strides': 2, 'padding': 'valid'}},
+              {'name': 'flat', 'type': 'flatten', 'inbound': ['pool']},
+              {'name': 'dense', 'type': 'dense', 'inbound': ['flat'], 'weights': {'kernel': 'dense/kernel'},
+               'config': {'activation': 'softmax'}}]
+    arrays = {'conv/kernel': kernel, 'deconv/kernel': kernel.transpose(0, 2, 1), 'dense/kernel': dense,
+              'index_table': aa_index_table(20), 'hot_table': idx_hot_table(20)}
+    header = {'format': 'runtime', 'name': 'model', 'inputs': ['input'], 'outputs': ['dense', 'deconv'],
+              'input_shapes': [[None, 10, 20]], 'compact': False, 'nb_aa': 20, 'layers': layers}
+    filename = str(tmpdir.join('model.evw'))
+    runtime.write_weight_file(filename, header, arrays)
+
+    model = runtime.load_runtime(filename)
+    assert all(a.ctypes.data % runtime.ALIGNMENT == 0 for a in model.arrays.values())
+
+    seqs = ['MKVLA', 'ACDEFGHIKLMN', 'Q']
+    x = model.encode(seqs)
+    assert x.shape == (3, 10, 20) and x[0, :5].sum() == 5 and not x[0, 5:].any()
+
+    conv = np.maximum(reference_conv1d(x, kernel, 'same'), 0)
+    logits = conv.reshape(3, 5, 2, 8).max(2).reshape(3, -1) @ dense
+    expected = np.exp(logits) / np.exp(logits).sum(1, keepdims=True)
+
+    probs, decoded = model.predict(seqs, batch_size=2)
+    assert np.allclose(probs, expected, atol=1e-4)
+    assert [len(d) for d in decoded] == [5, 10, 1]
+    assert np.allclose(model.predict(x)[0], expected, atol=1e-4)
@@ -0,0 +1,91 @@
+# coding=utf-8
+"""
+Test of the parse cache.
+
+"""
+import os
+import shutil
+
+import numpy as np
+import pytest
+from evolutron.tools import io_tools as io
+from evolutron.tools.cache_tools import cache_entries, cache_key, cached_file, cached_parse, evict
+
+
+def test_cached_parse(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    filename = str(tmpdir.join('sample.fasta'))
+    shutil.copy('tests/test_tools/samples/type2p_codes.fasta', filename)
+
+    calls = []
+
+    def fasta_parser(*args, **kwargs):
+        calls.append(1)
+        return io.fasta_parser(*args, **kwargs)
+
+    x_data, y_data = cached_parse(fasta_parser, filename, cache_dir=cache_dir, codes=True, code_key='type2p')
+    x_cached, y_cached = cached_parse(fasta_parser, filename, cache_dir=cache_dir, codes=True, code_key='type2p')
+    assert len(calls) == 1
+    assert x_cached.equals(x_data) and x_cached.name == 'sequence'
+    assert all(np.array_equal(a, b) for a, b in zip(y_cached, y_data))
+
+    # Other options and modified sources are parsed again
+    cached_parse(fasta_parser, filename, cache_dir=cache_dir, codes=False)
+    assert len(calls) == 2
+    os.utime(filename, (0, 0))
+    cached_parse(fasta_parser, filename, cache_dir=cache_dir, codes=False)
+    assert len(calls) == 3
+
+    # Secondary structure labels are ragged arrays
+    x_data, y_data = cached_parse(io.secs_parser, 'tests/test_tools/samples/smallSecS.sec', cache_dir=cache_dir)
+    _, y_cached = cached_parse(io.secs_parser, 'tests/test_tools/samples/smallSecS.sec', cache_dir=cache_dir)
+    assert all(np.array_equal(a, b) for a, b in zip(y_cached, y_data))
+
+    entries = sorted(cache_entries(cache_dir))
+    assert len(entries) == 4
+    assert evict(cache_dir, max_bytes=entries[-1][1]) == 3
+    assert [e[2] for e in cache_entries(cache_dir)] == [entries[-1][2]]
+
+
+def test_cache_versions(tmpdir, cache_dir):
+    filename = str(tmpdir.join('sample.fasta'))
+    shutil.copy('tests/test_tools/samples/type2p_codes.fasta', filename)
+
+    calls = []
+
+    def fasta_parser(*args, **kwargs):
+        calls.append(1)
+        return io.fasta_parser(*args, **kwargs)
+
+    cached_parse(fasta_parser, filename, version=1, codes=False)
+    cached_parse(fasta_parser, filename, version=1, codes=False)
+    assert len(calls) == 1
+    cached_parse(fasta_parser, filename, version=2, codes=False)
+    assert len(calls) == 2
+    assert len(list(cache_entries(cache_dir))) == 2
+
+
+def test_cached_file(tmpdir, cache_dir):
+    filename = str(tmpdir.join('source.txt'))
+    with open(filename, 'w') as f:
+        f.write('x' * 1000)
+
+    def build(path):
+        shutil.copy(filename, path)
+
+    # The fresh entry is kept even when it alone exceeds the size limit
+    path = cached_file(cache_key(filename, 'copy'), 'copy.txt', build, max_bytes=10)
+    assert os.path.exists(path)
+    path = cached_file(cache_key(filename, 'copy', version=1), 'copy.txt', build, max_bytes=10)
+    assert os.path.exists(path)
+    assert len(list(cache_entries(cache_dir))) == 1
+
+    # Failed builds leave no temporary entries behind
+    def failing_build(path):
+        with open(path, 'w') as f:
+            f.write('partial')
+        raise RuntimeError('build failed')
+
+    with pytest.raises(RuntimeError):
+        cached_file(cache_key(filename, 'fail'), 'fail.txt', failing_build)
+    assert not [name for name in os.listdir(cache_dir) if name.startswith('.tmp')]
@@ -5,7 +5,9 @@ Test of loading datasets.
 """
 import pytest
 import numpy as np
-from evolutron.tools import load_dataset
+from evolutron.tools import aa2hot, hot2aa, load_dataset, load_random_aa_seqs, preprocess_dataset
+from evolutron.tools.data_tools import (bucket_batch_generator, bucket_batches, encode_batch, hot_batch_generator,
+                                        pack_sequences, packed_batch_generator, prefetch, stream_batches, unpack_batch)
 
 
 def test_load_dataset():
@@ -32,3 +34,146 @@ def test_file_db():
     for data_id in ['random', 'type2p', 'ecoli']:
         print('\nDataset: {} '.format(data_id))
         _, _ = load_dataset(data_id, padded=True, max_aa=1000)
+
+
+def test_compact_dataset():
+    x_raw = load_random_aa_seqs(20, min_length=10, max_length=50)
+
+    x_hot = preprocess_dataset(x_raw, max_aa=60)
+    x_idx = preprocess_dataset(x_raw, max_aa=60, compact=True)
+    assert x_idx.dtype == np.uint8
+    assert x_idx.shape == x_hot.shape[:2]
+
+    y = np.arange(20)
+    x_batch, y_batch = next(hot_batch_generator(x_idx, y, batch_size=8, shuffle=False))
+    np.testing.assert_array_equal(x_batch, x_hot[:8])
+    np.testing.assert_array_equal(y_batch, y[:8])
+
+    weights = np.random.rand(len(y))
+    # Weights follow their samples through the shuffle
+    _, y_batch, w_batch = next(hot_batch_generator(x_idx, y, batch_size=8, shuffle=True, sample_weight=weights))
+    np.testing.assert_array_equal(w_batch, weights[y_batch])
+
+
+def test_bucket_batch_generator():
+    x_raw = load_random_aa_seqs(50, min_length=10, max_length=300).tolist()
+    y = np.arange(50)
+
+    batches = bucket_batches([len(x) for x in x_raw], batch_size=8)
+    assert sorted(np.concatenate(batches)) == list(range(50))
+
+    seen = []
+    for x_batch, y_batch in bucket_batch_generator(x_raw, y, batch_size=8, loop=False):
+        assert x_batch.shape[1] == max(len(x_raw[i]) for i in y_batch)
+        assert len(x_batch) == len(y_batch)
+        seen += y_batch.tolist()
+    assert sorted(seen) == list(range(50))
+
+    # Without shuffling, the first batch holds the shortest sequences, clipped to max_aa
+    x_batch = next(bucket_batch_generator(x_raw, batch_size=8, compact=True, max_aa=5, shuffle=False))
+    assert x_batch.dtype == np.uint8 and x_batch.shape == (8, 5)
+    shortest = np.argsort([len(x) for x in x_raw], kind='mergesort')[:8]
+    np.testing.assert_array_equal(x_batch, encode_batch([x_raw[i][:5] for i in shortest], 20, compact=True))
+
+
+def test_stream_batches():
+    x_raw = load_random_aa_seqs(50, min_length=10, max_length=300).tolist()
+    y = [np.full(len(x), i % 8) for i, x in enumerate(x_raw)]
+
+    seen = []
+    for excerpt, x_batch, y_batch in prefetch(stream_batches(x_raw, y, batch_size=8, window=20, pad_y_data=True,
+                                                             nb_categories=8), max_queue_size=2):
+        assert excerpt.max() - excerpt.min() < 20
+        assert x_batch.shape[:2] == y_batch.shape[:2] and y_batch.shape[2] == 8
+        seen += excerpt.tolist()
+    assert sorted(seen) == list(range(50))
+
+    _, x_batch, _ = next(stream_batches(x_raw, compact=True, max_aa=20, length=30))
+    assert x_batch.shape[1] == 30 and not x_batch[:, 20:].any()
+
+    def failing():
+        yield np.zeros((2, 3))
+        raise RuntimeError
+    with pytest.raises(RuntimeError):
+        list(prefetch(stream_batches(failing())))
+
+
+def test_packed_batch_generator():
+    x_raw = load_random_aa_seqs(100, min_length=10, max_length=300).tolist()
+    y = [np.ones((len(x), 8), dtype=np.float32) for x in x_raw]
+
+    rows = pack_sequences([len(x) for x in x_raw], row_len=600, gap=4)
+    assert sorted(np.concatenate(rows)) == list(range(100))
+
+    segments = []
+    for (x_batch, seg_batch), y_batch in packed_batch_generator(x_raw, y, row_len=600, batch_size=16, gap=4,
+                                                                shuffle=False, loop=False):
+        assert x_batch.shape[1:] == (600, 20) and y_batch.shape[1:] == (600, 8)
+        np.testing.assert_array_equal(seg_batch > 0, x_batch.any(-1))
+        np.testing.assert_array_equal(seg_batch > 0, y_batch.any(-1))
+        segments += unpack_batch(x_batch, seg_batch)
+
+    order = np.concatenate(rows)
+    assert [hot2aa(x) for x in segments] == [x_raw[i] for i in order]
+
+    with pytest.raises(ValueError):
+        next(packed_batch_generator(x_raw, y, row_len=600))
+
+
+def test_preprocess_dataset():
+    x_raw = load_random_aa_seqs(30, min_length=10, max_length=80)
+    y = [np.ones((len(x), 3)) for x in x_raw]
+
+    x_data, y_data = preprocess_dataset(x_raw, y, pad_y_data=True, max_aa=80, min_aa=90, chunk_size=7)
+    assert x_data.shape == (30, 90, 20) and x_data.dtype == np.float32
+    assert y_data.shape == (30, 90, 3)
+    for i, x in enumerate(x_raw):
+        np.testing.assert_array_equal(x_data[i, :len(x)], aa2hot(x))
+        assert not x_data[i, len(x):].any()
+        assert y_data[i].sum() == 3 * len(x)
+
+    x_data = preprocess_dataset(x_raw, max_aa=50, dtype=np.float16)
+    assert x_data.shape == (30, 50, 20) and x_data.dtype == np.float16
+
+
+def test_load_datasets(tmpdir):
+    from evolutron.tools import io_tools as io
+
+    records = list(io.fasta_records('tests/test_tools/samples/type2p_codes.fasta'))
+    for k in range(4):
+        with open(str(tmpdir.join('part{}.fasta'.format(k))), 'w') as f:
+            f.writelines('>{0}\n{1}\n'.format(r[1], r[2]) for r in records[4 * k:4 * (k + 1)])
+
+    x_data, y_data = load_dataset(str(tmpdir.join('part*.fasta')), processes=2, cache=False)
+    assert x_data.tolist() == [r[2] for r in records]
+    assert x_data.index.tolist() == list(range(len(records)))
+
+    files = [str(tmpdir.join('part{}.fasta'.format(k))) for k in (3, 0)]
+    x_data, _ = load_dataset(files, output=str(tmpdir.join('merged.rgd')), processes=2)
+    assert len(x_data) == 8
+    assert x_data[0] == records[12][2] and x_data[4] == records[0][2]
+    x_data.close()
+
+    # Record ids are looked up in every file
+    ids = [records[13][0], records[1][0], records[2][0]]
+    x_data, _ = load_dataset(files, ids=ids, processes=1, cache=False)
+    assert x_data.tolist() == [records[13][2], records[1][2], records[2][2]]
+    with pytest.raises(ValueError):
+        load_dataset(files, ids=[0, 1], processes=1, cache=False)
+    with pytest.raises(KeyError):
+        load_dataset(files, ids=[records[5][0]], processes=1, cache=False)
+
+    # Per-residue targets are stored as residue labels, whatever their lengths
+    sec_files = ['tests/test_tools/samples/smallSecS.sec'] * 2
+    _, y_raw = load_dataset(sec_files[0], cache=False)
+    x_data, y_data = load_dataset(sec_files, output=str(tmpdir.join('secs.rgd')), processes=1, cache=False)
+    assert len(y_data) == 2 * len(y_raw)
+    assert all(np.array_equal(a, b) for a, b in zip(y_data, y_raw + y_raw))
+    x_data.close()
+
+
+def test_load_dataset_npz(tmpdir):
+    filename = str(tmpdir.join('sample.npz'))
+    np.savez(filename, data=np.zeros((2, 700 * 57), dtype=np.float32))
+    with pytest.raises(NotImplementedError):
+        load_dataset(filename)
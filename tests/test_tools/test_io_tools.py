@@ -4,6 +4,8 @@ import os
 import pandas as pd
 
 from evolutron.tools import io_tools as io
+from evolutron.tools import load_dataset, preprocess_dataset
+from evolutron.tools.ragged_tools import write_ragged
 
 
 # noinspection PyTypeChecker
@@ -28,6 +30,80 @@ def test_fasta_parser():
     assert type(y_data) == list
 
 
+def test_fasta_records():
+    filename = 'tests/test_tools/samples/type2p_codes.fasta'
+    records = list(io.fasta_records(filename))
+
+    assert records[0][:2] == ('TspMI', 'TspMI CCCGGG')
+    assert list(io.fasta_records(filename, chunk_size=37)) == records
+    assert sum(map(len, io.fasta_batches(filename, batch_size=5))) == len(records)
+
+    ids, x_batch, lengths = next(io.fasta_encoded_batches(filename, batch_size=4))
+    assert ids == [r[0] for r in records[:4]]
+    assert x_batch.shape == (4, max(lengths))
+    assert lengths.tolist() == [len(r[2]) for r in records[:4]]
+
+
+def test_indexed_fasta(tmpdir):
+    filename = str(tmpdir.join('sample.fasta'))
+    with open('tests/test_tools/samples/type2p_codes.fasta') as f, open(filename, 'w') as out:
+        out.write(f.read())
+    records = list(io.fasta_records(filename))
+
+    with io.IndexedFasta(filename) as fasta:
+        assert len(fasta) == len(records)
+        assert fasta[3] == records[3]
+        assert fasta[records[-1][0]] == records[-1]
+        assert fasta.fetch([records[5][0], 1]) == [records[5], records[1]]
+
+    x_data, _ = load_dataset(filename, ids=[records[2][0], records[0][0]])
+    assert x_data.tolist() == [records[2][2], records[0][2]]
+
+
+def test_fasta_leading_text(tmpdir):
+    filename = str(tmpdir.join('commented.fasta'))
+    with open('tests/test_tools/samples/type2p_codes.fasta') as f, open(filename, 'w') as out:
+        out.write('\n; exported sites\n;>not a record\n' + f.read())
+    records = list(io.fasta_records('tests/test_tools/samples/type2p_codes.fasta'))
+
+    for chunk_size in [4, 37, 1 << 20]:
+        assert list(io.fasta_records(filename, chunk_size=chunk_size)) == records
+    assert sum(map(len, io.fasta_batches(filename, batch_size=5))) == len(records)
+    with io.IndexedFasta(filename) as fasta:
+        assert len(fasta) == len(records)
+        assert fasta[0] == records[0] and fasta[records[-1][0]] == records[-1]
+
+
+def test_compressed_inputs(tmpdir):
+    import gzip
+    import lzma
+    from Bio import bgzf
+
+    with open('tests/test_tools/samples/type2p_codes.fasta', 'rb') as f:
+        data = f.read()
+    records = list(io.fasta_records('tests/test_tools/samples/type2p_codes.fasta'))
+
+    for suffix, opener in [('gz', gzip.open), ('xz', lzma.open), ('bgz', bgzf.BgzfWriter)]:
+        filename = str(tmpdir.join('sample.fasta.' + suffix))
+        with opener(filename, 'wb') as out:
+            out.write(data)
+        assert io.file_type(filename) == 'fasta'
+        x_data, _ = load_dataset(filename)
+        assert x_data.tolist() == [r[2] for r in records]
+
+    with io.IndexedFasta(filename) as fasta:
+        assert fasta[records[4][0]] == records[4]
+
+    with pytest.raises(ValueError):
+        io.IndexedFasta(str(tmpdir.join('sample.fasta.gz')))
+
+    filename = str(tmpdir.join('sample.tsv.gz'))
+    with open('tests/test_tools/samples/sample.tsv', 'rb') as f, gzip.open(filename, 'wb') as out:
+        out.write(f.read())
+    x_data, _ = io.csv_parser(filename)
+    assert len(x_data) > 0
+
+
 def test_tab_parser():
 
     x_data, y_data = io.csv_parser('tests/test_tools/samples/sample.tsv', codes=False)
@@ -45,8 +121,59 @@ def test_tab_parser():
     assert type(x_data) == pd.Series
     assert not y_data
 
-    # Cleaning up
-    os.remove('tests/test_tools/samples/sample.h5')
+
+def test_tsv_to_hdf(tmpdir):
+    import numpy as np
+
+    h5_file = str(tmpdir.join('sample.h5'))
+    nb_rows = io.tsv_to_hdf('tests/test_tools/samples/sample.tsv', h5_file, chunksize=4)
+
+    raw_data = pd.read_csv('tests/test_tools/samples/sample.tsv', sep='\t')
+    assert nb_rows == len(raw_data)
+
+    table = pd.read_hdf(h5_file, 'raw_data')
+    assert table.sequence.tolist() == raw_data.Sequence.tolist()
+    assert table.loc[0, 'fam'] == 'P53 family'
+
+    short = pd.read_hdf(h5_file, 'raw_data', where='length < 500', columns=['entry'])
+    assert short.entry.tolist() == raw_data.Entry[raw_data.Length < 500].tolist()
+
+    # Longer values in later chunks fit, numeric columns stay numeric, and failed ingestions leave no store behind
+    sorted_file = str(tmpdir.join('sorted.tsv'))
+    raw_data['Mass'] = raw_data.Length * 110
+    raw_data['Code'] = ['A'] * 10 + list(range(len(raw_data) - 10))
+    raw_data.sort_values('Length').to_csv(sorted_file, sep='\t', index=False)
+    io.tsv_to_hdf(sorted_file, h5_file, chunksize=5)
+    table = pd.read_hdf(h5_file, 'raw_data')
+    assert table.sequence.str.len().max() == raw_data.Length.max()
+    assert table.mass.dtype == np.float64 and table.mass.tolist() == sorted(raw_data.Mass)
+    assert table.code.dtype == object and table.code.map(type).eq(str).all()
+
+    with pytest.raises(ValueError):
+        io.tsv_to_hdf(sorted_file, str(tmpdir.join('bad.h5')), chunksize=5, min_itemsize={'sequence': 10})
+    assert not os.path.exists(str(tmpdir.join('bad.h5')))
+
+
+def test_h5_parser(tmpdir):
+    h5_file = str(tmpdir.join('sample.h5'))
+    io.tsv_to_hdf('tests/test_tools/samples/sample.tsv', h5_file, chunksize=4)
+
+    x_data, y_data = io.h5_parser(h5_file, y_codes='fam')
+    assert type(x_data) == pd.Series and len(x_data) == len(y_data)
+
+    x_data, y_data = io.h5_parser(h5_file, y_codes='fam', min_length=300, max_length=1000)
+    assert x_data.str.len().between(300, 1000).all()
+
+    x_data, y_data = io.h5_parser(h5_file, y_codes=['fam', 'sup'], families=['P53 family', 'Hedgehog family'])
+    assert sorted(y_data[0]) == ['Hedgehog family', 'P53 family']
+
+    chunks = list(io.h5_parser(h5_file, y_codes='fam', chunksize=5))
+    assert sum(len(x) for x, _ in chunks) == 19
+
+    x_data, y_data = load_dataset(h5_file, y_codes='fam')
+    assert len(x_data) == len(y_data) == 19
+    with pytest.raises(ValueError):
+        load_dataset(h5_file, y_codes='fam', chunksize=5)
 
 
 def test_secs_parser():
@@ -58,7 +185,153 @@ def test_secs_parser():
     os.remove('tests/test_tools/samples/smallSecS.h5')
 
 
+def test_secs_to_ragged(tmpdir):
+    import numpy as np
+    from evolutron.tools.seq_tools import labels2hot
+
+    sample = 'tests/test_tools/samples/smallSecS.sec'
+    x_data, y_data = io.secs_parser(sample)
+
+    filename = str(tmpdir.join('secs.rgd'))
+    assert io.secs_to_ragged([sample, sample], filename, processes=2, chunk_size=50) == 2 * len(x_data)
+    x_store, y_store = load_dataset(filename, y_codes='secs')
+    assert x_store[len(x_data) + 3] == x_data[3]
+    assert np.array_equal(labels2hot(y_store[len(x_data) + 3], 8), y_data[3])
+    x_store.close()
+    _, ids = load_dataset(filename, y_codes='id')
+    assert list(ids[:len(x_data)]) == list(ids[len(x_data):])
+    assert not [name for name in os.listdir(str(tmpdir)) if name.startswith('.tmp')]
+
+    with open(sample) as f:
+        malformed = f.read().replace('>102L:A:secstr', '>103L:A:secstr', 1)
+    with open(str(tmpdir.join('bad.sec')), 'w') as f:
+        f.write(malformed)
+    with pytest.raises(ValueError):
+        io.secs_parser(str(tmpdir.join('bad.sec')))
+    with pytest.warns(UserWarning):
+        x_valid, _ = io.secs_parser(str(tmpdir.join('bad.sec')), errors='skip')
+    assert len(x_valid) == len(x_data) - 1
+
+
 def test_npz_parser():
     x_data, y_data = io.npz_parser('/data/datasets/cb513+profile_split1.npy.gz')
 
     assert x_data, y_data
+
+
+def test_ragged_store(tmpdir):
+    filename = str(tmpdir.join('sample.rgd'))
+    seqs = ['MKV', 'ACDEFGHIKLMNPQRSTVWY', 'MX']
+    write_ragged(filename, seqs, labels={'fam': ['a', 'b', 'a'], 'size': [3, 20, 2]},
+                 residue_labels={'secs': [[0, 1, 2], list(range(20)), [5, 5]]})
+
+    x_data, y_data = load_dataset(filename, y_codes='fam')
+    assert len(x_data) == 3
+    assert x_data[1] == seqs[1] and x_data[-1] == seqs[-1]
+    assert list(y_data) == ['a', 'b', 'a']
+    assert x_data.lengths.tolist() == [3, 20, 2]
+    assert x_data.residue_label('secs', 2).tolist() == [5, 5]
+
+    batch = x_data.batch([2, 0], max_len=10)
+    assert batch.shape == (2, 3)
+    assert batch[0, 2] == 0
+    assert x_data.batch([0, 1]).shape == (2, 20)
+
+    x_pad = preprocess_dataset(x_data, max_aa=5, compact=True)
+    assert x_pad[0].tolist() == x_data.codes(0).tolist() + [0, 0]
+    x_data.close()
+
+    # Residues outside the alphabet are read back as X, and padding stays 0
+    write_ragged(filename, ['MUV', 'OK'])
+    with io.RaggedStore(filename) as x_data:
+        assert x_data[:] == ['MXV', 'XK']
+        batch = x_data.batch([1, 0])
+        assert batch.shape == (2, 3) and batch[0, 2] == 0
+
+
+def test_npz_parser_lazy(tmpdir):
+    import gzip
+    import numpy as np
+
+    raw = np.random.rand(4, 700 * 57).astype(np.float32)
+    filename = str(tmpdir.join('sample.npy.gz'))
+    with gzip.open(filename, 'wb') as f:
+        np.save(f, raw)
+
+    x_data, y_data = io.npz_parser(filename, pssm=True, codon_table=True)
+    x_lazy, y_lazy = io.npz_parser(filename, pssm=True, codon_table=True, lazy=True)
+    assert x_lazy.shape == x_data.shape == (4, 700, 108)
+    assert np.array_equal(x_lazy[[0, 2]], x_data[[0, 2]])
+    assert np.array_equal(y_lazy, y_data)
+
+    x_view, _ = io.npz_parser(filename, lazy=True)
+    assert isinstance(x_view, np.memmap) and x_view.shape == (4, 700, 22)
+
+
+def test_npz_parser_compact(tmpdir):
+    import gzip
+    import numpy as np
+
+    # Two proteins of lengths 3 and 5, padded with NoSeq residues
+    raw = np.zeros((2, 700, 57), dtype=np.float32)
+    raw[:, :, 21] = 1
+    for i, residues in enumerate([[0, 4, 19], [1, 2, 3, 20, 5]]):
+        raw[i, :len(residues), 21] = 0
+        raw[i, np.arange(len(residues)), residues] = 1
+        raw[i, np.arange(len(residues)), 22 + np.arange(len(residues)) % 8] = 1
+    filename = str(tmpdir.join('sample.npy.gz'))
+    with gzip.open(filename, 'wb') as f:
+        np.save(f, raw.reshape(2, -1))
+
+    x_data, y_data = io.npz_parser(filename, compact=True)
+    assert x_data.dtype == np.uint8 and x_data.shape == (2, 700)
+    assert x_data[0, :4].tolist() == [1, 5, 20, 0] and not x_data[0, 3:].any()
+    assert x_data[1, :6].tolist() == [2, 3, 4, 21, 6, 0] and not x_data[1, 5:].any()
+    assert y_data[1, :6].tolist() == [1, 2, 3, 4, 5, 0]
+
+
+def test_parse_cache_entries(tmpdir, cache_dir):
+    import gzip
+    import numpy as np
+    from evolutron.tools.cache_tools import cache_entries
+
+    raw = np.random.rand(2, 700 * 57).astype(np.float32)
+    filename = str(tmpdir.join('sample.npy.gz'))
+    with gzip.open(filename, 'wb') as f:
+        np.save(f, raw)
+
+    # Without the cache, compressed arrays are read into memory and nothing is written
+    x_data, y_data = load_dataset(filename, cache=False, lazy=True)
+    assert not isinstance(x_data, np.memmap) and x_data.shape == (2, 700, 20)
+    assert np.array_equal(y_data, raw.reshape(2, 700, 57)[:, :, 22:30])
+    assert not cache_entries(cache_dir)
+    x_data, _ = load_dataset(filename, lazy=True)
+    assert isinstance(x_data, np.memmap) and len(cache_entries(cache_dir)) == 1
+
+    # Tables are cached once, as the parsed result, and not as an intermediate HDF5 store too
+    load_dataset('tests/test_tools/samples/sample.tsv', codes=True, code_key='fam')
+    assert len(cache_entries(cache_dir)) == 2
+    io.csv_parser('tests/test_tools/samples/sample.tsv')
+    assert len(cache_entries(cache_dir)) == 2
+
+
+def test_prediction_sink(tmpdir):
+    import h5py
+    import numpy as np
+
+    outputs = [np.random.rand(n, 3).astype(np.float32) for n in (4, 1, 7)]
+    with io.PredictionSink(str(tmpdir.join('pred.h5'))) as sink:
+        sink.write(outputs[:2])
+        sink.write(outputs[2:])
+    with h5py.File(str(tmpdir.join('pred.h5')), 'r') as f:
+        assert f['offsets'][:].tolist() == [0, 4, 5, 12]
+        assert np.array_equal(f['predictions'][5:], outputs[2])
+
+    with io.PredictionSink(str(tmpdir.join('pred.npy')), nb_samples=3, max_len=5) as sink:
+        sink.write(outputs)
+    padded = np.load(str(tmpdir.join('pred.npy')))
+    assert padded.shape == (3, 5, 3)
+    assert np.array_equal(padded[0, :4], outputs[0]) and not padded[1, 1:].any()
+
+    with pytest.raises(ValueError):
+        io.PredictionSink(str(tmpdir.join('pred.npy')))
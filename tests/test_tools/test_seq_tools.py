@@ -1,7 +1,11 @@
 # coding=utf-8
+import numpy as np
+import pytest
 
-from evolutron.tools.seq_tools import (aa2hot, hot2aa, secs2hot, hot2SecS_3cat, hot2SecS_8cat,
-                                       ntround, nt2prob, aa2codon)
+from evolutron.tools.seq_tools import (aa2hot, aa2hot_batch, aa2idx, aa2idx_batch, aa_map, hot2aa, hot2aa_batch,
+                                       hot2idx, idx2hot, labels2hot, secs2hot, hot2SecS_3cat, hot2SecS_8cat,
+                                       hot2SecS_3cat_batch, hot2SecS_8cat_batch, ntround, ntround_batch, nt2prob,
+                                       nt2prob_batch, prob2nt_batch, aa2codon, hot2codon_batch, seqs2bytes)
 
 
 def test_converters():
@@ -12,3 +16,86 @@ def test_converters():
     assert hot2SecS_8cat(secs2hot('HLHLEE', 8)) == 'HCHCEE'
 
     # TODO: write tests for ntround, nt2prob, aa2codon
+
+
+def test_batch_encoder():
+    seqs = ['MKFLKIK', 'XBZJ', 'MUOK']
+    map_before = dict(aa_map)
+
+    for n in [20, 22]:
+        batch = aa2hot_batch(seqs, n)
+        assert batch.shape == (3, 7, n)
+        assert batch.dtype == np.float32
+        for i, seq in enumerate(seqs):
+            np.testing.assert_allclose(batch[i, :len(seq)], aa2hot(seq, n))
+            assert not batch[i, len(seq):].any()
+
+    assert aa2hot_batch(seqs, 20, max_len=5).shape == (3, 5, 20)
+    assert aa2hot('U', 20).sum() == 0 and aa2hot('U', 22)[0, aa_map['U']] == 1
+    assert aa_map == map_before
+
+
+def test_index_encoder():
+    seqs = ['MKFLKIK', 'XBZJ', 'MUOK']
+
+    for n in [20, 22]:
+        idx = aa2idx_batch(seqs, n)
+        assert idx.dtype == np.uint8 and idx.shape == (3, 7)
+        np.testing.assert_array_equal(idx2hot(idx, n), aa2hot_batch(seqs, n))
+        np.testing.assert_array_equal(aa2idx(seqs[0], n), idx[0])
+
+    assert hot2aa(idx2hot(aa2idx('MKFLKIK'))) == 'MKFLKIK'
+    np.testing.assert_array_equal(hot2idx(idx2hot(idx[:1], 22)), idx[:1])
+    np.testing.assert_array_equal(labels2hot(np.array([0, 1, 3]), 3), [[0, 0, 0], [1, 0, 0], [0, 0, 1]])
+
+
+def test_batch_decoders():
+    seqs = ['MKFLKIK', 'MKW', 'HUO']
+    hot = aa2hot_batch(seqs, 22)
+
+    assert hot2aa_batch(hot) == ['MKFLKIK', 'MKW----', 'HUO----']
+    assert hot2aa_batch(hot, lengths=[7, 3, 3]) == seqs
+    assert hot2aa(hot[1]) == 'MKW----'
+
+    secs = np.stack([secs2hot('HLHLEE', 8), np.vstack((secs2hot('GIT', 8), np.zeros((3, 8))))])
+    assert hot2SecS_8cat_batch(secs) == ['HCHCEE', 'GITCCC']
+    assert hot2SecS_8cat_batch(secs, lengths=[6, 3]) == ['HCHCEE', 'GIT']
+    assert hot2SecS_3cat_batch(secs2hot('HLHLEE', 3)) == ['HCHCEE']
+
+
+def test_seqs2bytes():
+    codes, lengths = seqs2bytes(['ACD', '', 'MKVLL', 'Q'], max_len=4)
+    assert [row.tobytes() for row in codes] == [b'ACD\0', b'\0' * 4, b'MKVL', b'Q\0\0\0']
+    assert lengths.tolist() == [3, 0, 5, 1]
+    assert seqs2bytes([b'AB', b'C'])[0].tolist() == [[65, 66], [67, 0]]
+
+
+def test_nt_codec():
+    sites = ['GAATTC', 'CCWGG', 'GCNNNNNGC']
+    codes = nt2prob_batch(sites)
+
+    assert codes.shape == (3, 9, 4) and codes.dtype == np.float32
+    for i, site in enumerate(sites):
+        np.testing.assert_array_equal(codes[i, :len(site)], nt2prob(site))
+
+    assert prob2nt_batch(codes, lengths=[len(s) for s in sites]) == sites
+    assert prob2nt_batch(codes.reshape((3, -1)))[1] == 'CCWGG----'
+
+    # Letters outside the IUPAC code are rejected, as the per-letter lookup used to
+    with pytest.raises(IOError):
+        nt2prob_batch(['GAATTC', 'GAXTTC'])
+    with pytest.raises(IOError):
+        nt2prob('gaattc')
+    assert nt2prob_batch(['GAATTCX'], max_len=6).shape == (1, 6, 4)
+
+    probs = np.random.rand(100)
+    np.testing.assert_array_equal(ntround_batch(probs), [ntround(p) for p in probs])
+
+
+def test_codon_features():
+    seqs = ['MKFLKIKUO', 'MKW']
+    codons = hot2codon_batch(aa2hot_batch(seqs, 22))
+
+    assert codons.shape == (2, 9, 64)
+    np.testing.assert_array_equal(codons[0], aa2codon(seqs[0]))
+    assert codons[1, :3].sum() == 1 + 2 + 1 and not codons[1, 3:].any()
@@ -0,0 +1,38 @@
+# coding=utf-8
+"""
+Test of on-disk dataset shards.
+
+"""
+import numpy as np
+import pytest
+from evolutron.tools import aa2hot, load_random_aa_seqs
+
+pytest.importorskip('keras')
+from evolutron.tools.shard_tools import ShardSequence, write_shards  # noqa: E402
+
+
+def test_shard_sequence(tmpdir):
+    x_raw = load_random_aa_seqs(50, min_length=10, max_length=40)
+    y_raw = np.arange(50)
+
+    sizes = write_shards(x_raw, str(tmpdir), y_data=y_raw, shard_size=20, max_aa=45)
+    assert sizes == [20, 20, 10]
+
+    seq = ShardSequence(str(tmpdir), batch_size=8, shuffle=False)
+    assert len(seq) == 3 + 3 + 2
+
+    # Batches never cross shards
+    x, y = seq[2]
+    assert x.shape == (4, 45, 20)
+    assert y.tolist() == list(range(16, 20))
+    assert np.array_equal(x[0, :len(x_raw[16])], aa2hot(x_raw[16]))
+
+    # Row access across shard boundaries
+    assert len(seq.inputs) == 50
+    assert seq.inputs[18:23].shape == (5, 45, 20)
+    assert np.array_equal(seq.inputs[-1][:len(x_raw[49])], aa2hot(x_raw[49]))
+
+    seq = ShardSequence(str(tmpdir), batch_size=8, shuffle=True, expand=False, targets=False)
+    seen = np.sort(np.concatenate([seq[i][:, 0] for i in range(len(seq))]))
+    assert seq[0].dtype == np.uint8
+    assert len(seen) == 50